@@ -7,7 +7,9 @@ Usage examples:
   python api_syncs/backfill_spotify_play_history.py --batch-size 250
 
 Behavior:
-- Selects up to N unique track_ids that are still missing any of (artist_id, album_id, album_type).
+- Drains spotify_play_history_pending_tracks first (track ids queued by
+  import_spotify_history.py), then selects up to N unique track_ids that are
+  still missing any of (artist_id, album_id, album_type).
 - Looks up metadata via Spotify API in chunks of 50 (tracks endpoint limit).
 - Updates spotify_play_history rows for those track_ids.
 - Upserts minimal rows into artists and albums to keep the catalog consistent.
@@ -60,6 +62,29 @@ def fetch_missing_track_ids(cur, limit):
     return [r[0] for r in cur.fetchall()]
 
 
+def fetch_queued_track_ids(cur, limit):
+    """Track ids queued by the history importer, oldest first ([] if there is no queue)."""
+    cur.execute("SELECT to_regclass('spotify_play_history_pending_tracks') IS NOT NULL")
+    if not cur.fetchone()[0]:
+        return []
+    cur.execute(
+        """
+        SELECT track_id
+          FROM spotify_play_history_pending_tracks
+         ORDER BY queued_at, track_id
+         LIMIT %s
+        """,
+        (limit,),
+    )
+    return [r[0] for r in cur.fetchall()]
+
+
+def dequeue_track_ids(cur, track_ids):
+    cur.execute("SELECT to_regclass('spotify_play_history_pending_tracks') IS NOT NULL")
+    if cur.fetchone()[0]:
+        cur.execute("DELETE FROM spotify_play_history_pending_tracks WHERE track_id = ANY(%s)", (list(track_ids),))
+
+
 def upsert_artist(cur, artist_id, artist_name):
     if not artist_id:
         return
@@ -128,7 +153,7 @@ def backfill_history(batch_size: int = 500, drip_delay: int = 5, no_catalog_writ
     total_processed = 0
 
     while True:
-        track_ids = fetch_missing_track_ids(cur, batch_size)
+        track_ids = fetch_queued_track_ids(cur, batch_size) or fetch_missing_track_ids(cur, batch_size)
         if not track_ids:
             log_event(JOB_NAME, "Nothing left to backfill. All rows enriched.")
             print("✅ All rows enriched. Backfill complete.")
@@ -142,27 +167,18 @@ def backfill_history(batch_size: int = 500, drip_delay: int = 5, no_catalog_writ
             try:
                 resp = sp.tracks(chunk)
             except spotipy.SpotifyException as e:
-                # If token expired, refresh client via our standard helper and retry once
-                if getattr(e, 'http_status', None) == 401:
-                    log_event(JOB_NAME, "Access token expired. Refreshing client and retrying chunk once…")
-                    print("🔄 Access token expired. Refreshing and retrying…")
-                    sp = get_spotify_client()
-                    try:
-                        resp = sp.tracks(chunk)
-                    except Exception as e2:
-                        log_event(JOB_NAME, f"401 retry failed; exiting job. Error: {e2}")
-                        print(f"❗ 401 retry failed; stopping backfill. Error: {e2}")
-                        sys.exit(1)
-                else:
-                    log_event(JOB_NAME, f"Spotify API error: {e}. Sleeping 30s and retrying this chunk…")
-                    print(f"⚠️ Spotify API error: {e}. Sleeping 30s and retrying this chunk…")
-                    time.sleep(30)
-                    try:
-                        resp = sp.tracks(chunk)
-                    except Exception as e2:
-                        log_event(JOB_NAME, f"Chunk failed again, skipping. Error: {e2}")
-                        print(f"❗ Chunk failed again, skipping. Error: {e2}")
-                        continue
+                # Expired tokens are refreshed by the shared client; anything else gets one retry
+                log_event(JOB_NAME, f"Spotify API error: {e}. Sleeping 30s and retrying this chunk…")
+                print(f"⚠️ Spotify API error: {e}. Sleeping 30s and retrying this chunk…")
+                time.sleep(30)
+                try:
+                    resp = sp.tracks(chunk)
+                except Exception as e2:
+                    log_event(JOB_NAME, f"Chunk failed again, skipping. Error: {e2}")
+                    print(f"❗ Chunk failed again, skipping. Error: {e2}")
+                    dequeue_track_ids(cur, chunk)
+                    conn.commit()
+                    continue
 
             tracks = (resp or {}).get("tracks", []) or []
             for t in tracks:
@@ -193,6 +209,8 @@ def backfill_history(batch_size: int = 500, drip_delay: int = 5, no_catalog_writ
                 # Update all history rows for this track_id that are still missing data
                 update_history_rows(cur, tid, primary_artist_id, album_id, album_type, track_duration)
 
+            # Unknown ids come back as null; they leave the queue either way
+            dequeue_track_ids(cur, chunk)
             conn.commit()
             total_processed += len(chunk)
             log_event(JOB_NAME, f"Committed chunk of {len(chunk)} tracks; total processed this run: {total_processed}.")
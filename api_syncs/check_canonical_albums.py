@@ -1,4 +1,3 @@
-import time
 import logging
 from utils.spotify_auth import get_spotify_client
 from utils.db_utils import get_db_connection
@@ -29,10 +28,9 @@ def get_albums_by_artist(sp, artist_id):
     while results['next']:
         results = sp.next(results)
         albums.extend(results['items'])
-        time.sleep(0.1)
     return albums
 
-def main():
+def run(context=None):
     conn = get_db_connection()
     sp = get_spotify_client()
 
@@ -124,4 +122,4 @@ def main():
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
-    main()
\ No newline at end of file
+    run()
\ No newline at end of file
@@ -1,127 +1,144 @@
 import os
-from utils.db_utils import get_db_connection
-import requests
-import time
-from datetime import datetime, timedelta
-from spotipy import Spotify
+from datetime import datetime
+from psycopg2.extras import execute_values
 from spotipy.exceptions import SpotifyException
+from utils.db_utils import get_db_connection
 from utils.logger import log_event
 from utils.spotify_auth import get_spotify_client
+from utils.spotify_rate_limit import spotify_map
 
-def safe_spotify_call(func, *args, **kwargs):
-    retries = 0
-    while True:
-        try:
-            return func(*args, **kwargs)
-        except SpotifyException as e:
-            if e.http_status == 429:
-                retry_after = int(e.headers.get("Retry-After", 5))
-                retries += 1
-                log_event("check_track_availability", f"Rate limit hit. Retry #{retries} in {retry_after}s")
-                time.sleep(retry_after)
-            else:
-                log_event("check_track_availability", f"Spotify error: {e}", level="error")
-                raise
-        except requests.exceptions.ReadTimeout as e:
-            retries += 1
-            log_event("check_track_availability", f"Timeout hit. Retry #{retries} in 5s... ({e})")
-            time.sleep(5)
-        except Exception as e:
-            log_event("check_track_availability", f"Unexpected error: {e}", level="error")
-            raise
-
-# ─────────────────────────────────────────────
-sp = get_spotify_client()
-
-# 🌍 Get user country
-try:
-    user_profile = safe_spotify_call(sp.current_user)
-    user_country = user_profile.get("country", "US")
-    log_event("check_track_availability", f"User country detected: {user_country}")
-except Exception as e:
-    log_event("check_track_availability", f"Could not retrieve user country, defaulting to 'US': {e}", level="warning")
-    user_country = "US"
-
-conn = get_db_connection()
-cur = conn.cursor()
-
-now = datetime.utcnow()
-
-# ─────────────────────────────────────────────
-# Step 1: Build unified view of track IDs with last check timestamp
-cur.execute("""
-(
-    SELECT combined.track_id
-    FROM (
-        SELECT track_id FROM liked_tracks
-        UNION
-        SELECT id AS track_id FROM tracks
-    ) AS combined
-    LEFT JOIN track_availability ta ON combined.track_id = ta.track_id
-    WHERE ta.checked_at IS NULL
-)
-UNION
-(
-    SELECT combined.track_id
-    FROM (
-        SELECT track_id FROM liked_tracks
-        UNION
-        SELECT id AS track_id FROM tracks
-    ) AS combined
-    LEFT JOIN track_availability ta ON combined.track_id = ta.track_id
-    WHERE ta.checked_at IS NOT NULL
-    ORDER BY ta.checked_at ASC
-    LIMIT 100
-)
-""")
-
-rows = cur.fetchall()
-to_check = [track_id for (track_id,) in rows]
-
-log_event("check_track_availability", f"Eligible tracks to check: {len(to_check)}")
-
-# Step 2: Query Spotify and update records
-for i, track_id in enumerate(to_check, start=1):
-    log_event("check_track_availability", f"[{i}/{len(to_check)}] Checking track: {track_id}")
+JOB_NAME = "check_track_availability"
+TRACKS_PER_REQUEST = 50  # Spotify max for /tracks?ids=
+# Concurrent /tracks requests; overall request rate is governed by SPOTIFY_RATE_PER_S
+AVAILABILITY_CONCURRENCY = int(os.getenv("AVAILABILITY_CONCURRENCY", "4"))
+# Track ids looked up, upserted and committed together
+AVAILABILITY_COMMIT_CHUNK = int(os.getenv("AVAILABILITY_COMMIT_CHUNK", "1000"))
+
+
+def get_user_country(sp):
+    # 🌍 Get user country
     try:
-        track = safe_spotify_call(sp.track, track_id, market=user_country)
-        is_playable = track.get('is_playable')
-        if is_playable is None:
-            available_markets = track.get('available_markets', [])
-            is_playable = user_country in available_markets
+        user_profile = sp.current_user()
+        user_country = user_profile.get("country", "US")
+        log_event(JOB_NAME, f"User country detected: {user_country}")
     except Exception as e:
-        log_event("check_track_availability", f"Error retrieving track {track_id}: {e}", level="error")
-        is_playable = False
+        log_event(JOB_NAME, f"Could not retrieve user country, defaulting to 'US': {e}", level="warning")
+        user_country = "US"
+    return user_country
 
+
+def check_batch(sp, track_ids, market):
+    """Return [(track_id, is_playable)] for up to 50 ids in one request.
+
+    Results are matched by position, so relinked tracks (whose ``id`` is the
+    substitute) still map back to the id we asked about. A 400 (some id in
+    the batch is invalid) is bisected so only the bad id is marked
+    unplayable; any other failure returns nothing, leaving the batch's
+    previous result and checked_at untouched for the next run.
+    """
     try:
-        cur.execute("""
-            INSERT INTO track_availability (track_id, is_playable, checked_at)
-            VALUES (%s, %s, %s)
-            ON CONFLICT (track_id) DO UPDATE SET
-                is_playable = EXCLUDED.is_playable,
-                checked_at = EXCLUDED.checked_at;
-        """, (track_id, is_playable, now))
-    except Exception as db_err:
-        log_event("check_track_availability", f"Database error for track {track_id}: {db_err}", level="error")
-
-    if i % 50 == 0 or i == len(to_check):
-        conn.commit()
-        log_event("check_track_availability", f"Committed batch up to track #{i}")
+        tracks = sp.tracks(track_ids, market=market).get('tracks') or []
+    except Exception as e:
+        if isinstance(e, SpotifyException) and e.http_status == 400:
+            if len(track_ids) == 1:
+                log_event(JOB_NAME, f"Spotify rejected track id {track_ids[0]}: {e}", level="warning")
+                return [(track_ids[0], False)]
+            half = len(track_ids) // 2
+            return check_batch(sp, track_ids[:half], market) + check_batch(sp, track_ids[half:], market)
+        log_event(JOB_NAME, f"Error retrieving {len(track_ids)} track(s) starting at {track_ids[0]}: {e}", level="error")
+        return []
+
+    results = []
+    for i, track_id in enumerate(track_ids):
+        track = tracks[i] if i < len(tracks) else None
+        if not track:
+            results.append((track_id, False))
+            continue
+        is_playable = track.get('is_playable')
+        if is_playable is None:
+            is_playable = market in (track.get('available_markets') or [])
+        results.append((track_id, bool(is_playable)))
+    return results
 
 
-# ─────────────────────────────────────────────
-# Cleanup: remove orphaned entries from track_availability
-cur.execute("""
-    DELETE FROM track_availability
-    WHERE track_id NOT IN (
+def run(context=None):
+    sp = get_spotify_client()
+    user_country = get_user_country(sp)
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    now = datetime.utcnow()
+
+    # ─────────────────────────────────────────────
+    # Step 1: Never-checked tracks, plus the 100 stalest checks
+    cur.execute("""
+    WITH combined AS (
         SELECT track_id FROM liked_tracks
         UNION
-        SELECT id FROM tracks
-    );
-""")
-conn.commit()
-log_event("check_track_availability", "🧹 Removed orphaned rows from track_availability")
-
-cur.close()
-conn.close()
-log_event("check_track_availability", "✅ Finished checking availability")
+        SELECT id AS track_id FROM tracks
+    )
+    (
+        SELECT c.track_id
+        FROM combined c
+        WHERE NOT EXISTS (
+            SELECT 1 FROM track_availability ta
+            WHERE ta.track_id = c.track_id AND ta.checked_at IS NOT NULL
+        )
+    )
+    UNION
+    (
+        SELECT c.track_id
+        FROM combined c
+        JOIN track_availability ta ON ta.track_id = c.track_id
+        WHERE ta.checked_at IS NOT NULL
+        ORDER BY ta.checked_at ASC
+        LIMIT 100
+    )
+    """)
+    to_check = [track_id for (track_id,) in cur.fetchall()]
+    log_event(JOB_NAME, f"Eligible tracks to check: {len(to_check)}")
+
+    # ─────────────────────────────────────────────
+    # Step 2: Query Spotify 50 ids per request and bulk upsert each chunk
+    checked = 0
+    for start in range(0, len(to_check), AVAILABILITY_COMMIT_CHUNK):
+        chunk = to_check[start:start + AVAILABILITY_COMMIT_CHUNK]
+        batches = [chunk[i:i + TRACKS_PER_REQUEST] for i in range(0, len(chunk), TRACKS_PER_REQUEST)]
+        results = []
+        for batch_results in spotify_map(lambda batch: check_batch(sp, batch, user_country), batches,
+                                         max_workers=AVAILABILITY_CONCURRENCY):
+            results.extend(batch_results)
+
+        if results:
+            execute_values(cur, """
+                INSERT INTO track_availability (track_id, is_playable, checked_at)
+                VALUES %s
+                ON CONFLICT (track_id) DO UPDATE SET
+                    is_playable = EXCLUDED.is_playable,
+                    checked_at = EXCLUDED.checked_at
+            """, [(track_id, is_playable, now) for track_id, is_playable in results], page_size=1000)
+        conn.commit()
+
+        checked += len(chunk)
+        unavailable = sum(1 for _, is_playable in results if not is_playable)
+        log_event(JOB_NAME, f"Committed {checked}/{len(to_check)} tracks ({unavailable} unavailable, "
+                            f"{len(chunk) - len(results)} left unchecked after errors in this chunk)")
+
+    # ─────────────────────────────────────────────
+    # Cleanup: remove orphaned entries from track_availability
+    cur.execute("""
+        DELETE FROM track_availability ta
+        WHERE NOT EXISTS (SELECT 1 FROM tracks t WHERE t.id = ta.track_id)
+          AND NOT EXISTS (SELECT 1 FROM liked_tracks lt WHERE lt.track_id = ta.track_id)
+    """)
+    removed = cur.rowcount
+    conn.commit()
+    log_event(JOB_NAME, f"🧹 Removed {removed} orphaned rows from track_availability")
+
+    cur.close()
+    conn.close()
+    log_event(JOB_NAME, "✅ Finished checking availability")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,259 @@
+"""
+Import an Apple Music "Play Activity" CSV export into apple_music_play_history.
+
+Usage examples:
+  python api_syncs/import_apple_music_history.py "Apple Music Play Activity.csv"
+  python api_syncs/import_apple_music_history.py export.csv --min-ms-played 30000
+
+Behavior:
+- The CSV is streamed row by row and COPYed into an UNLOGGED staging table in
+  batches, so memory stays bounded by APPLE_HISTORY_COPY_BATCH rows.
+- Only PLAY_END events are kept (one row per play). Timestamps are
+  normalized to naive UTC truncated to the second, and durations to positive
+  integer milliseconds. Column names from older and newer export layouts
+  are both accepted.
+- The merge is idempotent: each play's fingerprint (utils/play_fingerprint.py)
+  is unique, so re-importing the same or an overlapping export adds nothing.
+- Plays of Apple tracks already matched in apple_unique_track_ids get the
+  Spotify ids filled in. Apple track ids not seen before are added to
+  apple_unique_track_ids, so the apple_private backfill scripts only
+  process the delta.
+- Everything runs in one transaction.
+"""
+import os
+import sys as _sys
+# Ensure project root is on sys.path when running as a script
+_sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import csv
+import time
+
+from utils.db_utils import get_db_connection, copy_rows
+from utils.logger import log_event
+from utils.play_fingerprint import ensure_play_fingerprint, fingerprint_sql
+from utils.play_partitions import ensure_play_partitions
+from api_syncs.materialized_views import change_tracking_suspended
+
+JOB_NAME = "import_apple_music_history"
+TARGET_TABLE = "apple_music_play_history"
+TRACK_IDS_TABLE = "apple_unique_track_ids"
+COPY_BATCH = int(os.getenv("APPLE_HISTORY_COPY_BATCH", "50000"))
+# Larger imports skip per-statement change tracking and queue one full unified_tracks rebuild
+FULL_REBUILD_ROWS = int(os.getenv("APPLE_HISTORY_FULL_REBUILD_ROWS", "50000"))
+PLAY_EVENT_TYPES = {"PLAY_END"}
+
+# Export column -> accepted header names, newest layout first
+CSV_COLUMNS = {
+    "apple_track_id": ("Song ID", "Content ID", "Item ID", "Track Identifier"),
+    "played_at": ("Event Start Timestamp", "Event End Timestamp", "Event Received Timestamp"),
+    "track_name": ("Song Name", "Content Name"),
+    "artist_name": ("Artist Name", "Container Artist Name"),
+    "album_name": ("Album Name", "Container Album Name"),
+    "duration_ms": ("Media Duration In Milliseconds",),
+    "ms_played": ("Play Duration Milliseconds",),
+    "event_type": ("Event Type",),
+}
+
+STAGING_TABLE = "apple_play_activity_staging"
+STAGING_COLUMNS = ("apple_track_id", "played_at", "track_name", "artist_name", "album_name", "duration_ms")
+STAGING_DDL = f"""
+CREATE UNLOGGED TABLE IF NOT EXISTS {STAGING_TABLE} (
+    apple_track_id TEXT,
+    played_at TIMESTAMPTZ NOT NULL,
+    track_name TEXT NOT NULL,
+    artist_name TEXT,
+    album_name TEXT,
+    duration_ms INTEGER
+);
+"""
+
+NORMALIZED_SQL = f"""
+SELECT DISTINCT ON (fingerprint)
+    apple_track_id, played_at, track_name, artist_name, album_name, duration_ms
+FROM (
+    SELECT s.*, {fingerprint_sql('s.played_at', 's.track_name', 's.artist_name')} AS fingerprint
+    FROM (
+        SELECT apple_track_id, date_trunc('second', played_at AT TIME ZONE 'UTC') AS played_at,
+               track_name, artist_name, album_name, duration_ms
+        FROM {STAGING_TABLE}
+    ) s
+) f
+ORDER BY fingerprint, apple_track_id NULLS LAST
+"""
+
+
+def _column_map(fieldnames):
+    """{our column: CSV header} for the headers present in this export."""
+    present = set(fieldnames or ())
+    mapping = {}
+    for column, headers in CSV_COLUMNS.items():
+        for header in headers:
+            if header in present:
+                mapping[column] = header
+                break
+    missing = {"played_at", "track_name"} - set(mapping)
+    if missing:
+        raise ValueError(f"CSV is missing required columns for: {', '.join(sorted(missing))}")
+    return mapping
+
+
+def _ms(value):
+    """Positive integer milliseconds, or None."""
+    try:
+        ms = int(float(value))
+    except (TypeError, ValueError):
+        return None
+    return ms if ms > 0 else None
+
+
+def activity_row(record, columns, min_ms_played=0):
+    """Staging row for one CSV record, or None for non-play events and unusable rows."""
+    def get(column):
+        header = columns.get(column)
+        value = record.get(header) if header else None
+        return (value.strip() or None) if isinstance(value, str) else value
+
+    event_type = get("event_type")
+    if event_type is not None and event_type not in PLAY_EVENT_TYPES:
+        return None
+    played_at, track_name = get("played_at"), get("track_name")
+    if not played_at or not track_name:
+        return None
+    if min_ms_played and (_ms(get("ms_played")) or 0) < min_ms_played:
+        return None
+    return (
+        get("apple_track_id"),
+        played_at,
+        track_name,
+        get("artist_name"),
+        get("album_name"),
+        _ms(get("duration_ms")),
+    )
+
+
+def stage_csv(cur, path, min_ms_played=0):
+    """COPY one export file into staging in batches. Returns (records, staged)."""
+    records = staged = 0
+    batch = []
+    with open(path, newline="", encoding="utf-8-sig") as fp:
+        reader = csv.DictReader(fp)
+        columns = _column_map(reader.fieldnames)
+        for record in reader:
+            records += 1
+            row = activity_row(record, columns, min_ms_played)
+            if row is None:
+                continue
+            batch.append(row)
+            if len(batch) >= COPY_BATCH:
+                staged += copy_rows(cur, STAGING_TABLE, STAGING_COLUMNS, batch)
+                batch = []
+    staged += copy_rows(cur, STAGING_TABLE, STAGING_COLUMNS, batch)
+    return records, staged
+
+
+def _track_id_type(cur):
+    """Column type of apple_unique_track_ids.apple_track_id, or None without that table."""
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL", (TRACK_IDS_TABLE,))
+    if not cur.fetchone()[0]:
+        return None
+    cur.execute("""
+        SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+        WHERE attrelid = %s::regclass AND attname = 'apple_track_id'
+    """, (TRACK_IDS_TABLE,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def merge_staged(cur, staged):
+    """Merge staging into apple_music_play_history. Returns (inserted, new_track_ids)."""
+    cur.execute(f"""
+        SELECT MIN(played_at AT TIME ZONE 'UTC'), MAX(played_at AT TIME ZONE 'UTC') FROM {STAGING_TABLE}
+    """)
+    oldest, newest = cur.fetchone()
+    if oldest is not None:
+        ensure_play_partitions(cur, start=oldest, end=newest, tables=(TARGET_TABLE,))
+
+    id_type = _track_id_type(cur)
+    new_track_ids = 0
+    if id_type:
+        # Only Apple track ids not seen before; the backfills pick up rows with no Spotify match yet
+        cur.execute(f"""
+            INSERT INTO {TRACK_IDS_TABLE} (apple_track_id, name, artist_name, album_name, duration_ms)
+            SELECT DISTINCT ON (apple_track_id) apple_track_id::{id_type}, track_name, artist_name, album_name, duration_ms
+            FROM {STAGING_TABLE}
+            WHERE apple_track_id IS NOT NULL
+            ORDER BY apple_track_id, played_at DESC
+            ON CONFLICT (apple_track_id) DO NOTHING
+        """)
+        new_track_ids = cur.rowcount
+        matched = (f"LEFT JOIN {TRACK_IDS_TABLE} m ON m.apple_track_id = n.apple_track_id::{id_type} "
+                   f"AND m.spotify_track_id IS NOT NULL")
+        spotify = ("m.spotify_track_id, m.spotify_artist_id, m.spotify_album_id, m.spotify_album_type, "
+                   "CASE WHEN m.spotify_track_id IS NOT NULL THEN NOW() END")
+    else:
+        matched = ""
+        spotify = "NULL, NULL, NULL, NULL, NULL"
+
+    merge_sql = f"""
+        INSERT INTO {TARGET_TABLE}
+            (played_at, track_name, artist_name, album_name, duration_ms,
+             track_id, artist_id, album_id, album_type, checked_at)
+        SELECT n.played_at, n.track_name, n.artist_name, n.album_name, n.duration_ms, {spotify}
+        FROM ({NORMALIZED_SQL}) n
+        {matched}
+        ON CONFLICT (play_fingerprint, played_at) DO NOTHING
+    """
+    if staged >= FULL_REBUILD_ROWS:
+        with change_tracking_suspended(cur, TARGET_TABLE):
+            cur.execute(merge_sql)
+            inserted = cur.rowcount
+    else:
+        cur.execute(merge_sql)
+        inserted = cur.rowcount
+    return inserted, new_track_ids
+
+
+def import_activity(paths, min_ms_played=0):
+    start = time.time()
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        ensure_play_fingerprint(cur)
+        cur.execute(STAGING_DDL)
+        cur.execute(f"TRUNCATE {STAGING_TABLE}")
+
+        total_records = total_staged = 0
+        for path in paths:
+            records, staged = stage_csv(cur, path, min_ms_played)
+            total_records += records
+            total_staged += staged
+            print(f"📥 {os.path.basename(path)}: {staged} of {records} rows staged")
+
+        inserted, new_track_ids = merge_staged(cur, total_staged)
+        cur.execute(f"TRUNCATE {STAGING_TABLE}")
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        log_event(JOB_NAME, f"❌ Import failed: {e}", level="error")
+        raise
+    finally:
+        cur.close()
+        conn.close()
+
+    log_event(JOB_NAME, f"✅ Imported {inserted} new plays from {len(paths)} file(s) "
+                        f"({total_staged} staged of {total_records} rows, {new_track_ids} new Apple track ids) "
+                        f"in {time.time() - start:.1f}s")
+    return inserted
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Import Apple Music Play Activity CSV into apple_music_play_history")
+    ap.add_argument("paths", nargs="+", help="Play Activity CSV file(s)")
+    ap.add_argument("--min-ms-played", type=int, default=0, help="Skip plays shorter than this many ms (default 0)")
+    return ap.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    import_activity(args.paths, min_ms_played=args.min_ms_played)
@@ -0,0 +1,240 @@
+"""
+Import a Spotify Extended Streaming History export into spotify_play_history.
+
+Usage examples:
+  python api_syncs/import_spotify_history.py ~/Downloads/my_spotify_data/          # every Streaming_History_Audio_*.json
+  python api_syncs/import_spotify_history.py Streaming_History_Audio_2023.json --min-ms-played 30000
+
+Behavior:
+- Each file is streamed element by element (the export is one big JSON array
+  per file), so memory stays bounded by SPOTIFY_HISTORY_COPY_BATCH rows.
+- Music plays are mapped to the table schema (ts -> played_at in UTC,
+  spotify_track_uri -> track_id, track/artist/album names); podcast episodes
+  and local files are skipped.
+- Rows are COPYed into an UNLOGGED staging table and merged in one statement,
+  deduplicated on (track_id, played_at), so re-importing an export is a no-op.
+- Metadata (artist/album ids, album type, duration) is copied from already
+  enriched plays of the same track. Track ids never seen before are queued in
+  spotify_play_history_pending_tracks for backfill_spotify_play_history.py.
+- Everything runs in one transaction.
+"""
+import os
+import sys as _sys
+# Ensure project root is on sys.path when running as a script
+_sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import glob
+import json
+import re
+import time
+
+from utils.db_utils import get_db_connection, copy_rows
+from utils.logger import log_event
+from utils.play_partitions import ensure_play_partitions
+from api_syncs.materialized_views import change_tracking_suspended
+
+JOB_NAME = "import_spotify_history"
+TARGET_TABLE = "spotify_play_history"
+FILE_PATTERNS = ("Streaming_History_Audio_*.json", "endsong_*.json")
+COPY_BATCH = int(os.getenv("SPOTIFY_HISTORY_COPY_BATCH", "50000"))
+READ_CHUNK = 1 << 20
+# Larger imports skip per-statement change tracking and queue one full unified_tracks rebuild
+FULL_REBUILD_ROWS = int(os.getenv("SPOTIFY_HISTORY_FULL_REBUILD_ROWS", "50000"))
+
+STAGING_TABLE = "spotify_history_staging"
+STAGING_COLUMNS = ("track_id", "played_at", "track_name", "artist_name", "album_name")
+STAGING_DDL = f"""
+CREATE UNLOGGED TABLE IF NOT EXISTS {STAGING_TABLE} (
+    track_id TEXT NOT NULL,
+    played_at TIMESTAMPTZ NOT NULL,
+    track_name TEXT,
+    artist_name TEXT,
+    album_name TEXT
+);
+"""
+
+PENDING_TABLE = "spotify_play_history_pending_tracks"
+PENDING_DDL = f"""
+CREATE TABLE IF NOT EXISTS {PENDING_TABLE} (
+    track_id TEXT PRIMARY KEY,
+    queued_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+# Distinct track ids with no play in the table at all (run before the merge)
+QUEUE_UNSEEN_SQL = f"""
+INSERT INTO {PENDING_TABLE} (track_id)
+SELECT DISTINCT s.track_id
+FROM {STAGING_TABLE} s
+WHERE NOT EXISTS (SELECT 1 FROM {TARGET_TABLE} h WHERE h.track_id = s.track_id)
+ON CONFLICT (track_id) DO NOTHING
+"""
+
+MERGE_SQL = f"""
+WITH staged AS (
+    SELECT DISTINCT ON (track_id, played_at)
+        track_id, (played_at AT TIME ZONE 'UTC') AS played_at, track_name, artist_name, album_name
+    FROM {STAGING_TABLE}
+    ORDER BY track_id, played_at
+),
+known AS (
+    SELECT DISTINCT ON (h.track_id)
+        h.track_id, h.artist_id, h.album_id, h.album_type, h.duration_ms
+    FROM {TARGET_TABLE} h
+    WHERE h.track_id IN (SELECT track_id FROM staged)
+      AND h.artist_id IS NOT NULL AND h.album_id IS NOT NULL
+      AND h.album_type IS NOT NULL AND h.duration_ms IS NOT NULL
+    ORDER BY h.track_id, h.checked_at DESC NULLS LAST
+)
+INSERT INTO {TARGET_TABLE}
+    (track_id, played_at, track_name, artist_id, duration_ms, artist_name, album_id, album_name, album_type, checked_at)
+SELECT s.track_id, s.played_at, s.track_name, k.artist_id, k.duration_ms, s.artist_name,
+       k.album_id, s.album_name, k.album_type, CASE WHEN k.track_id IS NOT NULL THEN NOW() END
+FROM staged s
+LEFT JOIN known k ON k.track_id = s.track_id
+ON CONFLICT (track_id, played_at) DO NOTHING
+"""
+
+_SEPARATORS = re.compile(r"[\s,]*")
+
+
+def iter_json_array(fp, chunk_size=READ_CHUNK):
+    """Yield the elements of a top-level JSON array without reading the whole file."""
+    decoder = json.JSONDecoder()
+    buf = fp.read(chunk_size)
+    pos = _SEPARATORS.match(buf).end()
+    if buf[pos:pos + 1] != "[":
+        raise ValueError("expected a JSON array")
+    pos += 1
+    while True:
+        pos = _SEPARATORS.match(buf, pos).end()
+        if buf[pos:pos + 1] == "]":
+            return
+        try:
+            item, pos = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            # Element cut off at the end of the buffer: read on and retry
+            chunk = fp.read(chunk_size)
+            if not chunk:
+                raise
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+        yield item
+
+
+def history_row(entry, min_ms_played=0):
+    """Staging row for one export entry, or None for episodes, local files and short plays."""
+    uri = entry.get("spotify_track_uri")
+    if not uri or not uri.startswith("spotify:track:") or not entry.get("ts"):
+        return None
+    if (entry.get("ms_played") or 0) < min_ms_played:
+        return None
+    return (
+        uri.rsplit(":", 1)[1],
+        entry["ts"],
+        entry.get("master_metadata_track_name"),
+        entry.get("master_metadata_album_artist_name"),
+        entry.get("master_metadata_album_album_name"),
+    )
+
+
+def find_export_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for pattern in FILE_PATTERNS:
+                files.extend(sorted(glob.glob(os.path.join(path, pattern))))
+        else:
+            files.append(path)
+    return files
+
+
+def stage_file(cur, path, min_ms_played=0):
+    """COPY one export file into staging in batches. Returns (entries, staged)."""
+    entries = staged = 0
+    batch = []
+    with open(path, encoding="utf-8-sig") as fp:
+        for entry in iter_json_array(fp):
+            entries += 1
+            row = history_row(entry, min_ms_played)
+            if row is None:
+                continue
+            batch.append(row)
+            if len(batch) >= COPY_BATCH:
+                staged += copy_rows(cur, STAGING_TABLE, STAGING_COLUMNS, batch)
+                batch = []
+    staged += copy_rows(cur, STAGING_TABLE, STAGING_COLUMNS, batch)
+    return entries, staged
+
+
+def merge_staged(cur, staged):
+    """Merge staging into spotify_play_history. Returns (inserted, queued)."""
+    cur.execute(f"""
+        SELECT MIN(played_at AT TIME ZONE 'UTC'), MAX(played_at AT TIME ZONE 'UTC') FROM {STAGING_TABLE}
+    """)
+    oldest, newest = cur.fetchone()
+    if oldest is not None:
+        ensure_play_partitions(cur, start=oldest, end=newest, tables=(TARGET_TABLE,))
+
+    cur.execute(QUEUE_UNSEEN_SQL)
+    queued = cur.rowcount
+    if staged >= FULL_REBUILD_ROWS:
+        with change_tracking_suspended(cur, TARGET_TABLE):
+            cur.execute(MERGE_SQL)
+            inserted = cur.rowcount
+    else:
+        cur.execute(MERGE_SQL)
+        inserted = cur.rowcount
+    return inserted, queued
+
+
+def import_history(paths, min_ms_played=0):
+    files = find_export_files(paths)
+    if not files:
+        log_event(JOB_NAME, f"No export files found in {paths}", level="warning")
+        return 0
+
+    start = time.time()
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute(STAGING_DDL)
+        cur.execute(PENDING_DDL)
+        cur.execute(f"TRUNCATE {STAGING_TABLE}")
+
+        total_entries = total_staged = 0
+        for path in files:
+            entries, staged = stage_file(cur, path, min_ms_played)
+            total_entries += entries
+            total_staged += staged
+            print(f"📥 {os.path.basename(path)}: {staged} of {entries} entries staged")
+
+        inserted, queued = merge_staged(cur, total_staged)
+        cur.execute(f"TRUNCATE {STAGING_TABLE}")
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        log_event(JOB_NAME, f"❌ Import failed: {e}", level="error")
+        raise
+    finally:
+        cur.close()
+        conn.close()
+
+    log_event(JOB_NAME, f"✅ Imported {inserted} new plays from {len(files)} file(s) "
+                        f"({total_staged} staged of {total_entries} entries, {queued} new track ids queued for "
+                        f"enrichment) in {time.time() - start:.1f}s")
+    return inserted
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Import Spotify Extended Streaming History JSON into spotify_play_history")
+    ap.add_argument("paths", nargs="+", help="Export files or directories containing Streaming_History_Audio_*.json")
+    ap.add_argument("--min-ms-played", type=int, default=0, help="Skip plays shorter than this many ms (default 0)")
+    return ap.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    import_history(args.paths, min_ms_played=args.min_ms_played)
@@ -0,0 +1,51 @@
+import os
+import sys
+from datetime import datetime
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from utils.logger import log_event
+from utils.db_utils import get_db_connection
+from utils.play_partitions import (
+    PLAY_TABLES, DETACH_AFTER_MONTHS, add_months, month_start,
+    ensure_play_partitions, detach_partitions_before, is_partitioned,
+)
+
+JOB_NAME = "maintain_play_partitions"
+
+
+def run(context=None):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        # ─────────────────────────────────────────────
+        # Upcoming months, so new plays never land in DEFAULT
+        # ─────────────────────────────────────────────
+        created = ensure_play_partitions(cur)
+        if created:
+            log_event(JOB_NAME, f"🗓️ Created {len(created)} partition(s): {', '.join(created)}")
+
+        # ─────────────────────────────────────────────
+        # Optional archival of old months
+        # ─────────────────────────────────────────────
+        if DETACH_AFTER_MONTHS > 0:
+            cutoff = add_months(month_start(datetime.utcnow()), -DETACH_AFTER_MONTHS)
+            for table in PLAY_TABLES:
+                if not is_partitioned(cur, table):
+                    continue
+                detached = detach_partitions_before(cur, table, cutoff)
+                if detached:
+                    log_event(JOB_NAME, f"📦 Detached {len(detached)} {table} partition(s) before {cutoff:%Y-%m}: "
+                                        f"{', '.join(detached)}")
+        conn.commit()
+        log_event(JOB_NAME, "✅ Play partitions are up to date")
+    except Exception as e:
+        conn.rollback()
+        log_event(JOB_NAME, f"❌ Partition maintenance failed: {e}", level="error")
+        raise
+    finally:
+        cur.close()
+        conn.close()
+
+
+if __name__ == "__main__":
+    run()
@@ -21,7 +21,7 @@ CREATE TABLE IF NOT EXISTS daily_metrics_cache (
 );
 """
 
-if __name__ == "__main__":
+def run(context=None):
     log_event("materialize_metrics", "🟡 Starting metrics materialization...")
     conn = get_db_connection()
     cur = conn.cursor()
@@ -45,4 +45,8 @@ if __name__ == "__main__":
     conn.commit()
     cur.close()
     conn.close()
-    log_event("materialize_metrics", "✅ Daily metrics cached successfully.")
\ No newline at end of file
+    log_event("materialize_metrics", "✅ Daily metrics cached successfully.")
+
+
+if __name__ == "__main__":
+    run()
@@ -205,5 +205,9 @@ def build_unified_plays_mv():
         conn.close()
 
 
-if __name__ == "__main__":
+def run(context=None):
     build_unified_plays_mv()
+
+
+if __name__ == "__main__":
+    run()
@@ -1,39 +1,151 @@
+"""materialized_views.py
+
+Builds and maintains the `unified_tracks` table (one row per canonical track
+across the library, liked tracks and play history, with play statistics).
+
+Usage:
+  python api_syncs/materialized_views.py          # incremental (default)
+  python api_syncs/materialized_views.py --full   # rebuild from scratch
+
+How incremental maintenance works:
+- Statement-level triggers on every source table (plays, history, tracks,
+  liked_tracks, albums, artists, availability, exclusions) record what
+  changed in `unified_tracks_dirty` (track ids, album ids, artist ids and
+  lower-cased name/artist keys used by fuzzy matching).
+- An incremental run expands those keys into the set of canonical track ids
+  whose row could have changed, recomputes just those rows with the same
+  query the full build uses, and swaps them in within one transaction.
+- Skip/resume classification is persisted per play in `play_behavior`
+  (with per-track totals in `play_behavior_counts`). The play-table triggers
+  queue each changed play; a run reclassifies only those plays, the play
+  just before each one and the next play of the same track, and adjusts the
+  totals by the difference. The triggers also mark the track of the play
+  just before a new one, so its unified_tracks row picks up new counts.
+- Changes to track_id_equivalents, TRUNCATEs, missing triggers or a very
+  large change set fall back to a full rebuild. A full rebuild builds a new
+  table next to the live one and swaps it in, so readers never see the table
+  missing.
+"""
 import os
+import sys
+import time
+import argparse
+from contextlib import contextmanager
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from utils.logger import log_event
 from utils.db_utils import get_db_connection
+from utils.match_keys import ensure_match_keys, fuzzy_match_sql
 
-UNIFIED_TRACKS_VIEW = """
-DROP MATERIALIZED VIEW IF EXISTS unified_tracks;
+JOB_NAME = "build_unified_tracks"
+TABLE_NAME = "unified_tracks"
+BUILD_TABLE_NAME = "unified_tracks_build"
+# Above this many affected tracks an incremental run just rebuilds everything
+MAX_INCREMENTAL_SCOPE = int(os.getenv("UNIFIED_TRACKS_MAX_INCREMENTAL_SCOPE", "25000"))
+# Serializes builders (full and incremental) across processes
+BUILD_LOCK_KEY = 73210401
+# Optional columnar snapshot for in-process rule evaluation (playlists/columnar_tracks.py)
+COLUMNAR_TRACKS_PATH = os.getenv("COLUMNAR_TRACKS_PATH", "")
 
-CREATE MATERIALIZED VIEW unified_tracks AS
--- Step 0: Use unified_plays_mv (canonicalized track_id via track_id_equivalents)
-WITH all_plays AS (
+PLAY_TABLES = ("plays", "spotify_play_history", "apple_music_play_history")
+PLAY_COLUMNS = ("track_id, track_name, artist_id, artist_name, album_id, album_name, album_type, duration_ms, played_at, "
+                "match_key, duration_bucket")
+
+UNIFIED_TRACKS_INDEXES = {
+    "idx_unified_tracks_track_id": "(track_id)",
+    "idx_unified_tracks_artist": "(artist)",
+    "idx_unified_tracks_artist_id": "(artist_id)",
+    "idx_unified_tracks_album_id": "(album_id)",
+    "idx_unified_tracks_last_played": "(last_played_at)",
+    # accelerates the final ORDER BY for browsing
+    "idx_unified_tracks_browse_order": "(artist, album_id, disc_number, track_number)",
+}
+
+
+# ─────────────────────────────────────────────
+# unified_tracks query (full or scoped to tmp_ut_scope)
+# ─────────────────────────────────────────────
+def _resolved_plays_sql(extra_where=""):
+    """All plays with track ids canonicalized via track_id_equivalents."""
+    union = "\n        UNION ALL\n".join(
+        f"        SELECT '{table}'::text AS source, id AS play_id, {PLAY_COLUMNS} "
+        f"FROM {table} WHERE played_at IS NOT NULL AND track_id IS NOT NULL {extra_where}"
+        for table in PLAY_TABLES
+    )
+    return f"""
     SELECT
-        -- unified_plays_mv has no stable source id; generate a deterministic row id for internal matching
-        ROW_NUMBER() OVER (
-            ORDER BY
-                played_at,
-                track_id,
-                COALESCE(duration_ms, 0),
-                COALESCE(album_id, ''),
-                COALESCE(track_name, ''),
-                COALESCE(artist_name, '')
-        ) AS play_row_id,
-        track_id,
-        track_name,
-        artist_id,
-        artist_name,
-        album_id,
-        album_name,
-        album_type,
-        duration_ms,
-        played_at
-    FROM unified_plays_mv
-    WHERE played_at IS NOT NULL
-      AND track_id IS NOT NULL
+        rp.source,
+        rp.play_id,
+        COALESCE(eq.canonical_track_id, rp.track_id) AS track_id,
+        rp.track_name,
+        rp.artist_id,
+        rp.artist_name,
+        rp.album_id,
+        rp.album_name,
+        rp.album_type,
+        rp.duration_ms,
+        rp.played_at,
+        rp.match_key,
+        rp.duration_bucket
+    FROM (
+{union}
+    ) rp
+    LEFT JOIN track_id_equivalents eq
+      ON eq.alias_track_id = rp.track_id"""
+
+
+def _play_next_sql(scoped):
+    """For every play timestamp: the next (strictly later) play across all sources.
+
+    When several plays share that next timestamp, the smallest canonical
+    track id wins, so full and scoped builds agree.
+    """
+    if not scoped:
+        return """
+play_heads AS (
+    SELECT played_at, MIN(track_id) AS track_id
+    FROM all_plays
+    GROUP BY played_at
 ),
+play_next AS (
+    SELECT
+        played_at,
+        LEAD(track_id) OVER (ORDER BY played_at) AS next_track_id,
+        LEAD(played_at) OVER (ORDER BY played_at) AS next_played
+    FROM play_heads
+),"""
+    firsts = "\n            UNION ALL\n".join(
+        f"            (SELECT played_at FROM {table} WHERE played_at > ts.played_at AND track_id IS NOT NULL "
+        f"ORDER BY played_at LIMIT 1)"
+        for table in PLAY_TABLES
+    )
+    at_next = "\n            UNION ALL\n".join(
+        f"            SELECT track_id FROM {table} WHERE played_at = nx.next_played AND track_id IS NOT NULL"
+        for table in PLAY_TABLES
+    )
+    return f"""
+play_next AS (
+    SELECT ts.played_at, nt.next_track_id, nx.next_played
+    FROM (SELECT DISTINCT played_at FROM all_plays) ts
+    CROSS JOIN LATERAL (
+        SELECT MIN(f.played_at) AS next_played
+        FROM (
+{firsts}
+        ) f
+    ) nx
+    CROSS JOIN LATERAL (
+        SELECT MIN(COALESCE(eq.canonical_track_id, r.track_id)) AS next_track_id
+        FROM (
+{at_next}
+        ) r
+        LEFT JOIN track_id_equivalents eq ON eq.alias_track_id = r.track_id
+    ) nt
+),"""
+
 
--- Step 1a: Canonicalize track IDs for tracks and liked_tracks using track_id_equivalents
+def _library_canon_sql(tracks_scope="", liked_scope=""):
+    """CTEs tracks_canon / liked_tracks_canon: one tracks / liked_tracks row per canonical id."""
+    return f"""-- Step 1a: Canonicalize track IDs for tracks and liked_tracks using track_id_equivalents
 tracks_canon_raw AS (
     SELECT
         t.*,
@@ -41,6 +153,7 @@ tracks_canon_raw AS (
     FROM tracks t
     LEFT JOIN track_id_equivalents eq
       ON eq.alias_track_id = t.id
+    {tracks_scope}
 ),
 tracks_canon AS (
     -- One row per canonical_track_id.
@@ -60,6 +173,7 @@ liked_tracks_canon_raw AS (
     FROM liked_tracks lt
     LEFT JOIN track_id_equivalents eq
       ON eq.alias_track_id = lt.track_id
+    {liked_scope}
 ),
 liked_tracks_canon AS (
     -- One row per canonical_track_id.
@@ -71,9 +185,61 @@ liked_tracks_canon AS (
         canonical_track_id,
         (track_id = canonical_track_id) DESC,
         liked_at DESC NULLS LAST
+),"""
+
+
+def _scoped_sources(scoped):
+    """(all_plays SQL, tracks filter, liked_tracks filter), optionally limited to tmp_ut_scope."""
+    if not scoped:
+        return _resolved_plays_sql(), "", ""
+    all_plays = _resolved_plays_sql("AND track_id IN (SELECT track_id FROM tmp_ut_scope_raw)")
+    all_plays = f"""
+    SELECT * FROM ({all_plays}
+    ) sp
+    WHERE sp.track_id IN (SELECT track_id FROM tmp_ut_scope)"""
+    tracks_scope = "WHERE COALESCE(eq.canonical_track_id, t.id) IN (SELECT track_id FROM tmp_ut_scope)"
+    liked_scope = "WHERE COALESCE(eq.canonical_track_id, lt.track_id) IN (SELECT track_id FROM tmp_ut_scope)"
+    return all_plays, tracks_scope, liked_scope
+
+
+def unified_tracks_select(scoped=False):
+    """SELECT producing unified_tracks rows.
+
+    With ``scoped=True`` only rows for track ids in the temp table
+    ``tmp_ut_scope`` are produced; plays are read by id from
+    ``tmp_ut_scope_raw`` and fuzzy-match candidates by match key from
+    ``tmp_ut_keys``. Skip/resume counts come from ``play_behavior_counts``,
+    which must be refreshed first.
+    """
+    all_plays, tracks_scope, liked_scope = _scoped_sources(scoped)
+    if scoped:
+        fuzzy_source = _resolved_plays_sql(
+            "AND match_key IN (SELECT match_key FROM tmp_ut_keys)"
+        )
+        base_scope = "WHERE ab.track_id IN (SELECT track_id FROM tmp_ut_scope)"
+    else:
+        fuzzy_source = "SELECT * FROM all_plays"
+        base_scope = ""
+
+    return f"""
+-- Step 0: Every play, canonicalized via track_id_equivalents
+WITH all_plays AS ({all_plays}
 ),
 
--- Step 1b: Merge tracks and liked_tracks into a unified base (library source), keyed by canonical track_id
+{_library_canon_sql(tracks_scope, liked_scope)}
+
+-- Step 1b: Every canonical id present in tracks or liked_tracks (never scoped)
+library_ids AS (
+    SELECT COALESCE(eq.canonical_track_id, t.id) AS track_id
+    FROM tracks t
+    LEFT JOIN track_id_equivalents eq ON eq.alias_track_id = t.id
+    UNION
+    SELECT COALESCE(eq.canonical_track_id, lt.track_id)
+    FROM liked_tracks lt
+    LEFT JOIN track_id_equivalents eq ON eq.alias_track_id = lt.track_id
+),
+
+-- Step 1c: Merge tracks and liked_tracks into a unified base (library source), keyed by canonical track_id
 base_tracks AS (
     SELECT
         tc.canonical_track_id AS track_id,
@@ -160,86 +326,45 @@ play_stats AS (
     GROUP BY track_id
 ),
 
--- Step 3: Classify skips and resumes from plays (fallback to plays.duration_ms)
-classified_plays AS (
-    SELECT
-        p.track_id,
-        COALESCE(tc.duration_ms, ltc.duration_ms, p.duration_ms) AS duration_ms,
-        LAG(p.played_at) OVER (PARTITION BY p.track_id ORDER BY p.played_at) AS prev_played,
-        LEAD(p.track_id) OVER (ORDER BY p.played_at) AS next_track_id,
-        LEAD(p.played_at) OVER (ORDER BY p.played_at) AS next_played,
-        CASE
-            WHEN LAG(p.played_at) OVER (PARTITION BY p.track_id ORDER BY p.played_at) IS NOT NULL
-                 AND EXTRACT(EPOCH FROM (p.played_at - LAG(p.played_at) OVER (PARTITION BY p.track_id ORDER BY p.played_at))) * 1000
-                     < COALESCE(tc.duration_ms, ltc.duration_ms, p.duration_ms)
-            THEN TRUE ELSE FALSE
-        END AS is_resume,
-        CASE
-            WHEN LEAD(p.track_id) OVER (ORDER BY p.played_at) IS NOT NULL
-                 AND LEAD(p.track_id) OVER (ORDER BY p.played_at) != p.track_id
-                 AND EXTRACT(EPOCH FROM (LEAD(p.played_at) OVER (ORDER BY p.played_at) - p.played_at)) * 1000
-                     < (COALESCE(tc.duration_ms, ltc.duration_ms, p.duration_ms) * 0.3)
-            THEN TRUE ELSE FALSE
-        END AS is_skipped
-    FROM all_plays p
-    LEFT JOIN tracks_canon tc ON tc.canonical_track_id = p.track_id
-    LEFT JOIN liked_tracks_canon ltc ON ltc.canonical_track_id = p.track_id
-),
-
--- Step 4: Aggregate resume/skip counts
-play_behavior_stats AS (
-    SELECT
-        track_id,
-        COUNT(*) FILTER (WHERE is_resume) AS resume_play_count,
-        COUNT(*) FILTER (WHERE is_skipped) AS skip_play_count
-    FROM classified_plays
-    GROUP BY track_id
-),
-
 -- Step 5: Narrow to fuzzy candidates (no exact id in library/liked)
 fuzzy_candidates AS (
-  SELECT p.*
-  FROM all_plays p
-  LEFT JOIN tracks_canon tc  ON tc.canonical_track_id = p.track_id
-  LEFT JOIN liked_tracks_canon ltc ON ltc.canonical_track_id = p.track_id
-  WHERE p.track_id IS NOT NULL
-    AND tc.id IS NULL
-    AND ltc.track_id IS NULL
+    SELECT p.*
+    FROM ({fuzzy_source}) p
+    WHERE NOT EXISTS (SELECT 1 FROM library_ids l WHERE l.track_id = p.track_id)
 ),
 
 -- Step 6: Fuzzy match only those candidates
 fuzzy_matched_tracks AS (
-  SELECT 
-    c.play_row_id AS play_id,
-    t.id        AS matched_track_id,
-    c.played_at AS fuzzy_played_at
-  FROM fuzzy_candidates c
-  JOIN tracks t
-    ON LOWER(c.track_name) = LOWER(t.name)
-   AND LOWER(c.artist_name) = LOWER(t.artist)
-   AND ABS(COALESCE(c.duration_ms, 0) - COALESCE(t.duration_ms, 0)) <= 1000
+    SELECT
+        t.id        AS matched_track_id,
+        c.played_at AS fuzzy_played_at
+    FROM fuzzy_candidates c
+    JOIN tracks t
+      ON {fuzzy_match_sql("c", "t")}
 ),
 
 -- Step 7: Aggregate fuzzy match stats
 fuzzy_play_stats AS (
-  SELECT
-    matched_track_id AS track_id,
-    COUNT(*) AS fuzz_play_count,
-    MIN(fuzzy_played_at) AS fuzz_play_count_first_played,
-    MAX(fuzzy_played_at) AS fuzz_play_count_last_played
-  FROM fuzzy_matched_tracks
-  GROUP BY matched_track_id
+    SELECT
+        matched_track_id AS track_id,
+        COUNT(*) AS fuzz_play_count,
+        MIN(fuzzy_played_at) AS fuzz_play_count_first_played,
+        MAX(fuzzy_played_at) AS fuzz_play_count_last_played
+    FROM fuzzy_matched_tracks
+    GROUP BY matched_track_id
 ),
 
--- Step 8: Identify non-library track_ids from plays not in library/liked AND not used by a fuzzy match play
+-- Step 8: Identify non-library track_ids with at least one play that is not in library/liked
+-- and not claimed by a fuzzy match
 non_library_candidates AS (
     SELECT
         p.track_id
     FROM all_plays p
-    WHERE p.track_id IS NOT NULL
-      AND NOT EXISTS (SELECT 1 FROM tracks_canon tc WHERE tc.canonical_track_id = p.track_id)
-      AND NOT EXISTS (SELECT 1 FROM liked_tracks_canon ltc WHERE ltc.canonical_track_id = p.track_id)
-      AND NOT EXISTS (SELECT 1 FROM fuzzy_matched_tracks fmt WHERE fmt.play_id = p.play_row_id)
+    WHERE NOT EXISTS (SELECT 1 FROM library_ids l WHERE l.track_id = p.track_id)
+      AND NOT EXISTS (
+          SELECT 1 FROM tracks t
+          WHERE {fuzzy_match_sql("p", "t")}
+      )
     GROUP BY p.track_id
 ),
 
@@ -248,7 +373,6 @@ latest_play_per_track AS (
     SELECT DISTINCT ON (p.track_id)
         p.*
     FROM all_plays p
-    WHERE p.track_id IS NOT NULL
     ORDER BY p.track_id, p.played_at DESC
 ),
 
@@ -284,7 +408,6 @@ non_library_base AS (
     JOIN latest_play_per_track p ON p.track_id = c.track_id
     LEFT JOIN artists ar2 ON ar2.id = p.artist_id
     LEFT JOIN albums  a2  ON a2.id = p.album_id
-    LEFT JOIN track_availability ta ON ta.track_id = p.track_id
 ),
 
 -- Step 11: Combine library and non-library rows before stats joins
@@ -352,7 +475,7 @@ SELECT
 
 FROM all_base ab
 LEFT JOIN play_stats ps ON ps.track_id = ab.track_id
-LEFT JOIN play_behavior_stats pb ON pb.track_id = ab.track_id
+LEFT JOIN play_behavior_counts pb ON pb.track_id = ab.track_id
 LEFT JOIN fuzzy_play_stats fp ON fp.track_id = ab.track_id
 CROSS JOIN LATERAL (
     SELECT
@@ -375,47 +498,466 @@ CROSS JOIN LATERAL (
             'infinity'::timestamptz
         ) AS earliest_added_at
 ) AS combined_dates
-;
+{base_scope}
 """
 
-if __name__ == "__main__":
-    log_event("build_unified_tracks", "Starting unified_tracks materialized view build...")
-    conn = get_db_connection()
-    cur = conn.cursor()
-    # Force drop and recreate the materialized view each run
-    cur.execute("DROP MATERIALIZED VIEW IF EXISTS unified_tracks;")
-    cur.execute(UNIFIED_TRACKS_VIEW)
-    conn.commit()
-    log_event("build_unified_tracks", "Recreated unified_tracks MV.")
 
-    # Ensure helpful indexes exist on the materialized view
-    cur.execute(
-        """
-        CREATE INDEX IF NOT EXISTS idx_unified_tracks_track_id     ON unified_tracks(track_id);
-        CREATE INDEX IF NOT EXISTS idx_unified_tracks_artist       ON unified_tracks(artist);
-        CREATE INDEX IF NOT EXISTS idx_unified_tracks_album_id     ON unified_tracks(album_id);
-        CREATE INDEX IF NOT EXISTS idx_unified_tracks_last_played  ON unified_tracks(last_played_at);
-        -- accelerates the final ORDER BY for browsing
-        CREATE INDEX IF NOT EXISTS idx_unified_tracks_browse_order ON unified_tracks(artist, album_id, disc_number, track_number);
-        """
+# ─────────────────────────────────────────────
+# play_behavior: persisted skip/resume classification per play
+# ─────────────────────────────────────────────
+PLAY_BEHAVIOR_DDL = """
+CREATE TABLE IF NOT EXISTS play_behavior (
+    source TEXT NOT NULL,
+    play_id INTEGER NOT NULL,
+    track_id TEXT NOT NULL,
+    played_at TIMESTAMP NOT NULL,
+    duration_ms INTEGER,
+    prev_played TIMESTAMP,
+    next_track_id TEXT,
+    next_played TIMESTAMP,
+    is_resume BOOLEAN NOT NULL,
+    is_skip BOOLEAN NOT NULL,
+    classified_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (source, play_id)
+);
+CREATE INDEX IF NOT EXISTS idx_play_behavior_track ON play_behavior (track_id, played_at);
+CREATE INDEX IF NOT EXISTS idx_play_behavior_played_at ON play_behavior (played_at);
+-- tracks/liked_tracks duration the row was classified with; a change reclassifies the track
+ALTER TABLE play_behavior ADD COLUMN IF NOT EXISTS library_duration_ms INTEGER;
+
+CREATE TABLE IF NOT EXISTS play_behavior_counts (
+    track_id TEXT PRIMARY KEY,
+    resume_play_count INTEGER NOT NULL,
+    skip_play_count INTEGER NOT NULL
+);
+"""
+PLAY_BEHAVIOR_COLUMNS = ("source, play_id, track_id, played_at, duration_ms, prev_played, "
+                         "next_track_id, next_played, is_resume, is_skip, library_duration_ms")
+
+
+def _earlier_play_sql():
+    """Latest play of ``p.track_id`` (any alias, any source) strictly before ``p.played_at``."""
+    aliases = "SELECT p.track_id UNION ALL SELECT alias_track_id FROM track_id_equivalents WHERE canonical_track_id = p.track_id"
+    earlier = "\n                UNION ALL\n".join(
+        f"                SELECT MAX(played_at) FROM {table} WHERE track_id IN ({aliases}) AND played_at < p.played_at"
+        for table in PLAY_TABLES
     )
-    conn.commit()
+    return f"""(
+            SELECT MAX(e.played_at) FROM (
+{earlier}
+            ) e(played_at)
+        )"""
+
+
+def play_behavior_select(scoped=False):
+    """SELECT classifying every play (only the plays at the timestamps in ``tmp_pb_targets`` when scoped).
+
+    - resume: the previous play of the same track started less than one
+      track length earlier (duration from tracks/liked_tracks, else the play).
+    - skip: the next play (across all sources) is a different track and
+      started within 30% of this track's length.
+    """
+    if scoped:
+        all_plays = _resolved_plays_sql("AND played_at IN (SELECT played_at FROM tmp_pb_targets)")
+        tracks_scope = "WHERE COALESCE(eq.canonical_track_id, t.id) IN (SELECT track_id FROM all_plays)"
+        liked_scope = "WHERE COALESCE(eq.canonical_track_id, lt.track_id) IN (SELECT track_id FROM all_plays)"
+        # Every play at a target timestamp is selected, so ties at that timestamp resolve here;
+        # otherwise the predecessor is looked up in the play tables
+        prev_played = (f"COALESCE(\n"
+                       f"            LAG(p.played_at) OVER (PARTITION BY p.track_id, p.played_at ORDER BY p.source, p.play_id),\n"
+                       f"            {_earlier_play_sql()}\n"
+                       f"        )")
+    else:
+        all_plays, tracks_scope, liked_scope = _resolved_plays_sql(), "", ""
+        prev_played = "LAG(p.played_at) OVER (PARTITION BY p.track_id ORDER BY p.played_at, p.source, p.play_id)"
+    return f"""
+WITH all_plays AS ({all_plays}
+),
+
+{_library_canon_sql(tracks_scope, liked_scope)}
+
+{_play_next_sql(scoped)}
+ordered_plays AS (
+    SELECT
+        p.source,
+        p.play_id,
+        p.track_id,
+        p.played_at,
+        COALESCE(tc.duration_ms, ltc.duration_ms, p.duration_ms) AS duration_ms,
+        COALESCE(tc.duration_ms, ltc.duration_ms) AS library_duration_ms,
+        {prev_played} AS prev_played
+    FROM all_plays p
+    LEFT JOIN tracks_canon tc ON tc.canonical_track_id = p.track_id
+    LEFT JOIN liked_tracks_canon ltc ON ltc.canonical_track_id = p.track_id
+)
+SELECT
+    p.source,
+    p.play_id,
+    p.track_id,
+    p.played_at,
+    p.duration_ms,
+    p.prev_played,
+    n.next_track_id,
+    n.next_played,
+    CASE
+        WHEN p.prev_played IS NOT NULL
+             AND EXTRACT(EPOCH FROM (p.played_at - p.prev_played)) * 1000 < p.duration_ms
+        THEN TRUE ELSE FALSE
+    END AS is_resume,
+    CASE
+        WHEN n.next_track_id IS NOT NULL
+             AND n.next_track_id != p.track_id
+             AND EXTRACT(EPOCH FROM (n.next_played - p.played_at)) * 1000 < (p.duration_ms * 0.3)
+        THEN TRUE ELSE FALSE
+    END AS is_skip,
+    p.library_duration_ms
+FROM ordered_plays p
+LEFT JOIN play_next n ON n.played_at = p.played_at
+"""
+
+
+def _play_targets_sql():
+    """Statements filling ``tmp_pb_targets`` with the play timestamps a scoped run reclassifies."""
+    _, tracks_scope, liked_scope = _scoped_sources(True)
+    return f"""
+        -- Changed plays (inserted, updated or deleted), queued by the play-table triggers
+        INSERT INTO tmp_pb_targets (played_at)
+        SELECT DISTINCT key::timestamp FROM tmp_ut_dirty WHERE kind = 'play'
+        ON CONFLICT DO NOTHING;
+
+        -- The play just before each one: its next play may have changed (skip)
+        INSERT INTO tmp_pb_targets (played_at)
+        SELECT prev.played_at
+        FROM (SELECT DISTINCT key::timestamp AS played_at FROM tmp_ut_dirty WHERE kind = 'play') c
+        CROSS JOIN LATERAL (
+            SELECT MAX(pb.played_at) AS played_at FROM play_behavior pb WHERE pb.played_at < c.played_at
+        ) prev
+        WHERE prev.played_at IS NOT NULL
+        ON CONFLICT DO NOTHING;
+
+        -- The next play of the same track: its previous play may have changed (resume)
+        INSERT INTO tmp_pb_targets (played_at)
+        SELECT nxt.played_at
+        FROM (
+            SELECT DISTINCT d.key::timestamp AS played_at, COALESCE(eq.canonical_track_id, d.key2) AS track_id
+            FROM tmp_ut_dirty d
+            LEFT JOIN track_id_equivalents eq ON eq.alias_track_id = d.key2
+            WHERE d.kind = 'play' AND d.key2 <> ''
+        ) c
+        CROSS JOIN LATERAL (
+            SELECT MIN(pb.played_at) AS played_at FROM play_behavior pb
+            WHERE pb.track_id = c.track_id AND pb.played_at > c.played_at
+        ) nxt
+        WHERE nxt.played_at IS NOT NULL
+        ON CONFLICT DO NOTHING;
 
-    # Ensure helpful indexes exist on source tables used by the view
+        -- Every play of a track whose tracks/liked_tracks duration changed
+        WITH {_library_canon_sql(tracks_scope, liked_scope)}
+        library AS (
+            SELECT COALESCE(tc.canonical_track_id, ltc.canonical_track_id) AS track_id,
+                   COALESCE(tc.duration_ms, ltc.duration_ms) AS duration_ms
+            FROM tracks_canon tc
+            FULL JOIN liked_tracks_canon ltc ON ltc.canonical_track_id = tc.canonical_track_id
+        )
+        INSERT INTO tmp_pb_targets (played_at)
+        SELECT DISTINCT pb.played_at
+        FROM play_behavior pb
+        JOIN tmp_ut_scope s ON s.track_id = pb.track_id
+        LEFT JOIN library l ON l.track_id = pb.track_id
+        WHERE pb.library_duration_ms IS DISTINCT FROM l.duration_ms
+        ON CONFLICT DO NOTHING;
+    """
+
+
+def refresh_play_behavior(cur, scoped):
+    """Classify plays and keep per-track skip/resume counts.
+
+    Full runs redo everything. Scoped runs reclassify only the plays at the
+    timestamps that can have changed: each changed play (queued by the
+    play-table triggers), the play just before it, the next play of the same
+    track and, when a track's library duration changed, all of that track's
+    plays. Counts are adjusted by the difference instead of recounted.
+    """
+    if not scoped:
+        cur.execute("TRUNCATE play_behavior, play_behavior_counts")
+        cur.execute(f"INSERT INTO play_behavior ({PLAY_BEHAVIOR_COLUMNS}) {play_behavior_select()}")
+        cur.execute("""
+            INSERT INTO play_behavior_counts (track_id, resume_play_count, skip_play_count)
+            SELECT track_id, COUNT(*) FILTER (WHERE is_resume), COUNT(*) FILTER (WHERE is_skip)
+            FROM play_behavior
+            GROUP BY track_id
+        """)
+        return
+
+    cur.execute("""
+        CREATE TEMP TABLE tmp_pb_targets (played_at TIMESTAMP PRIMARY KEY) ON COMMIT DROP;
+        CREATE TEMP TABLE tmp_pb_delta (track_id TEXT NOT NULL, resumes INTEGER NOT NULL, skips INTEGER NOT NULL)
+            ON COMMIT DROP;
+    """)
+    cur.execute(_play_targets_sql())
+    cur.execute("ANALYZE tmp_pb_targets")
+
+    cur.execute("""
+        WITH removed AS (
+            DELETE FROM play_behavior WHERE played_at IN (SELECT played_at FROM tmp_pb_targets)
+            RETURNING track_id, is_resume, is_skip
+        )
+        INSERT INTO tmp_pb_delta (track_id, resumes, skips)
+        SELECT track_id, -COUNT(*) FILTER (WHERE is_resume), -COUNT(*) FILTER (WHERE is_skip)
+        FROM removed
+        GROUP BY track_id
+    """)
+    cur.execute(f"""
+        WITH added AS (
+            INSERT INTO play_behavior ({PLAY_BEHAVIOR_COLUMNS}) {play_behavior_select(scoped=True)}
+            RETURNING track_id, is_resume, is_skip
+        )
+        INSERT INTO tmp_pb_delta (track_id, resumes, skips)
+        SELECT track_id, COUNT(*) FILTER (WHERE is_resume), COUNT(*) FILTER (WHERE is_skip)
+        FROM added
+        GROUP BY track_id
+    """)
+
+    cur.execute("""
+        INSERT INTO play_behavior_counts AS c (track_id, resume_play_count, skip_play_count)
+        SELECT track_id, SUM(resumes), SUM(skips) FROM tmp_pb_delta GROUP BY track_id
+        ON CONFLICT (track_id) DO UPDATE SET
+            resume_play_count = c.resume_play_count + EXCLUDED.resume_play_count,
+            skip_play_count = c.skip_play_count + EXCLUDED.skip_play_count
+    """)
+    # Like a full run, only tracks that still have plays keep a counts row
+    cur.execute("""
+        DELETE FROM play_behavior_counts c
+        WHERE c.track_id IN (SELECT track_id FROM tmp_pb_delta)
+          AND NOT EXISTS (SELECT 1 FROM play_behavior pb WHERE pb.track_id = c.track_id)
+    """)
+
+
+def ensure_play_behavior(cur):
+    """Create the play_behavior tables; returns True if they did not exist yet."""
+    cur.execute("SELECT to_regclass('play_behavior') IS NULL")
+    created = cur.fetchone()[0]
+    cur.execute(PLAY_BEHAVIOR_DDL)
+    return created
+
+
+# ─────────────────────────────────────────────
+# Change tracking (dirty queue + triggers)
+# ─────────────────────────────────────────────
+# table -> (kind, key column[, name column, artist column[, played_at column]])
+DIRTY_SOURCES = {
+    "tracks": ("track", "id", "name", "artist"),
+    "liked_tracks": ("track", "track_id"),
+    "track_availability": ("track", "track_id"),
+    "excluded_tracks": ("track", "track_id"),
+    "albums": ("album", "id"),
+    "artists": ("artist", "id"),
+    "plays": ("track", "track_id", "track_name", "artist_name", "played_at"),
+    "spotify_play_history": ("track", "track_id", "track_name", "artist_name", "played_at"),
+    "apple_music_play_history": ("track", "track_id", "track_name", "artist_name", "played_at"),
+}
+# Any change here can re-key many rows at once; just rebuild
+FULL_REBUILD_SOURCES = ("track_id_equivalents",)
+
+
+def _previous_play_sql(changed):
+    """Track ids of the play(s) immediately before each changed play timestamp."""
+    prev_max = "\n            UNION ALL\n".join(
+        f"            (SELECT played_at FROM {table} WHERE played_at < c.played_at AND track_id IS NOT NULL "
+        f"ORDER BY played_at DESC LIMIT 1)"
+        for table in PLAY_TABLES
+    )
+    prev_rows = "\n            UNION ALL\n".join(
+        f"            SELECT track_id FROM {table} WHERE played_at = pp.played_at AND track_id IS NOT NULL"
+        for table in PLAY_TABLES
+    )
+    return f"""
+        SELECT DISTINCT 'track', prev.track_id
+        FROM (SELECT DISTINCT played_at FROM ({changed}) ch WHERE played_at IS NOT NULL) c
+        CROSS JOIN LATERAL (
+            SELECT MAX(x.played_at) AS played_at
+            FROM (
+{prev_max}
+            ) x
+        ) pp
+        CROSS JOIN LATERAL (
+{prev_rows}
+        ) prev"""
+
+
+DIRTY_DDL = """
+CREATE TABLE IF NOT EXISTS unified_tracks_dirty (
+    kind TEXT NOT NULL,          -- track | album | artist | name | play | full
+    key TEXT NOT NULL,
+    key2 TEXT NOT NULL DEFAULT '',
+    queued_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (kind, key, key2)
+);
+
+-- TG_ARGV: kind, key column [, name column, artist column [, played_at column]]
+CREATE OR REPLACE FUNCTION unified_tracks_mark_dirty() RETURNS trigger
+LANGUAGE plpgsql AS $fn$
+DECLARE
+    changed TEXT;
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        changed := 'SELECT * FROM new_rows';
+    ELSIF TG_OP = 'DELETE' THEN
+        changed := 'SELECT * FROM old_rows';
+    ELSE
+        -- Rows an UPDATE left untouched (e.g. no-op upserts) don't need a rebuild
+        changed := '(SELECT * FROM new_rows EXCEPT SELECT * FROM old_rows) '
+                   'UNION ALL (SELECT * FROM old_rows EXCEPT SELECT * FROM new_rows)';
+    END IF;
+
+    EXECUTE format(
+        'INSERT INTO unified_tracks_dirty (kind, key)
+         SELECT DISTINCT %L, c.%I::text FROM (%s) c WHERE c.%I IS NOT NULL
+         ON CONFLICT DO NOTHING',
+        TG_ARGV[0], TG_ARGV[1], changed, TG_ARGV[1]);
+
+    IF TG_NARGS > 3 THEN
+        EXECUTE format(
+            'INSERT INTO unified_tracks_dirty (kind, key, key2)
+             SELECT DISTINCT ''name'', LOWER(c.%I), LOWER(c.%I) FROM (%s) c
+             WHERE c.%I IS NOT NULL AND c.%I IS NOT NULL
+             ON CONFLICT DO NOTHING',
+            TG_ARGV[2], TG_ARGV[3], changed, TG_ARGV[2], TG_ARGV[3]);
+    END IF;
+
+    IF TG_NARGS > 4 THEN
+        -- The changed plays themselves, so play_behavior reclassifies just them and their neighbours
+        EXECUTE format(
+            'INSERT INTO unified_tracks_dirty (kind, key, key2)
+             SELECT DISTINCT ''play'', c.%I::text, COALESCE(c.%I, '''') FROM (%s) c WHERE c.%I IS NOT NULL
+             ON CONFLICT DO NOTHING',
+            TG_ARGV[4], TG_ARGV[1], changed, TG_ARGV[4]);
+
+        -- A new/removed play changes which play follows its predecessor (skip detection)
+        EXECUTE format(
+            'INSERT INTO unified_tracks_dirty (kind, key) ' || $nb$__PREVIOUS_PLAY_SQL__$nb$ ||
+            ' ON CONFLICT DO NOTHING',
+            changed);
+    END IF;
+
+    RETURN NULL;
+END
+$fn$;
+
+CREATE OR REPLACE FUNCTION unified_tracks_mark_full() RETURNS trigger
+LANGUAGE plpgsql AS $fn$
+BEGIN
+    INSERT INTO unified_tracks_dirty (kind, key) VALUES ('full', TG_TABLE_NAME)
+    ON CONFLICT DO NOTHING;
+    RETURN NULL;
+END
+$fn$;
+"""
+
+
+def _install_trigger(cur, installed, table, name, ddl):
+    """Create trigger ``name`` on ``table`` unless an identical one exists. Returns True if it was absent.
+
+    DROP/CREATE TRIGGER take ACCESS EXCLUSIVE (cascading to every partition),
+    so triggers that are already in place are left alone; only one whose
+    function call changed (after an upgrade) is replaced.
+    """
+    current = installed.get((table, name))
+    call = ddl.split("EXECUTE FUNCTION", 1)[1].strip()
+    if current is not None and current.endswith(call):
+        return False
+    if current is not None:
+        cur.execute(f"DROP TRIGGER {name} ON {table}")
+    cur.execute(ddl)
+    return current is None
+
+
+def ensure_change_tracking(cur):
+    """Create the dirty queue and install missing triggers. Returns True if any trigger was missing."""
+    # format() fills the %s with the changed-rows query at trigger time
+    cur.execute(DIRTY_DDL.replace("__PREVIOUS_PLAY_SQL__", _previous_play_sql("%s")))
+
+    tables = list(DIRTY_SOURCES) + list(FULL_REBUILD_SOURCES)
+    cur.execute("""
+        SELECT c.relname, t.tgname, pg_get_triggerdef(t.oid)
+        FROM pg_trigger t
+        JOIN pg_class c ON c.oid = t.tgrelid
+        WHERE NOT t.tgisinternal AND t.tgname LIKE 'unified_tracks_dirty%%'
+          AND c.relnamespace = current_schema()::regnamespace AND c.relname = ANY(%s)
+    """, (tables,))
+    installed = {(table, name): definition for table, name, definition in cur.fetchall()}
+
+    missing = False
+    for table, args in DIRTY_SOURCES.items():
+        arg_list = ", ".join(f"'{a}'" for a in args)
+        for suffix, event, referencing in (
+            ("ins", "INSERT", "REFERENCING NEW TABLE AS new_rows"),
+            ("upd", "UPDATE", "REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows"),
+            ("del", "DELETE", "REFERENCING OLD TABLE AS old_rows"),
+        ):
+            missing |= _install_trigger(cur, installed, table, f"unified_tracks_dirty_{suffix}", f"""
+                CREATE TRIGGER unified_tracks_dirty_{suffix}
+                AFTER {event} ON {table}
+                {referencing}
+                FOR EACH STATEMENT EXECUTE FUNCTION unified_tracks_mark_dirty({arg_list})
+            """)
+
+    for table in tables:
+        events = "INSERT OR UPDATE OR DELETE OR TRUNCATE" if table in FULL_REBUILD_SOURCES else "TRUNCATE"
+        missing |= _install_trigger(cur, installed, table, "unified_tracks_dirty_full", f"""
+            CREATE TRIGGER unified_tracks_dirty_full
+            AFTER {events} ON {table}
+            FOR EACH STATEMENT EXECUTE FUNCTION unified_tracks_mark_full()
+        """)
+
+    return missing
+
+
+@contextmanager
+def change_tracking_suspended(cur, table):
+    """Bulk loads: skip the per-statement dirty tracking on ``table`` and
+    queue a full rebuild instead, which is cheaper than expanding a huge
+    transition table. Use within one transaction; DISABLE TRIGGER is
+    transactional, so a failed load leaves the triggers enabled.
+    """
+    cur.execute("""
+        SELECT tgname FROM pg_trigger
+        WHERE tgrelid = %s::regclass AND NOT tgisinternal
+          AND tgname LIKE 'unified_tracks_dirty%%' AND tgname <> 'unified_tracks_dirty_full'
+    """, (table,))
+    triggers = [row[0] for row in cur.fetchall()]
+    for trigger in triggers:
+        cur.execute(f"ALTER TABLE {table} DISABLE TRIGGER {trigger}")
+    yield
+    for trigger in triggers:
+        cur.execute(f"ALTER TABLE {table} ENABLE TRIGGER {trigger}")
+    if triggers:
+        cur.execute("INSERT INTO unified_tracks_dirty (kind, key) VALUES ('full', %s) ON CONFLICT DO NOTHING", (table,))
+
+
+# ─────────────────────────────────────────────
+# Indexes
+# ─────────────────────────────────────────────
+def ensure_source_indexes(cur):
+    """Ensure helpful indexes exist on source tables used by unified_tracks."""
+    ensure_match_keys(cur)
     cur.execute(
         """
         -- Plays & history: speed grouping/windowing and candidate scans
-        CREATE INDEX IF NOT EXISTS idx_unified_plays_track_time ON unified_plays_mv(track_id, played_at);
-        CREATE INDEX IF NOT EXISTS idx_unified_plays_name_artist_lower ON unified_plays_mv(LOWER(track_name), LOWER(artist_name));
         CREATE INDEX IF NOT EXISTS idx_plays_track_time        ON plays(track_id, played_at);
         CREATE INDEX IF NOT EXISTS idx_hist_track_time         ON spotify_play_history(track_id, played_at);
         CREATE INDEX IF NOT EXISTS idx_amph_track_time         ON apple_music_play_history(track_id, played_at);
 
-        -- Functional indexes for fuzzy matching
-        CREATE INDEX IF NOT EXISTS idx_plays_name_artist_lower ON plays(LOWER(track_name), LOWER(artist_name));
-        CREATE INDEX IF NOT EXISTS idx_hist_name_artist_lower  ON spotify_play_history(LOWER(track_name), LOWER(artist_name));
-        CREATE INDEX IF NOT EXISTS idx_amph_name_artist_lower  ON apple_music_play_history(LOWER(track_name), LOWER(artist_name));
-        CREATE INDEX IF NOT EXISTS idx_tracks_name_artist_lower ON tracks(LOWER(name), LOWER(artist));
+        -- Next/previous play lookups for incremental skip detection
+        CREATE INDEX IF NOT EXISTS idx_plays_played_at         ON plays(played_at);
+        CREATE INDEX IF NOT EXISTS idx_hist_played_at          ON spotify_play_history(played_at);
+        CREATE INDEX IF NOT EXISTS idx_amph_played_at          ON apple_music_play_history(played_at);
+
+        -- Superseded by the persisted match_key indexes (utils/match_keys.py)
+        DROP INDEX IF EXISTS idx_plays_name_artist_lower;
+        DROP INDEX IF EXISTS idx_hist_name_artist_lower;
+        DROP INDEX IF EXISTS idx_amph_name_artist_lower;
+        DROP INDEX IF EXISTS idx_tracks_name_artist_lower;
 
         -- Common FK/lookup helpers
         CREATE INDEX IF NOT EXISTS idx_tracks_album            ON tracks(album_id);
@@ -423,12 +965,278 @@ if __name__ == "__main__":
         CREATE INDEX IF NOT EXISTS idx_albums_id               ON albums(id);
         CREATE INDEX IF NOT EXISTS idx_artists_id              ON artists(id);
         CREATE INDEX IF NOT EXISTS idx_availability_track      ON track_availability(track_id);
+        CREATE INDEX IF NOT EXISTS idx_equivalents_canonical   ON track_id_equivalents(canonical_track_id);
         """
     )
+
+
+def _relkind(cur, name):
+    cur.execute("""
+        SELECT c.relkind FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = current_schema() AND c.relname = %s
+    """, (name,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+# ─────────────────────────────────────────────
+# Full rebuild
+# ─────────────────────────────────────────────
+def full_rebuild(conn):
+    cur = conn.cursor()
+    # Claim everything queued so far; this build covers it
+    cur.execute("DELETE FROM unified_tracks_dirty")
     conn.commit()
 
-    cur.execute("SELECT COUNT(*) FROM unified_tracks;")
-    row_count = cur.fetchone()[0]
-    log_event("build_unified_tracks", f"✅ unified_tracks view built successfully with {row_count} rows.")
-    cur.close()
-    conn.close()
+    try:
+        cur.execute(f"DROP TABLE IF EXISTS {BUILD_TABLE_NAME}")
+        refresh_play_behavior(cur, scoped=False)
+        cur.execute(f"CREATE TABLE {BUILD_TABLE_NAME} AS {unified_tracks_select(scoped=False)}")
+        for index_name, columns in UNIFIED_TRACKS_INDEXES.items():
+            cur.execute(f"CREATE INDEX {index_name}_build ON {BUILD_TABLE_NAME} {columns}")
+        cur.execute(f"ANALYZE {BUILD_TABLE_NAME}")
+
+        # Swap in one short transaction so readers never see the table missing
+        kind = _relkind(cur, TABLE_NAME)
+        if kind == "m":
+            cur.execute(f"DROP MATERIALIZED VIEW {TABLE_NAME}")
+        elif kind == "r":
+            cur.execute(f"DROP TABLE {TABLE_NAME}")
+        cur.execute(f"ALTER TABLE {BUILD_TABLE_NAME} RENAME TO {TABLE_NAME}")
+        for index_name in UNIFIED_TRACKS_INDEXES:
+            cur.execute(f"ALTER INDEX {index_name}_build RENAME TO {index_name}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        cur.execute("INSERT INTO unified_tracks_dirty (kind, key) VALUES ('full', 'retry') ON CONFLICT DO NOTHING")
+        conn.commit()
+        raise
+    finally:
+        cur.close()
+
+
+# ─────────────────────────────────────────────
+# Incremental refresh
+# ─────────────────────────────────────────────
+def _canonicalize_scope(cur):
+    cur.execute("""
+        INSERT INTO tmp_ut_scope (track_id)
+        SELECT eq.canonical_track_id
+        FROM track_id_equivalents eq
+        JOIN tmp_ut_scope s ON s.track_id = eq.alias_track_id
+        ON CONFLICT DO NOTHING
+    """)
+    cur.execute("TRUNCATE tmp_ut_scope_raw")
+    cur.execute("""
+        INSERT INTO tmp_ut_scope_raw (track_id)
+        SELECT track_id FROM tmp_ut_scope
+        UNION
+        SELECT eq.alias_track_id
+        FROM track_id_equivalents eq
+        JOIN tmp_ut_scope s ON s.track_id = eq.canonical_track_id
+    """)
+
+
+def _add_track_keys(cur):
+    # Name keys of every track row in scope (fuzzy matches land on these)
+    cur.execute("""
+        INSERT INTO tmp_ut_keys (name_key, artist_key)
+        SELECT DISTINCT LOWER(t.name), LOWER(t.artist)
+        FROM tracks t
+        JOIN tmp_ut_scope_raw r ON r.track_id = t.id
+        WHERE t.name IS NOT NULL AND t.artist IS NOT NULL
+        ON CONFLICT DO NOTHING
+    """)
+
+
+def build_scope(cur):
+    """Expand the claimed dirty keys (tmp_ut_dirty) into tmp_ut_scope / tmp_ut_scope_raw / tmp_ut_keys."""
+    cur.execute("""
+        CREATE TEMP TABLE tmp_ut_scope (track_id TEXT PRIMARY KEY) ON COMMIT DROP;
+        CREATE TEMP TABLE tmp_ut_scope_raw (track_id TEXT PRIMARY KEY) ON COMMIT DROP;
+        CREATE TEMP TABLE tmp_ut_keys (
+            name_key TEXT NOT NULL,
+            artist_key TEXT NOT NULL,
+            match_key TEXT GENERATED ALWAYS AS (name_key || E'\\x1f' || artist_key) STORED,
+            PRIMARY KEY (name_key, artist_key)
+        ) ON COMMIT DROP;
+        CREATE INDEX ON tmp_ut_keys (match_key);
+
+        -- Directly changed tracks
+        INSERT INTO tmp_ut_scope (track_id)
+        SELECT DISTINCT key FROM tmp_ut_dirty WHERE kind = 'track'
+        ON CONFLICT DO NOTHING;
+
+        -- Album changes: every track on the album (library or seen in plays)
+        INSERT INTO tmp_ut_scope (track_id)
+        SELECT t.id FROM tracks t JOIN tmp_ut_dirty d ON d.kind = 'album' AND d.key = t.album_id
+        UNION
+        SELECT u.track_id FROM unified_tracks u JOIN tmp_ut_dirty d ON d.kind = 'album' AND d.key = u.album_id
+        ON CONFLICT DO NOTHING;
+
+        -- Artist changes: genres/images are denormalized into every row of the artist
+        INSERT INTO tmp_ut_scope (track_id)
+        SELECT u.track_id FROM unified_tracks u JOIN tmp_ut_dirty d ON d.kind = 'artist' AND d.key = u.artist_id
+        UNION
+        SELECT t.id FROM tracks t
+        JOIN albums a ON a.id = t.album_id
+        JOIN tmp_ut_dirty d ON d.kind = 'artist' AND d.key = a.artist_id
+        UNION
+        SELECT lt.track_id FROM liked_tracks lt JOIN tmp_ut_dirty d ON d.kind = 'artist' AND d.key = lt.artist_id
+        ON CONFLICT DO NOTHING;
+
+        -- Name keys whose fuzzy matches may have changed (incl. old names of updated/deleted rows)
+        INSERT INTO tmp_ut_keys (name_key, artist_key)
+        SELECT DISTINCT key, key2 FROM tmp_ut_dirty WHERE kind = 'name'
+        ON CONFLICT DO NOTHING;
+    """)
+    _canonicalize_scope(cur)
+    _add_track_keys(cur)
+    for table in PLAY_TABLES:
+        cur.execute(f"""
+            INSERT INTO tmp_ut_keys (name_key, artist_key)
+            SELECT DISTINCT LOWER(p.track_name), LOWER(p.artist_name)
+            FROM {table} p
+            JOIN tmp_ut_scope_raw r ON r.track_id = p.track_id
+            WHERE p.track_name IS NOT NULL AND p.artist_name IS NOT NULL
+            ON CONFLICT DO NOTHING
+        """)
+
+    # Every row sharing one of those keys: library tracks gaining/losing fuzzy plays,
+    # and non-library tracks whose plays become (un)matched
+    cur.execute("""
+        INSERT INTO tmp_ut_scope (track_id)
+        SELECT t.id FROM tracks t
+        JOIN tmp_ut_keys k ON k.match_key = t.match_key
+        ON CONFLICT DO NOTHING
+    """)
+    for table in PLAY_TABLES:
+        cur.execute(f"""
+            INSERT INTO tmp_ut_scope (track_id)
+            SELECT DISTINCT p.track_id FROM {table} p
+            JOIN tmp_ut_keys k ON k.match_key = p.match_key
+            WHERE p.track_id IS NOT NULL
+            ON CONFLICT DO NOTHING
+        """)
+    _canonicalize_scope(cur)
+    _add_track_keys(cur)
+
+    cur.execute("SELECT COUNT(*) FROM tmp_ut_scope")
+    return cur.fetchone()[0]
+
+
+def incremental_refresh(conn):
+    """Recompute only the rows affected by queued changes.
+
+    Returns the number of rows recomputed, or None if a full rebuild is needed.
+    """
+    cur = conn.cursor()
+    try:
+        if _relkind(cur, TABLE_NAME) != "r":
+            return None
+        cur.execute("SELECT 1 FROM unified_tracks_dirty WHERE kind = 'full' LIMIT 1")
+        if cur.fetchone():
+            return None
+
+        # Claim queued changes; a failure rolls the claim back with everything else
+        cur.execute("""
+            CREATE TEMP TABLE tmp_ut_dirty (kind TEXT, key TEXT, key2 TEXT) ON COMMIT DROP;
+            WITH claimed AS (
+                DELETE FROM unified_tracks_dirty RETURNING kind, key, key2
+            )
+            INSERT INTO tmp_ut_dirty SELECT * FROM claimed;
+        """)
+        cur.execute("SELECT COUNT(*) FROM tmp_ut_dirty")
+        if cur.fetchone()[0] == 0:
+            conn.commit()
+            return 0
+
+        scope_size = build_scope(cur)
+        if scope_size > MAX_INCREMENTAL_SCOPE:
+            log_event(JOB_NAME, f"{scope_size} tracks affected (> {MAX_INCREMENTAL_SCOPE}); doing a full rebuild instead")
+            conn.rollback()
+            return None
+
+        cur.execute("ANALYZE tmp_ut_scope; ANALYZE tmp_ut_scope_raw; ANALYZE tmp_ut_keys;")
+        refresh_play_behavior(cur, scoped=True)
+        cur.execute(f"CREATE TEMP TABLE tmp_ut_rows ON COMMIT DROP AS {unified_tracks_select(scoped=True)}")
+        cur.execute(f"DELETE FROM {TABLE_NAME} u USING tmp_ut_scope s WHERE u.track_id = s.track_id")
+        cur.execute(f"INSERT INTO {TABLE_NAME} SELECT * FROM tmp_ut_rows")
+        conn.commit()
+        return scope_size
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+
+def export_columnar_tracks(conn):
+    """Rewrite the columnar snapshot of unified_tracks; failures only cost the fast path."""
+    # Imported lazily: the rule evaluator pulls in routes/, which the build itself never needs
+    from playlists import columnar_tracks
+    if not columnar_tracks.available():
+        log_event(JOB_NAME, "⚠️ COLUMNAR_TRACKS_PATH is set but numpy is not installed; skipping snapshot",
+                  level="warning")
+        return
+    start = time.time()
+    try:
+        rows = columnar_tracks.export_columnar_snapshot(conn, COLUMNAR_TRACKS_PATH)
+        log_event(JOB_NAME, f"🧊 Columnar snapshot of {rows} rows written to {COLUMNAR_TRACKS_PATH} "
+                            f"in {time.time() - start:.1f}s")
+    except Exception as e:
+        conn.rollback()
+        log_event(JOB_NAME, f"⚠️ Columnar snapshot failed: {e}", level="warning")
+
+
+def build_unified_tracks(full=False):
+    start = time.time()
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT pg_advisory_lock(%s)", (BUILD_LOCK_KEY,))
+        ensure_source_indexes(cur)
+        triggers_missing = ensure_change_tracking(cur)
+        if triggers_missing:
+            # Changes made while triggers were absent were never recorded
+            cur.execute("INSERT INTO unified_tracks_dirty (kind, key) VALUES ('full', 'triggers') ON CONFLICT DO NOTHING")
+        if ensure_play_behavior(cur):
+            # A new play_behavior table has to be filled from the whole history once
+            cur.execute("INSERT INTO unified_tracks_dirty (kind, key) VALUES ('full', 'play_behavior') ON CONFLICT DO NOTHING")
+        conn.commit()
+
+        refreshed = None if full else incremental_refresh(conn)
+        if refreshed is None:
+            log_event(JOB_NAME, "Starting full unified_tracks rebuild...")
+            full_rebuild(conn)
+            cur.execute(f"SELECT COUNT(*) FROM {TABLE_NAME}")
+            row_count = cur.fetchone()[0]
+            conn.commit()
+            log_event(JOB_NAME, f"✅ unified_tracks rebuilt with {row_count} rows in {time.time() - start:.1f}s.")
+        elif refreshed == 0:
+            log_event(JOB_NAME, "✅ unified_tracks already up to date.")
+        else:
+            log_event(JOB_NAME, f"✅ unified_tracks refreshed {refreshed} affected tracks in {time.time() - start:.1f}s.")
+
+        if COLUMNAR_TRACKS_PATH:
+            # Still under the build lock, so the snapshot matches one committed build
+            export_columnar_tracks(conn)
+    finally:
+        conn.rollback()
+        cur.execute("SELECT pg_advisory_unlock(%s)", (BUILD_LOCK_KEY,))
+        conn.commit()
+        cur.close()
+        conn.close()
+
+
+def run(context=None):
+    full = bool(context and context.options.get("full_rebuild"))
+    build_unified_tracks(full=full)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or incrementally refresh unified_tracks.")
+    parser.add_argument("--full", action="store_true", help="Rebuild unified_tracks from scratch")
+    args = parser.parse_args()
+    build_unified_tracks(full=args.full)
@@ -0,0 +1,245 @@
+"""
+Snapshot export / restore of the core tables via binary COPY.
+
+Usage examples:
+  python api_syncs/snapshot.py export snapshots/2025-01-01
+  python api_syncs/snapshot.py restore snapshots/2025-01-01          # into a database set up by init_db
+  python api_syncs/snapshot.py restore snapshots/2025-01-01 --tables plays artists
+
+Layout of a snapshot directory:
+  manifest.json          format, creation time, server version and per table:
+                         file, columns (name + type), row count, played_at range
+  <table>.copy.gz        COPY ... WITH (FORMAT binary) output, gzip-compressed
+
+Behavior:
+- Export streams every table through COPY ... TO STDOUT straight into gzip;
+  no row ever passes through Python. Tables are exported in parallel from
+  one exported snapshot (pg_export_snapshot), so the set is consistent.
+- Generated columns are not exported; the target recomputes them.
+- Restore replaces the data of each table (TRUNCATE + COPY FROM STDIN) in
+  parallel, one transaction per table. Secondary indexes are dropped before
+  the load and recreated afterwards; id sequences are moved past the
+  restored ids. Column types must match the manifest (binary COPY is typed).
+- unified_tracks is not part of the snapshot; the TRUNCATEs queue a full
+  rebuild for the next materialized_views run.
+"""
+import os
+import sys
+# Ensure project root is on sys.path when running as a script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import gzip
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from utils.db_utils import get_db_connection
+from utils.logger import log_event
+from utils.play_partitions import PLAY_TABLES, ensure_play_partitions
+from api_syncs.materialized_views import change_tracking_suspended
+
+JOB_NAME = "snapshot"
+FORMAT = "pgcopy-binary+gzip"
+FORMAT_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+SNAPSHOT_TABLES = (
+    "albums", "tracks", "liked_tracks",
+    "plays", "spotify_play_history", "apple_music_play_history",
+    "artists", "playlist_mappings", "track_id_equivalents", "excluded_tracks",
+)
+# Parallel table workers (each holds one pooled connection)
+WORKERS = int(os.getenv("SNAPSHOT_WORKERS", "4"))
+# gzip level: low levels keep export disk/network-bound rather than CPU-bound
+COMPRESS_LEVEL = int(os.getenv("SNAPSHOT_COMPRESS_LEVEL", "1"))
+
+
+def table_columns(cur, table):
+    """[(name, type)] of the non-generated columns of ``table`` in ordinal order."""
+    cur.execute("""
+        SELECT a.attname, format_type(a.atttypid, a.atttypmod)
+        FROM pg_attribute a
+        WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped AND a.attgenerated = ''
+        ORDER BY a.attnum
+    """, (table,))
+    return [tuple(row) for row in cur.fetchall()]
+
+
+def _column_list(columns):
+    return ", ".join(f'"{name}"' for name, _ in columns)
+
+
+# ─────────────────────────────────────────────
+# Export
+# ─────────────────────────────────────────────
+def _export_table(directory, snapshot_id, table):
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        cur.execute("SET TRANSACTION SNAPSHOT %s", (snapshot_id,))
+        columns = table_columns(cur, table)
+        entry = {"file": f"{table}.copy.gz", "columns": [list(c) for c in columns]}
+        if table in PLAY_TABLES:
+            cur.execute(f"SELECT MIN(played_at), MAX(played_at) FROM {table}")
+            oldest, newest = cur.fetchone()
+            entry["played_at_range"] = [oldest.isoformat() if oldest else None, newest.isoformat() if newest else None]
+
+        path = os.path.join(directory, entry["file"])
+        with gzip.open(path, "wb", compresslevel=COMPRESS_LEVEL) as out:
+            cur.copy_expert(f"COPY (SELECT {_column_list(columns)} FROM {table}) TO STDOUT WITH (FORMAT binary)", out)
+        entry["rows"] = cur.rowcount
+        entry["bytes"] = os.path.getsize(path)
+        cur.close()
+        return table, entry
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def export_snapshot(directory, tables=SNAPSHOT_TABLES, workers=WORKERS):
+    start = time.time()
+    os.makedirs(directory, exist_ok=True)
+    # Held open until every worker has imported its snapshot
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        cur.execute("SELECT pg_export_snapshot(), current_setting('server_version')")
+        snapshot_id, server_version = cur.fetchone()
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            entries = dict(pool.map(lambda table: _export_table(directory, snapshot_id, table), tables))
+    finally:
+        conn.rollback()
+        conn.close()
+
+    manifest = {
+        "format": FORMAT,
+        "version": FORMAT_VERSION,
+        "created_at": datetime.utcnow().isoformat() + "Z",
+        "server_version": server_version,
+        "tables": {table: entries[table] for table in tables},
+    }
+    with open(os.path.join(directory, MANIFEST_FILE), "w") as fp:
+        json.dump(manifest, fp, indent=2)
+
+    rows = sum(e["rows"] for e in entries.values())
+    size = sum(e["bytes"] for e in entries.values())
+    log_event(JOB_NAME, f"📦 Exported {len(tables)} tables ({rows} rows, {size / 1e6:.1f} MB) "
+                        f"to {directory} in {time.time() - start:.1f}s")
+    return manifest
+
+
+# ─────────────────────────────────────────────
+# Restore
+# ─────────────────────────────────────────────
+def _secondary_indexes(cur, table):
+    """[(name, definition)] of indexes that do not back a constraint."""
+    cur.execute("""
+        SELECT c.relname, pg_get_indexdef(i.indexrelid)
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE i.indrelid = %s::regclass
+          AND NOT EXISTS (SELECT 1 FROM pg_constraint k WHERE k.conindid = i.indexrelid)
+    """, (table,))
+    # Definitions of partitioned indexes read "ON ONLY parent"; recreate them on every partition
+    return [(name, definition.replace(" ON ONLY ", " ON ", 1)) for name, definition in cur.fetchall()]
+
+
+def _reset_sequences(cur, table, columns):
+    for name, _ in columns:
+        cur.execute("SELECT pg_get_serial_sequence(%s, %s)", (table, name))
+        sequence = cur.fetchone()[0]
+        if sequence:
+            cur.execute(f'SELECT setval(%s, COALESCE((SELECT MAX("{name}") FROM {table}), 0) + 1, FALSE)',
+                        (sequence,))
+
+
+def _restore_table(directory, table, entry):
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        columns = [tuple(c) for c in entry["columns"]]
+        current = dict(table_columns(cur, table))
+        mismatched = [f"{name} ({kind} -> {current.get(name, 'missing')})"
+                      for name, kind in columns if current.get(name) != kind]
+        if mismatched:
+            raise ValueError(f"{table}: column types differ from the snapshot: {', '.join(mismatched)}")
+
+        if table in PLAY_TABLES and entry.get("played_at_range", [None])[0]:
+            oldest, newest = (datetime.fromisoformat(v) for v in entry["played_at_range"])
+            ensure_play_partitions(cur, start=oldest, end=newest, tables=(table,))
+
+        indexes = _secondary_indexes(cur, table)
+        cur.execute(f"TRUNCATE {table}")
+        for name, _ in indexes:
+            cur.execute(f"DROP INDEX {name}")
+        with change_tracking_suspended(cur, table):
+            with gzip.open(os.path.join(directory, entry["file"]), "rb") as src:
+                cur.copy_expert(f"COPY {table} ({_column_list(columns)}) FROM STDIN WITH (FORMAT binary)", src)
+            rows = cur.rowcount
+        for _, definition in indexes:
+            cur.execute(definition)
+        _reset_sequences(cur, table, columns)
+        cur.execute(f"ANALYZE {table}")
+        conn.commit()
+        cur.close()
+        return table, rows
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def restore_snapshot(directory, tables=None, workers=WORKERS):
+    start = time.time()
+    with open(os.path.join(directory, MANIFEST_FILE)) as fp:
+        manifest = json.load(fp)
+    if manifest.get("format") != FORMAT or manifest.get("version") != FORMAT_VERSION:
+        raise ValueError(f"Unsupported snapshot format: {manifest.get('format')} v{manifest.get('version')}")
+
+    selected = {t: e for t, e in manifest["tables"].items() if not tables or t in tables}
+    unknown = set(tables or ()) - set(manifest["tables"])
+    if unknown:
+        raise ValueError(f"Not in this snapshot: {', '.join(sorted(unknown))}")
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_restore_table, directory, table, entry) for table, entry in selected.items()]
+        restored, failed = {}, {}
+        for table, future in zip(selected, futures):
+            try:
+                restored[table] = future.result()[1]
+            except Exception as e:
+                failed[table] = e
+                log_event(JOB_NAME, f"❌ Restore of {table} failed: {e}", level="error")
+
+    log_event(JOB_NAME, f"♻️ Restored {len(restored)} tables ({sum(restored.values())} rows) "
+                        f"from {directory} in {time.time() - start:.1f}s")
+    if failed:
+        raise RuntimeError(f"Restore failed for: {', '.join(sorted(failed))}")
+    return restored
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Export or restore a binary COPY snapshot of the core tables")
+    sub = ap.add_subparsers(dest="command", required=True)
+    export = sub.add_parser("export", help="Write a snapshot directory")
+    export.add_argument("directory")
+    export.add_argument("--tables", nargs="+", default=list(SNAPSHOT_TABLES), help="Tables to export (default: all core tables)")
+    restore = sub.add_parser("restore", help="Replace table contents from a snapshot directory")
+    restore.add_argument("directory")
+    restore.add_argument("--tables", nargs="+", help="Only restore these tables")
+    for parser in (export, restore):
+        parser.add_argument("--workers", type=int, default=WORKERS, help=f"Parallel tables (default {WORKERS})")
+    return ap.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.command == "export":
+        export_snapshot(args.directory, tables=tuple(args.tables), workers=args.workers)
+    else:
+        restore_snapshot(args.directory, tables=args.tables, workers=args.workers)
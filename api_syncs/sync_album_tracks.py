@@ -1,257 +1,284 @@
 import os
-import psycopg2
-import requests
-import time
-import requests.exceptions
-from spotipy import Spotify
-from spotipy.exceptions import SpotifyException
+from psycopg2.extras import execute_values
 from utils.logger import log_event
 from utils.spotify_auth import get_spotify_client
+from utils.spotify_rate_limit import spotify_map
 from utils.db_utils import get_db_connection
 
-sp = get_spotify_client()
+JOB_NAME = "sync_album_tracks"
 # How many albums to integrity-check per run (can override via env ALBUM_INTEGRITY_BATCH)
 INTEGRITY_CHECK_COUNT = int(os.getenv("ALBUM_INTEGRITY_BATCH", "50"))
+# Albums fetched, upserted and committed together
+ALBUM_SYNC_CHUNK = int(os.getenv("ALBUM_SYNC_CHUNK", "200"))
+ALBUMS_PER_REQUEST = 20   # Spotify max for /albums?ids=
+TRACKS_PER_REQUEST = 50   # Spotify max for /tracks?ids=
 
-def safe_spotify_call(func, *args, **kwargs):
-    retries = 0
-    while retries < 5:
-        try:
-            return func(*args, **kwargs)
-        except SpotifyException as e:
-            if e.http_status == 429:
-                retry_after = int(e.headers.get("Retry-After", 5))
-                retries += 1
-                log_event("sync_album_tracks", f"Rate limit hit. Retry #{retries} in {retry_after}s")
-                time.sleep(retry_after)
-            else:
-                log_event("sync_album_tracks", f"Spotify error: {e}", level="error")
-                raise
-        except requests.exceptions.ConnectionError as e:
-            retries += 1
-            log_event("sync_album_tracks", f"Connection error: {e}. Retry #{retries} in 5s", level="warning")
-            time.sleep(5)
-    raise Exception("safe_spotify_call failed after 5 retries")
-
-
-# Helper to get all tracks for an album (handles pagination)
-def get_all_album_tracks(album_id):
-    album_data = safe_spotify_call(sp.album, album_id)
-    tracks = album_data['tracks']['items']
-    next_url = album_data['tracks']['next']
-
-    while next_url:
-        next_page = safe_spotify_call(sp._get, next_url)
-        tracks.extend(next_page['items'])
-        next_url = next_page['next']
-
-    return tracks
-
-conn = get_db_connection()
-cur = conn.cursor()
-# Safety: ensure columns exist (no-op if already present)
-cur.execute("ALTER TABLE albums ADD COLUMN IF NOT EXISTS tracks_checked_at TIMESTAMP")
-cur.execute("ALTER TABLE tracks ADD COLUMN IF NOT EXISTS popularity INTEGER")
-conn.commit()
-log_event("sync_album_tracks", "Schema check complete for tracks_checked_at and popularity")
-
-log_event("sync_album_tracks", "Syncing album tracks for unsynced albums")
-
-# 1️⃣ Sync tracks for still-saved albums
-cur.execute("""
-    SELECT id, name, added_at FROM albums
-    WHERE is_saved = TRUE AND (tracks_synced = FALSE OR tracks_synced IS NULL)
-""")
-saved_albums = cur.fetchall()
-
-for album_id, album_name, album_added_at in saved_albums:
-    log_event("sync_album_tracks", f"Syncing tracks for: {album_name} ({album_id})")
-    album_tracks = get_all_album_tracks(album_id)
-    if not album_tracks:
-        log_event("sync_album_tracks", f"No tracks found for album: {album_name} ({album_id})")
-        continue
-
-    track_ids = [t['id'] for t in album_tracks if t.get('id')]
-    enriched_metadata = {}
-    for i in range(0, len(track_ids), 50):
-        batch_ids = track_ids[i:i+50]
-        response = safe_spotify_call(sp.tracks, batch_ids)
-        for item in response.get('tracks', []):
-            enriched_metadata[item['id']] = item
-
-    for track in album_tracks:
-        track_id = track['id']
-        track_name = track['name']
-        track_artist = track['artists'][0]['name']
-        track_number = track.get('track_number') or 1
-        disc_number = track.get('disc_number') or 1
-
-        duration_ms = track.get('duration_ms')
-
-        popularity = None
-        if track_id and track_id in enriched_metadata:
-            popularity = enriched_metadata[track_id].get('popularity')
-
-        cur.execute("""
-            INSERT INTO tracks (
-                id, name, artist, album, album_id,
-                from_album, track_number, disc_number, added_at,
-                duration_ms, popularity
-            )
-            VALUES (%s, %s, %s, %s, %s, TRUE, %s, %s, %s,
-                    %s, %s)
-            ON CONFLICT (id) DO UPDATE SET
-                name = EXCLUDED.name,
-                artist = EXCLUDED.artist,
-                album = EXCLUDED.album,
-                album_id = EXCLUDED.album_id,
-                from_album = TRUE,
-                track_number = EXCLUDED.track_number,
-                disc_number = EXCLUDED.disc_number,
-                added_at = COALESCE(tracks.added_at, EXCLUDED.added_at),
-                duration_ms = EXCLUDED.duration_ms,
-                popularity = COALESCE(EXCLUDED.popularity, tracks.popularity)
-        """, (
-            track_id, track_name, track_artist, album_name, album_id,
-            track_number, disc_number, album_added_at,
-            duration_ms, popularity
-        ))
-
-    # --- Reconcile: remove DB tracks that no longer exist on Spotify for this album ---
-    cur.execute("SELECT id FROM tracks WHERE album_id = %s AND from_album = TRUE", (album_id,))
-    existing_ids = {row[0] for row in cur.fetchall()}
-    desired_ids = {t['id'] for t in album_tracks if t.get('id')}
-    to_remove = list(existing_ids - desired_ids)
-
-    if to_remove:
-        # Remove liked_tracks that reference these tracks first to avoid FK issues
-        cur.execute("DELETE FROM liked_tracks WHERE track_id = ANY(%s)", (to_remove,))
-        cur.execute("DELETE FROM tracks WHERE id = ANY(%s) AND album_id = %s", (to_remove, album_id))
-        log_event("sync_album_tracks", f"Reconciled album {album_id}: removed {len(to_remove)} track(s) not present on Spotify")
 
-    cur.execute("""
-        UPDATE albums SET
-            tracks_synced = TRUE,
-            tracks_checked_at = NOW()
-        WHERE id = %s
-    """, (album_id,))
-    conn.commit()
+def _batches(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
 
-# 2️⃣ Remove albums and their tracks if they are no longer saved
-cur.execute("""
-    SELECT id FROM albums
-    WHERE is_saved = FALSE
-""")
-removed_albums = cur.fetchall()
 
-for album_id, in removed_albums:
-    log_event("sync_album_tracks", f"Deleting tracks and album: {album_id}")
-
-    cur.execute("SELECT COUNT(*) FROM liked_tracks WHERE track_id IN (SELECT id FROM tracks WHERE album_id = %s)", (album_id,))
-    deleted_liked_count = cur.fetchone()[0]
-    log_event("sync_album_tracks", f"Deleting {deleted_liked_count} liked tracks associated with album: {album_id}")
+# ─────────────────────────────────────────────
+# Spotify fetch (batched + concurrent)
+# ─────────────────────────────────────────────
+def fetch_album_tracks(sp, album_ids):
+    """Return {album_id: [track items]} using /albums in batches of 20.
 
+    Albums Spotify no longer returns are left out of the result.
+    """
+    def fetch(batch):
+        albums = sp.albums(batch).get('albums') or []
+        result = {}
+        for album in albums:
+            if not album:
+                continue
+            page = album['tracks']
+            tracks = list(page['items'])
+            while page.get('next'):
+                page = sp.next(page)
+                tracks.extend(page['items'])
+            result[album['id']] = tracks
+        return result
+
+    album_tracks = {}
+    for part in spotify_map(fetch, _batches(album_ids, ALBUMS_PER_REQUEST)):
+        album_tracks.update(part)
+    return album_tracks
+
+
+def fetch_popularity(sp, track_ids):
+    """Return {track_id: popularity} using /tracks in batches of 50."""
+    def fetch(batch):
+        return {t['id']: t.get('popularity') for t in (sp.tracks(batch).get('tracks') or []) if t}
+
+    popularity = {}
+    for part in spotify_map(fetch, _batches(track_ids, TRACKS_PER_REQUEST)):
+        popularity.update(part)
+    return popularity
+
+
+# ─────────────────────────────────────────────
+# DB writes (set-based)
+# ─────────────────────────────────────────────
+def upsert_tracks(cur, albums, album_tracks, popularity):
+    """Upsert every track of every album in ``album_tracks`` in one statement."""
+    rows = {}
+    for album_id, tracks in album_tracks.items():
+        album_name, album_added_at = albums[album_id]
+        for t in tracks:
+            tid = t.get('id')
+            if not tid:
+                continue
+            rows[tid] = (
+                tid,
+                t.get('name'),
+                (t.get('artists') or [{}])[0].get('name'),
+                album_name,
+                album_id,
+                t.get('track_number') or 1,
+                t.get('disc_number') or 1,
+                album_added_at,
+                t.get('duration_ms'),
+                popularity.get(tid),
+            )
+    if not rows:
+        return 0
+
+    execute_values(cur, """
+        INSERT INTO tracks (
+            id, name, artist, album, album_id,
+            track_number, disc_number, added_at,
+            duration_ms, popularity, from_album
+        )
+        VALUES %s
+        ON CONFLICT (id) DO UPDATE SET
+            name = EXCLUDED.name,
+            artist = EXCLUDED.artist,
+            album = EXCLUDED.album,
+            album_id = EXCLUDED.album_id,
+            from_album = TRUE,
+            track_number = EXCLUDED.track_number,
+            disc_number = EXCLUDED.disc_number,
+            added_at = COALESCE(tracks.added_at, EXCLUDED.added_at),
+            duration_ms = EXCLUDED.duration_ms,
+            popularity = COALESCE(EXCLUDED.popularity, tracks.popularity)
+    """, list(rows.values()), template="(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, TRUE)", page_size=1000)
+    return len(rows)
+
+
+def reconcile_tracks(cur, album_tracks):
+    """Delete DB tracks that no longer exist on Spotify for the given albums."""
+    pairs = [(album_id, t['id']) for album_id, tracks in album_tracks.items() for t in tracks if t.get('id')]
+    cur.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS tmp_album_track_ids (
+            album_id TEXT NOT NULL,
+            track_id TEXT NOT NULL
+        ) ON COMMIT DELETE ROWS
+    """)
+    execute_values(cur, "INSERT INTO tmp_album_track_ids (album_id, track_id) VALUES %s", pairs, page_size=1000)
+    cur.execute("""
+        WITH stale AS (
+            SELECT t.id, t.album_id
+            FROM tracks t
+            WHERE t.from_album = TRUE
+              AND t.album_id = ANY(%s)
+              AND NOT EXISTS (
+                  SELECT 1 FROM tmp_album_track_ids s
+                  WHERE s.album_id = t.album_id AND s.track_id = t.id
+              )
+        ),
+        -- Remove liked_tracks that reference these tracks too
+        removed_liked AS (
+            DELETE FROM liked_tracks WHERE track_id IN (SELECT id FROM stale)
+        )
+        DELETE FROM tracks t
+        USING stale
+        WHERE t.id = stale.id AND t.album_id = stale.album_id
+        RETURNING t.album_id
+    """, (list(album_tracks.keys()),))
+    removed = {}
+    for (album_id,) in cur.fetchall():
+        removed[album_id] = removed.get(album_id, 0) + 1
+    for album_id, count in removed.items():
+        log_event(JOB_NAME, f"Reconciled album {album_id}: removed {count} track(s) not present on Spotify")
+    return sum(removed.values())
+
+
+def _sync_chunk(sp, cur, albums, chunk, mark_synced):
+    """Fetch, upsert and reconcile one chunk of album ids (uncommitted).
+
+    Returns (albums with tracks, tracks upserted).
+    """
+    album_tracks = fetch_album_tracks(sp, chunk)
+    for album_id in chunk:
+        if album_id not in album_tracks:
+            log_event(JOB_NAME, f"Album not returned by Spotify: {albums[album_id][0]} ({album_id})", level="warning")
+        elif not album_tracks[album_id]:
+            log_event(JOB_NAME, f"No tracks found for album: {albums[album_id][0]} ({album_id})", level="warning")
+    album_tracks = {a: tracks for a, tracks in album_tracks.items() if tracks}
+
+    track_ids = list({t['id'] for tracks in album_tracks.values() for t in tracks if t.get('id')})
+    popularity = fetch_popularity(sp, track_ids)
+
+    upserted = upsert_tracks(cur, albums, album_tracks, popularity)
+    if album_tracks:
+        reconcile_tracks(cur, album_tracks)
+
+    if mark_synced:
+        cur.execute("UPDATE albums SET tracks_synced = TRUE WHERE id = ANY(%s)", (list(album_tracks.keys()),))
+    # Stamp every checked album, including empty ones, to avoid hammering them
+    cur.execute("UPDATE albums SET tracks_checked_at = NOW() WHERE id = ANY(%s)", (chunk,))
+    return len(album_tracks), upserted
+
+
+def sync_albums(sp, conn, albums, mark_synced):
+    """Fetch, upsert and reconcile tracks for ``albums`` ({id: (name, added_at)}).
+
+    Albums are processed and committed in chunks of ALBUM_SYNC_CHUNK.
+    ``mark_synced`` also flips albums.tracks_synced for albums that returned tracks.
+    A failing chunk is rolled back and retried album by album; an album that
+    still fails is only stamped as checked, so it can't block later runs.
+    """
+    cur = conn.cursor()
+    album_ids = list(albums.keys())
+    total_tracks = 0
+    for chunk in _batches(album_ids, ALBUM_SYNC_CHUNK):
+        try:
+            synced, upserted = _sync_chunk(sp, cur, albums, chunk, mark_synced)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            log_event(JOB_NAME, f"Chunk of {len(chunk)} album(s) failed, retrying one by one: {e}", level="warning")
+            synced = upserted = 0
+            for album_id in chunk:
+                try:
+                    album_synced, album_upserted = _sync_chunk(sp, cur, albums, [album_id], mark_synced)
+                    conn.commit()
+                except Exception as album_error:
+                    conn.rollback()
+                    log_event(JOB_NAME, f"Failed to sync album {albums[album_id][0]} ({album_id}): {album_error}",
+                              level="error")
+                    cur.execute("UPDATE albums SET tracks_checked_at = NOW() WHERE id = %s", (album_id,))
+                    conn.commit()
+                    continue
+                synced += album_synced
+                upserted += album_upserted
+        total_tracks += upserted
+        log_event(JOB_NAME, f"Committed {synced}/{len(chunk)} album(s), {total_tracks} track(s) so far")
+    cur.close()
+    return total_tracks
+
+
+def remove_unsaved_albums(conn):
+    """Remove albums (and their tracks) that are no longer saved, in one transaction."""
+    cur = conn.cursor()
     cur.execute("""
         DELETE FROM liked_tracks
         WHERE track_id IN (
-            SELECT id FROM tracks WHERE album_id = %s
+            SELECT t.id FROM tracks t
+            JOIN albums a ON a.id = t.album_id
+            WHERE a.is_saved = FALSE
         )
-    """, (album_id,))
-
-    cur.execute("DELETE FROM tracks WHERE album_id = %s", (album_id,))
-    cur.execute("DELETE FROM albums WHERE id = %s", (album_id,))
+    """)
+    deleted_liked = cur.rowcount
+    cur.execute("""
+        DELETE FROM tracks t
+        USING albums a
+        WHERE a.id = t.album_id AND a.is_saved = FALSE
+    """)
+    deleted_tracks = cur.rowcount
+    cur.execute("DELETE FROM albums WHERE is_saved = FALSE")
+    deleted_albums = cur.rowcount
     conn.commit()
+    cur.close()
+    if deleted_albums:
+        log_event(JOB_NAME, f"Deleted {deleted_albums} unsaved album(s), {deleted_tracks} track(s) "
+                            f"and {deleted_liked} associated liked track(s)")
+
+
+def run(context=None):
+    sp = get_spotify_client()
+    conn = get_db_connection()
+    cur = conn.cursor()
+    # Safety: ensure columns exist (no-op if already present)
+    cur.execute("ALTER TABLE albums ADD COLUMN IF NOT EXISTS tracks_checked_at TIMESTAMP")
+    cur.execute("ALTER TABLE tracks ADD COLUMN IF NOT EXISTS popularity INTEGER")
+    conn.commit()
+    log_event(JOB_NAME, "Schema check complete for tracks_checked_at and popularity")
 
-# 3️⃣ Background integrity check: verify oldest N albums each run (N=INTEGRITY_CHECK_COUNT)
-log_event("sync_album_tracks", f"Running background integrity check for oldest {INTEGRITY_CHECK_COUNT} albums")
-
-cur.execute("""
-    SELECT id, name, added_at
-    FROM albums
-    WHERE is_saved = TRUE
-    ORDER BY tracks_checked_at NULLS FIRST, added_at ASC
-    LIMIT %s
-""", (INTEGRITY_CHECK_COUNT,))
-oldest_albums = cur.fetchall()
-
-for chk_album_id, chk_album_name, chk_album_added_at in oldest_albums:
+    # 1️⃣ Sync tracks for still-saved albums
+    cur.execute("""
+        SELECT id, name, added_at FROM albums
+        WHERE is_saved = TRUE AND (tracks_synced = FALSE OR tracks_synced IS NULL)
+    """)
+    saved_albums = {album_id: (name, added_at) for album_id, name, added_at in cur.fetchall()}
+    log_event(JOB_NAME, f"Syncing album tracks for {len(saved_albums)} unsynced album(s)")
+    if saved_albums:
+        sync_albums(sp, conn, saved_albums, mark_synced=True)
+
+    # 2️⃣ Remove albums and their tracks if they are no longer saved
+    remove_unsaved_albums(conn)
+
+    # 3️⃣ Background integrity check: verify oldest N albums each run (N=INTEGRITY_CHECK_COUNT)
+    log_event(JOB_NAME, f"Running background integrity check for oldest {INTEGRITY_CHECK_COUNT} albums")
+    cur.execute("""
+        SELECT id, name, added_at
+        FROM albums
+        WHERE is_saved = TRUE
+        ORDER BY tracks_checked_at NULLS FIRST, added_at ASC
+        LIMIT %s
+    """, (INTEGRITY_CHECK_COUNT,))
+    oldest_albums = {album_id: (name, added_at) for album_id, name, added_at in cur.fetchall()}
     try:
-        log_event("sync_album_tracks", f"Integrity check: {chk_album_name} ({chk_album_id})")
-        album_tracks = get_all_album_tracks(chk_album_id)
-        if not album_tracks:
-            log_event("sync_album_tracks", f"No tracks returned during integrity check for album: {chk_album_name} ({chk_album_id})", level="warning")
-            # Still record check to avoid hammering the same album
-            cur.execute("UPDATE albums SET tracks_checked_at = NOW() WHERE id = %s", (chk_album_id,))
-            conn.commit()
-            continue
-
-        # Enrich with popularity
-        sp_track_ids = [t.get('id') for t in album_tracks if t.get('id')]
-        enriched = {}
-        for i in range(0, len(sp_track_ids), 50):
-            batch_ids = sp_track_ids[i:i+50]
-            response = safe_spotify_call(sp.tracks, batch_ids)
-            for item in response.get('tracks', []):
-                enriched[item['id']] = item
-
-        # Upsert tracks + popularity; do not delete missing here
-        for t in album_tracks:
-            tid = t.get('id')
-            if not tid:
-                continue
-            t_name = t.get('name')
-            t_artist = t.get('artists', [{}])[0].get('name')
-            t_num = t.get('track_number') or 1
-            d_num = t.get('disc_number') or 1
-            dur = t.get('duration_ms')
-            pop = enriched.get(tid, {}).get('popularity')
-
-            cur.execute("""
-                INSERT INTO tracks (
-                    id, name, artist, album, album_id,
-                    from_album, track_number, disc_number, added_at,
-                    duration_ms, popularity
-                )
-                VALUES (%s, %s, %s, %s, %s, TRUE, %s, %s, %s,
-                        %s, %s)
-                ON CONFLICT (id) DO UPDATE SET
-                    name = EXCLUDED.name,
-                    artist = EXCLUDED.artist,
-                    album = EXCLUDED.album,
-                    album_id = EXCLUDED.album_id,
-                    from_album = TRUE,
-                    track_number = EXCLUDED.track_number,
-                    disc_number = EXCLUDED.disc_number,
-                    duration_ms = EXCLUDED.duration_ms,
-                    popularity = COALESCE(EXCLUDED.popularity, tracks.popularity)
-            """, (tid, t_name, t_artist, chk_album_name, chk_album_id, t_num, d_num, chk_album_added_at, dur, pop))
-
-        # --- Reconcile: remove DB tracks that no longer exist on Spotify for this album (integrity check) ---
-        cur.execute("SELECT id FROM tracks WHERE album_id = %s AND from_album = TRUE", (chk_album_id,))
-        existing_ids = {row[0] for row in cur.fetchall()}
-        desired_ids = {t['id'] for t in album_tracks if t.get('id')}
-        to_remove = list(existing_ids - desired_ids)
-
-        if to_remove:
-            cur.execute("DELETE FROM liked_tracks WHERE track_id = ANY(%s)", (to_remove,))
-            cur.execute("DELETE FROM tracks WHERE id = ANY(%s) AND album_id = %s", (to_remove, chk_album_id))
-            log_event("sync_album_tracks", f"Integrity reconcile {chk_album_id}: removed {len(to_remove)} track(s) not present on Spotify")
-
-        # Mark album as checked
-        cur.execute("UPDATE albums SET tracks_checked_at = NOW() WHERE id = %s", (chk_album_id,))
-        updated = cur.rowcount
-        log_event("sync_album_tracks", f"Stamped tracks_checked_at for {chk_album_id}; rows updated: {updated}")
-        if updated == 0:
-            # Re-attempt with explicit type cast (rare, but helpful if id encoding mismatch)
-            cur.execute("UPDATE albums SET tracks_checked_at = NOW() WHERE id::text = %s::text", (chk_album_id,))
-            log_event("sync_album_tracks", f"Re-attempted stamp for {chk_album_id}; rows updated: {cur.rowcount}")
-        conn.commit()
+        sync_albums(sp, conn, oldest_albums, mark_synced=False)
     except Exception as e:
-        log_event("sync_album_tracks", f"Integrity check failed for album {chk_album_id}: {e}", level="error")
+        log_event(JOB_NAME, f"Integrity check failed: {e}", level="error")
         conn.rollback()
 
-conn.commit()
+    cur.close()
+    conn.close()
+    log_event(JOB_NAME, "Album tracks sync complete")
+
 
-cur.close()
-conn.close()
-log_event("sync_album_tracks", "Album tracks sync complete")
\ No newline at end of file
+if __name__ == "__main__":
+    run()
@@ -3,89 +3,124 @@ from utils.logger import log_event
 
 import os
 from datetime import datetime
+from psycopg2.extras import execute_values
 from utils.spotify_auth import get_spotify_client
 from utils.db_utils import get_db_connection
+from utils.spotify_rate_limit import spotify_map
+from utils.sync_state import ensure_sync_state, get_state, set_state
+
+JOB_NAME = "sync_artists"
+ARTISTS_PER_REQUEST = 50
+# Concurrent /artists requests; overall request rate is bounded by SPOTIFY_RATE_PER_S
+MAX_CONCURRENCY = int(os.getenv("ARTISTS_MAX_CONCURRENCY", "4"))
+REFRESH_OLDEST_COUNT = int(os.getenv("ARTISTS_REFRESH_OLDEST_COUNT", "100"))
+
+# Append-only play tables are scanned past a per-table id watermark;
+# the (small) library tables are anti-joined in full.
+PLAY_TABLES = ("plays", "spotify_play_history", "apple_music_play_history")
+LIBRARY_TABLES = ("albums", "liked_tracks")
+
+
+def _watermark_key(table):
+    return f"{JOB_NAME}.{table}.max_id"
+
 
 def fetch_artists_metadata(sp, artist_ids):
+    valid_ids = [a for a in artist_ids if a]  # Skip None or empty strings
+    batches = [valid_ids[i:i + ARTISTS_PER_REQUEST] for i in range(0, len(valid_ids), ARTISTS_PER_REQUEST)]
+
+    def fetch(batch):
+        return sp.artists(batch)['artists']
+
     metadata = []
-    for i in range(0, len(artist_ids), 50):
-        batch = artist_ids[i:i+50]
-        valid_batch = [a for a in batch if a]  # Skip None or empty strings
-        if not valid_batch:
-            log_event("sync_artists", "⚠️ Skipping empty artist batch")
-            continue
-        response = sp.artists(valid_batch)
-        for artist in response['artists']:
-            genres = artist.get('genres', [])
+    for response in spotify_map(fetch, batches, max_workers=MAX_CONCURRENCY):
+        for artist in response:
+            if not artist:
+                continue  # Unknown ids come back as null
             images = artist.get('images', [])
-            image_url = images[0]['url'] if images else None
             metadata.append({
                 'id': artist['id'],
                 'name': artist['name'],
-                'genres': genres,
-                'image_url': image_url,
+                'genres': artist.get('genres', []),
+                'image_url': images[0]['url'] if images else None,
             })
     return metadata
 
-def main():
+
+def find_new_artist_ids(cur):
+    """Artist ids referenced by the library or by plays newer than the
+    watermarks that are not in ``artists`` yet.
+
+    Returns (artist_ids, new_watermarks).
+    """
+    ranges = {}
+    for table in PLAY_TABLES:
+        cur.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}")
+        ranges[table] = (int(get_state(cur, _watermark_key(table), 0)), cur.fetchone()[0])
+
+    sources = [f"SELECT artist_id FROM {table}" for table in LIBRARY_TABLES]
+    params = []
+    for table, (low, high) in ranges.items():
+        if high > low:
+            sources.append(f"SELECT artist_id FROM {table} WHERE id > %s AND id <= %s")
+            params.extend([low, high])
+
+    cur.execute(f"""
+        SELECT src.artist_id
+        FROM ({' UNION '.join(sources)}) AS src
+        WHERE src.artist_id IS NOT NULL AND src.artist_id <> ''
+          AND NOT EXISTS (SELECT 1 FROM artists a WHERE a.id = src.artist_id)
+    """, params)
+    return [row[0] for row in cur.fetchall()], {table: high for table, (_, high) in ranges.items()}
+
+
+def run(context=None):
     conn = get_db_connection()
     cur = conn.cursor()
+    ensure_sync_state(cur)
     now = datetime.utcnow()
 
-    # Get all unique artist IDs from albums, liked_tracks, spotify_play_history, apple_music_play_history, and plays
-    cur.execute("""
-        SELECT DISTINCT artist_id FROM (
-            SELECT artist_id FROM albums
-            UNION
-            SELECT artist_id FROM liked_tracks
-            UNION
-            SELECT artist_id FROM spotify_play_history
-            UNION
-            SELECT artist_id FROM apple_music_play_history
-            UNION
-            SELECT artist_id FROM plays
-        ) AS combined
-    """)
-    all_known_artist_ids = {row[0] for row in cur.fetchall()}
-
-    # Artists not yet in the artists table
-    cur.execute("SELECT id FROM artists")
-    existing_artist_ids = {row[0] for row in cur.fetchall()}
-    new_artist_ids = list(all_known_artist_ids - existing_artist_ids)
-
-    # Oldest 100 existing artists
+    # New artists only: anti-join against artists, play tables past their watermark
+    new_artist_ids, watermarks = find_new_artist_ids(cur)
+
+    # Oldest existing artists get their metadata refreshed
     cur.execute("""
         SELECT id FROM artists
         ORDER BY COALESCE(last_checked_at, '2000-01-01') ASC
-        LIMIT 100
-    """)
+        LIMIT %s
+    """, (REFRESH_OLDEST_COUNT,))
     oldest_artist_ids = [row[0] for row in cur.fetchall()]
 
     # Combine new and old artist IDs
     all_artist_ids = list(set(new_artist_ids + oldest_artist_ids))
+    log_event(JOB_NAME, f"🔍 {len(new_artist_ids)} new artist(s), {len(oldest_artist_ids)} to refresh")
 
-    if not all_artist_ids:
-        log_event("sync_artists", "No artist IDs found to sync.")
-        return
-
-    sp = get_spotify_client()
-    artists = fetch_artists_metadata(sp, all_artist_ids)
+    if all_artist_ids:
+        sp = get_spotify_client()
+        artists = fetch_artists_metadata(sp, all_artist_ids)
+        rows = {a['id']: (a['id'], a['name'], a['genres'], a['image_url'], now) for a in artists}
+        if rows:
+            execute_values(cur, """
+                INSERT INTO artists (id, name, genres, image_url, last_checked_at)
+                VALUES %s
+                ON CONFLICT (id) DO UPDATE SET
+                    name = EXCLUDED.name,
+                    genres = EXCLUDED.genres,
+                    image_url = EXCLUDED.image_url,
+                    last_checked_at = EXCLUDED.last_checked_at;
+            """, list(rows.values()), page_size=500)
+    else:
+        artists = []
+        log_event(JOB_NAME, "No artist IDs found to sync.")
 
-    for artist in artists:
-        cur.execute("""
-            INSERT INTO artists (id, name, genres, image_url, last_checked_at)
-            VALUES (%s, %s, %s, %s, %s)
-            ON CONFLICT (id) DO UPDATE SET
-                name = EXCLUDED.name,
-                genres = EXCLUDED.genres,
-                image_url = EXCLUDED.image_url,
-                last_checked_at = EXCLUDED.last_checked_at;
-        """, (artist['id'], artist['name'], artist['genres'], artist['image_url'], now))
+    # Advance the watermarks together with the upsert
+    for table, high in watermarks.items():
+        set_state(cur, _watermark_key(table), high)
 
     conn.commit()
     cur.close()
     conn.close()
-    log_event("sync_artists", f"✔️ Synced {len(artists)} artists.")
+    log_event(JOB_NAME, f"✔️ Synced {len(artists)} artists.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    run()
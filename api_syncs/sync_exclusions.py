@@ -1,87 +1,131 @@
 import os
 import psycopg2
+from psycopg2.extras import execute_values
 from spotipy.exceptions import SpotifyException
 from utils.logger import log_event
 from utils.spotify_auth import get_spotify_client
+from utils.db_utils import get_db_connection
 
-# ─────────────────────────────────────────────
-# Get Spotify client
-# ─────────────────────────────────────────────
-sp = get_spotify_client()
+EXCLUSIONS_DDL = """
+CREATE TABLE IF NOT EXISTS excluded_tracks (track_id TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS excluded_tracks_changes (
+    id SERIAL PRIMARY KEY,
+    track_id TEXT NOT NULL,
+    change TEXT NOT NULL CHECK (change IN ('added', 'removed')),
+    snapshot_id TEXT,
+    changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_excluded_tracks_changes_changed_at ON excluded_tracks_changes (changed_at);
+"""
 
-# ─────────────────────────────────────────────
-# Connect to DB
-# ─────────────────────────────────────────────
-from utils.db_utils import get_db_connection
-conn = get_db_connection()
-cur = conn.cursor()
-
-# ─────────────────────────────────────────────
-# Get exclusion playlist ID
-# ─────────────────────────────────────────────
-cur.execute("SELECT playlist_id FROM playlist_mappings WHERE name = %s", ("exclusions",))
-row = cur.fetchone()
-if not row:
-    log_event("sync_exclusions", "❌ No 'exclusions' playlist found in playlist_mappings.")
-    exit(1)
-
-playlist_url = row[0]
-playlist_id = playlist_url.split("/")[-1].split("?")[0]
-log_event("sync_exclusions", f"🎯 Using playlist ID: {playlist_id}")
-
-playlist = sp.playlist(playlist_id)
-current_snapshot = playlist["snapshot_id"]
-log_event("sync_exclusions", f"🔍 Retrieved playlist snapshot: {current_snapshot}")
-
-cur.execute("SELECT snapshot_id FROM playlist_mappings WHERE playlist_id = %s", (playlist_url,))
-row = cur.fetchone()
-stored_snapshot = row[0] if row else None
-
-if stored_snapshot == current_snapshot:
-    log_event("sync_exclusions", "🟢 Snapshot unchanged — skipping sync.")
+
+def apply_exclusion_delta(cur, track_ids, snapshot_id):
+    """Bring excluded_tracks in line with ``track_ids`` by touching only the
+    rows that changed, and record each change in excluded_tracks_changes.
+
+    Returns (added, removed).
+    """
+    cur.execute("SELECT track_id FROM excluded_tracks")
+    current = {row[0] for row in cur.fetchall()}
+    target = set(track_ids)
+    added = sorted(target - current)
+    removed = sorted(current - target)
+
+    if removed:
+        cur.execute("DELETE FROM excluded_tracks WHERE track_id = ANY(%s)", (removed,))
+    if added:
+        execute_values(cur, "INSERT INTO excluded_tracks (track_id) VALUES %s ON CONFLICT DO NOTHING",
+                       [(track_id,) for track_id in added], page_size=1000)
+    changes = [(track_id, "added", snapshot_id) for track_id in added] + \
+              [(track_id, "removed", snapshot_id) for track_id in removed]
+    if changes:
+        execute_values(cur, "INSERT INTO excluded_tracks_changes (track_id, change, snapshot_id) VALUES %s",
+                       changes, page_size=1000)
+    return added, removed
+
+
+def run(context=None):
+    # ─────────────────────────────────────────────
+    # Get Spotify client
+    # ─────────────────────────────────────────────
+    sp = get_spotify_client()
+
+    # ─────────────────────────────────────────────
+    # Connect to DB
+    # ─────────────────────────────────────────────
+    conn = get_db_connection()
+    cur = conn.cursor()
+
+    # ─────────────────────────────────────────────
+    # Get exclusion playlist ID
+    # ─────────────────────────────────────────────
+    cur.execute("SELECT playlist_id FROM playlist_mappings WHERE name = %s", ("exclusions",))
+    row = cur.fetchone()
+    if not row:
+        log_event("sync_exclusions", "❌ No 'exclusions' playlist found in playlist_mappings.")
+        cur.close()
+        conn.close()
+        raise RuntimeError("No 'exclusions' playlist found in playlist_mappings")
+
+    playlist_url = row[0]
+    playlist_id = playlist_url.split("/")[-1].split("?")[0]
+    log_event("sync_exclusions", f"🎯 Using playlist ID: {playlist_id}")
+
+    playlist = sp.playlist(playlist_id)
+    current_snapshot = playlist["snapshot_id"]
+    log_event("sync_exclusions", f"🔍 Retrieved playlist snapshot: {current_snapshot}")
+
+    cur.execute("SELECT snapshot_id FROM playlist_mappings WHERE playlist_id = %s", (playlist_url,))
+    row = cur.fetchone()
+    stored_snapshot = row[0] if row else None
+
+    if stored_snapshot == current_snapshot:
+        log_event("sync_exclusions", "🟢 Snapshot unchanged — skipping sync.")
+        cur.close()
+        conn.close()
+        return
+
+    log_event("sync_exclusions", "📥 Fetching track IDs from Spotify...")
+
+    # ─────────────────────────────────────────────
+    # Fetch track IDs from exclusion playlist
+    # ─────────────────────────────────────────────
+    track_ids = []
+    offset = 0
+    while True:
+        results = sp.playlist_items(playlist_id, offset=offset, limit=100, fields="items.track.id,total,next", additional_types=["track"])
+        items = results.get("items", [])
+        for item in items:
+            track = item.get("track")
+            if track and track.get("id"):
+                track_ids.append(track["id"])
+        offset += len(items)
+        if not items or not results.get("next"):
+            break
+
+    log_event("sync_exclusions", f"📦 Retrieved {len(track_ids)} track(s) to exclude.")
+
+    log_event("sync_exclusions", "📤 Applying exclusion changes to database...")
+
+    # ─────────────────────────────────────────────
+    # Apply only the delta, together with the new snapshot
+    # ─────────────────────────────────────────────
+    cur.execute(EXCLUSIONS_DDL)
+    added, removed = apply_exclusion_delta(cur, track_ids, current_snapshot)
+
+    cur.execute("""
+        UPDATE playlist_mappings
+        SET snapshot_id = %s, last_synced_at = CURRENT_TIMESTAMP
+        WHERE playlist_id = %s
+    """, (current_snapshot, playlist_url))
+    conn.commit()
+
+    log_event("sync_exclusions", "📝 Updated playlist_mappings with new snapshot.")
+    log_event("sync_exclusions", f"✅ excluded_tracks updated: +{len(added)} / -{len(removed)}",
+              extra={"added": added[:50], "removed": removed[:50]})
     cur.close()
     conn.close()
-    exit(0)
-
-log_event("sync_exclusions", "📥 Fetching track IDs from Spotify...")
-
-# ─────────────────────────────────────────────
-# Fetch track IDs from exclusion playlist
-# ─────────────────────────────────────────────
-track_ids = []
-offset = 0
-while True:
-    results = sp.playlist_items(playlist_id, offset=offset, fields="items.track.id,total,next", additional_types=["track"])
-    items = results.get("items", [])
-    if not items:
-        break
-    for item in items:
-        track = item.get("track")
-        if track and track.get("id"):
-            track_ids.append(track["id"])
-    offset += len(items)
-
-log_event("sync_exclusions", f"📦 Retrieved {len(track_ids)} track(s) to exclude.")
-
-log_event("sync_exclusions", "📤 Writing excluded_tracks to database...")
-
-# ─────────────────────────────────────────────
-# Update excluded_tracks table
-# ─────────────────────────────────────────────
-cur.execute("CREATE TABLE IF NOT EXISTS excluded_tracks (track_id TEXT PRIMARY KEY)")
-cur.execute("TRUNCATE excluded_tracks")
-for track_id in track_ids:
-    cur.execute("INSERT INTO excluded_tracks (track_id) VALUES (%s)", (track_id,))
-conn.commit()
-
-cur.execute("""
-    UPDATE playlist_mappings
-    SET snapshot_id = %s, last_synced_at = CURRENT_TIMESTAMP
-    WHERE playlist_id = %s
-""", (current_snapshot, playlist_url))
-conn.commit()
-
-log_event("sync_exclusions", "📝 Updated playlist_mappings with new snapshot.")
-log_event("sync_exclusions", "✅ excluded_tracks table updated.")
-cur.close()
-conn.close()
\ No newline at end of file
+
+
+if __name__ == "__main__":
+    run()
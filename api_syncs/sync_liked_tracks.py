@@ -1,167 +1,198 @@
 import os
-import psycopg2
-import requests
 import fcntl
-import time
-from datetime import datetime, timedelta
-from spotipy import Spotify
-from spotipy.exceptions import SpotifyException
+from datetime import datetime, timedelta, timezone
 from utils.logger import log_event
 from dateutil import parser
 from utils.spotify_auth import get_spotify_client
 
 LOCK_FILE = "/tmp/sync_library.lock"
 
-def safe_spotify_call(func, *args, **kwargs):
-    retries = 0
-    while True:
+# ─────────────────────────────────────────────
+# Staging: pages are COPY'd here, then merged into liked_tracks in one statement
+# ─────────────────────────────────────────────
+STAGING_TABLE = "liked_tracks_staging"
+STAGING_COLUMNS = (
+    "track_id", "liked_at", "track_name", "track_artist", "artist_id",
+    "album_id", "duration_ms", "popularity",
+)
+STAGING_DDL = f"""
+CREATE UNLOGGED TABLE IF NOT EXISTS {STAGING_TABLE} (
+    track_id TEXT NOT NULL,
+    liked_at TIMESTAMPTZ,
+    track_name TEXT,
+    track_artist TEXT,
+    artist_id TEXT,
+    album_id TEXT,
+    duration_ms INTEGER,
+    popularity INTEGER
+);
+"""
+
+# added_at / album_in_library are resolved with a single join against albums
+MERGE_STAGED_SQL = f"""
+    INSERT INTO liked_tracks (
+        track_id, liked_at, added_at, last_checked_at,
+        track_name, track_artist, artist_id, album_id, album_in_library, duration_ms, popularity
+    )
+    SELECT DISTINCT ON (s.track_id)
+        s.track_id, s.liked_at, COALESCE(a.added_at, s.liked_at), %s,
+        s.track_name, s.track_artist, s.artist_id, s.album_id, a.id IS NOT NULL, s.duration_ms, s.popularity
+    FROM {STAGING_TABLE} s
+    LEFT JOIN albums a ON a.id = s.album_id
+    ORDER BY s.track_id, s.liked_at DESC
+    ON CONFLICT (track_id) DO UPDATE
+    SET liked_at = EXCLUDED.liked_at,
+        added_at = EXCLUDED.added_at,
+        last_checked_at = EXCLUDED.last_checked_at,
+        track_name = EXCLUDED.track_name,
+        track_artist = EXCLUDED.track_artist,
+        artist_id = EXCLUDED.artist_id,
+        album_id = EXCLUDED.album_id,
+        album_in_library = EXCLUDED.album_in_library,
+        duration_ms = EXCLUDED.duration_ms,
+        popularity = EXCLUDED.popularity;
+"""
+
+PRUNE_UNSTAGED_SQL = f"""
+    DELETE FROM liked_tracks l
+    WHERE NOT EXISTS (SELECT 1 FROM {STAGING_TABLE} s WHERE s.track_id = l.track_id);
+"""
+
+
+def ensure_staging_table(cur):
+    cur.execute(STAGING_DDL)
+    cur.execute(f"TRUNCATE {STAGING_TABLE}")
+
+
+def liked_added_at(item):
+    added_at = parser.isoparse(item['added_at'])
+    if added_at.tzinfo is None:
+        added_at = added_at.replace(tzinfo=timezone.utc)
+    return added_at
+
+
+def staging_row(item):
+    track = item['track']
+    artist = track['artists'][0]
+    return (
+        track['id'],
+        liked_added_at(item),
+        track['name'],
+        artist['name'],
+        artist['id'],
+        track['album']['id'],
+        track.get('duration_ms'),
+        track.get('popularity'),
+    )
+
+
+def stage_rows(cur, rows):
+    from utils.db_utils import copy_rows
+    return copy_rows(cur, STAGING_TABLE, STAGING_COLUMNS, rows)
+
+
+def merge_staged(cur, checked_at, prune=False):
+    """Upsert everything staged into liked_tracks; with ``prune`` also drop
+    liked tracks that were not staged (i.e. no longer liked on Spotify).
+
+    Runs inside the caller's transaction, so readers see either the old
+    liked set or the new one. Returns (upserted, removed).
+    """
+    cur.execute(MERGE_STAGED_SQL, (checked_at,))
+    upserted = cur.rowcount
+    removed = 0
+    if prune:
+        cur.execute(PRUNE_UNSTAGED_SQL)
+        removed = cur.rowcount
+    cur.execute(f"TRUNCATE {STAGING_TABLE}")
+    return upserted, removed
+
+
+def run(context=None):
+    # Acquire lock to avoid overlap
+    with open(LOCK_FILE, 'w') as lock_file:
         try:
-            return func(*args, **kwargs)
-        except SpotifyException as e:
-            if e.http_status == 429:
-                retry_after = int(e.headers.get("Retry-After", 5))
-                retries += 1
-                log_event("sync_liked_tracks", f"Rate limit hit. Retry #{retries} in {retry_after}s")
-                time.sleep(retry_after)
-            else:
-                log_event("sync_liked_tracks", f"Spotify error: {e}", level="error")
-                raise
-
-# Acquire lock to avoid overlap
-with open(LOCK_FILE, 'w') as lock_file:
-    try:
-        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
-    except BlockingIOError:
-        log_event("sync_liked_tracks", "Another sync is already running", level="warning")
-        exit(1)
-
-    sp = get_spotify_client()
-
-    from utils.db_utils import get_db_connection
-    conn = get_db_connection()
-    cur = conn.cursor()
-
-    # Compare total liked tracks between Spotify and DB
-    try:
-        spotify_total = safe_spotify_call(sp.current_user_saved_tracks, limit=1)['total']
-        cur.execute("SELECT COUNT(*) FROM liked_tracks;")
-        db_total = cur.fetchone()[0]
-        log_event("sync_liked_tracks", f"🔍 Spotify total: {spotify_total}, DB total: {db_total}")
-
-        if spotify_total == db_total:
-            log_event("sync_liked_tracks", "✅ Liked track counts match — skipping sync.")
-            cur.close()
-            conn.close()
-            exit(0)
-    except Exception as e:
-        log_event("sync_liked_tracks", f"⚠️ Failed to compare liked track counts: {e}", level="warning")
-
-    now = datetime.now(tz=None).astimezone()  # keep UTC-awareness
-    FRESH_LIKED_CUTOFF_DAYS = int(os.environ.get("FRESH_LIKED_CUTOFF_DAYS", "30"))
-    fresh_cutoff = now - timedelta(days=FRESH_LIKED_CUTOFF_DAYS)
-
-    limit = 50
-    offset = 0
-    batch_size = 50
-    counter = 0
-    liked_track_ids = set()
-    skipped_due_to_freshness = 0
-    updated_liked_tracks = 0
-
-    stop_fetching = False
-
-    log_event("sync_liked_tracks", "Starting liked tracks sync")
-
-    while True:
-        results = safe_spotify_call(sp.current_user_saved_tracks, limit=limit, offset=offset)
-        items = results['items']
-        log_event("sync_liked_tracks", f"Processing batch: offset={offset}, size={len(items)}")
-
-        if not items:
-            break
-
-        if items and parser.isoparse(items[-1]['added_at']) < fresh_cutoff:
-            stop_fetching = True
-
-        for item in items:
-            track = item['track']
-            if not track:
-                continue
-
-            track_id = track['id']
-            liked_added_at = parser.isoparse(item['added_at'])
-            if liked_added_at.tzinfo is None:
-                from datetime import timezone
-                liked_added_at = liked_added_at.replace(tzinfo=timezone.utc)
-            # Only skip tracks older than fresh_cutoff
-            if liked_added_at < fresh_cutoff:
-                continue
-            liked_track_ids.add(track_id)
-
-            track_name = track['name']
-            track_artist = track['artists'][0]['name']
-            artist_id = track['artists'][0]['id']
-            artist = track['artists'][0]['name']
-            album = track['album']['name']
-            album_id = track['album']['id']
-
-            duration_ms = track.get('duration_ms')
-            popularity = track.get('popularity')
-
-            cur.execute("SELECT added_at FROM albums WHERE id = %s", (album_id,))
-            album_row = cur.fetchone()
-            album_added_at = album_row[0] if album_row else None
-            final_added_at = album_added_at if album_added_at else liked_added_at
-
-            # Removed insertion into tracks table as per instructions
-
-            # Check if album is in library
-            cur.execute("SELECT 1 FROM albums WHERE id = %s", (album_id,))
-            album_in_library = cur.fetchone() is not None
-
-            # Insert into liked_tracks table
-            cur.execute("""
-                INSERT INTO liked_tracks (
-                    track_id, liked_at, added_at, last_checked_at,
-                    track_name, track_artist, artist_id, album_id, album_in_library, duration_ms, popularity
-                )
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT (track_id) DO UPDATE 
-                SET liked_at = EXCLUDED.liked_at,
-                    added_at = EXCLUDED.added_at,
-                    last_checked_at = EXCLUDED.last_checked_at,
-                    track_name = EXCLUDED.track_name,
-                    track_artist = EXCLUDED.track_artist,
-                    artist_id = EXCLUDED.artist_id,
-                    album_id = EXCLUDED.album_id,
-                    album_in_library = EXCLUDED.album_in_library,
-                    duration_ms = EXCLUDED.duration_ms,
-                    popularity = EXCLUDED.popularity;
-            """, (track_id, liked_added_at, final_added_at, now, track_name, track_artist, artist_id, album_id, album_in_library, duration_ms, popularity))
-
-            updated_liked_tracks += 1
-            counter += 1
-            if counter % 500 == 0:
-                log_event("sync_liked_tracks", f"Updated {counter} tracks so far")
-            if counter % batch_size == 0:
-                conn.commit()
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            log_event("sync_liked_tracks", "Another sync is already running", level="warning")
+            raise RuntimeError("Another liked tracks sync is already running")
+
+        sp = get_spotify_client()
+
+        from utils.db_utils import get_db_connection
+        conn = get_db_connection()
+        cur = conn.cursor()
+
+        # Compare total liked tracks between Spotify and DB
+        try:
+            spotify_total = sp.current_user_saved_tracks(limit=1)['total']
+            cur.execute("SELECT COUNT(*) FROM liked_tracks;")
+            db_total = cur.fetchone()[0]
+            log_event("sync_liked_tracks", f"🔍 Spotify total: {spotify_total}, DB total: {db_total}")
+
+            if spotify_total == db_total:
+                log_event("sync_liked_tracks", "✅ Liked track counts match — skipping sync.")
+                cur.close()
+                conn.close()
+                return
+        except Exception as e:
+            conn.rollback()
+            log_event("sync_liked_tracks", f"⚠️ Failed to compare liked track counts: {e}", level="warning")
+
+        now = datetime.now(tz=None).astimezone()  # keep UTC-awareness
+        FRESH_LIKED_CUTOFF_DAYS = int(os.environ.get("FRESH_LIKED_CUTOFF_DAYS", "30"))
+        fresh_cutoff = now - timedelta(days=FRESH_LIKED_CUTOFF_DAYS)
+
+        limit = 50
+        offset = 0
+        staged = 0
+        stop_fetching = False
+
+        log_event("sync_liked_tracks", "Starting liked tracks sync")
+        ensure_staging_table(cur)
+
+        # ─────────────────────────────────────────────
+        # Stream fresh likes into the staging table, one COPY per page
+        # ─────────────────────────────────────────────
+        while True:
+            results = sp.current_user_saved_tracks(limit=limit, offset=offset)
+            items = results['items']
+            log_event("sync_liked_tracks", f"Processing batch: offset={offset}, size={len(items)}")
+
+            if not items:
+                break
+
+            if liked_added_at(items[-1]) < fresh_cutoff:
+                stop_fetching = True
+
+            # Only keep tracks liked after fresh_cutoff
+            staged += stage_rows(cur, (
+                staging_row(item) for item in items
+                if item['track'] and item['track']['id'] and liked_added_at(item) >= fresh_cutoff
+            ))
+
+            if stop_fetching:
+                break
+
+            offset += len(items)
+            if len(items) < limit:
+                break
 
         if stop_fetching:
-            break
+            log_event("sync_liked_tracks", "Stopping fetch early: reached tracks older than fresh_cutoff")
 
-        offset += len(items)
-        if len(items) < limit:
-            break
+        log_event("sync_liked_tracks", f"Finished scanning liked tracks. Total staged: {staged}")
 
-    if stop_fetching:
-        log_event("sync_liked_tracks", "Stopping fetch early: reached tracks older than fresh_cutoff")
+        # ─────────────────────────────────────────────
+        # Merge staged rows into liked_tracks in one transaction
+        # ─────────────────────────────────────────────
+        upserted, _ = merge_staged(cur, now)
+        conn.commit()
+        log_event("sync_liked_tracks", f"✅ {upserted} tracks updated")
+        cur.close()
+        conn.close()
+        log_event("sync_liked_tracks", "Liked tracks sync complete")
 
-    log_event("sync_liked_tracks", f"{len(liked_track_ids)} liked tracks synced")
-    log_event("sync_liked_tracks", f"Finished scanning liked tracks. Total fetched: {counter}")
 
-    conn.commit()
-    log_event("sync_liked_tracks", f"✅ {updated_liked_tracks} tracks updated")
-    log_event("sync_liked_tracks", f"⏭️ {skipped_due_to_freshness} tracks skipped due to recent check")
-    cur.close()
-    conn.close()
-    log_event("sync_liked_tracks", "Liked tracks sync complete")
\ No newline at end of file
+if __name__ == "__main__":
+    run()
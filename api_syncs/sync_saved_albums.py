@@ -1,12 +1,5 @@
 import os
 import sys
-import psycopg2
-import requests
-import time
-from spotipy import Spotify
-from spotipy.exceptions import SpotifyException
-from dateutil import parser
-import datetime
 
 # ─────────────────────────────────────────────
 # Fix import path for utils
@@ -14,136 +7,224 @@ import datetime
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from utils.logger import log_event
 from utils.spotify_auth import get_spotify_client
-
-# ─────────────────────────────────────────────
-# Safe Spotify API Wrapper
-# ─────────────────────────────────────────────
-def safe_spotify_call(func, *args, **kwargs):
-    retries = 0
+from utils.db_utils import get_db_connection, copy_rows
+from utils.sync_state import ensure_sync_state, get_state, set_state, clear_state
+
+JOB_NAME = "sync_saved_albums"
+# Resumable progress: next page offset and the Spotify total it was computed against
+OFFSET_KEY = "sync_saved_albums.offset"
+TOTAL_KEY = "sync_saved_albums.total"
+# Stop after this many pages per run and resume next time (0 = fetch everything)
+MAX_PAGES_PER_RUN = int(os.getenv("SAVED_ALBUMS_MAX_PAGES", "0"))
+
+STAGING_TABLE = "saved_albums_staging"
+STAGING_COLUMNS = (
+    "id", "name", "artist", "artist_id", "release_date", "total_tracks",
+    "added_at", "album_type", "album_image_url",
+)
+STAGING_DDL = f"""
+CREATE UNLOGGED TABLE IF NOT EXISTS {STAGING_TABLE} (
+    id TEXT NOT NULL,
+    name TEXT,
+    artist TEXT,
+    artist_id TEXT,
+    release_date TEXT,
+    total_tracks INTEGER,
+    added_at TIMESTAMP,
+    album_type TEXT,
+    album_image_url TEXT
+);
+"""
+
+
+def staging_row(item):
+    album = item['album']
+    return (
+        album['id'],
+        album['name'],
+        album['artists'][0]['name'],
+        album['artists'][0]['id'],
+        album.get('release_date'),
+        album.get('total_tracks'),
+        item.get('added_at'),
+        album.get('album_type'),
+        album['images'][0]['url'] if album.get('images') else None,
+    )
+
+
+def reconcile(cur):
+    """Apply the staged library to albums in set-based statements.
+
+    Returns (upserted, unsaved, deleted_albums, deleted_tracks, deleted_liked).
+    """
+    cur.execute(f"""
+        INSERT INTO albums (id, name, artist, artist_id, release_date, total_tracks, is_saved, added_at, tracks_synced, album_type, album_image_url)
+        SELECT DISTINCT ON (id) id, name, artist, artist_id, release_date, total_tracks, TRUE, added_at, FALSE, album_type, album_image_url
+        FROM {STAGING_TABLE}
+        ORDER BY id, added_at DESC
+        ON CONFLICT (id) DO UPDATE
+        SET is_saved = TRUE,
+            added_at = EXCLUDED.added_at,
+            artist_id = EXCLUDED.artist_id,
+            album_type = EXCLUDED.album_type,
+            album_image_url = EXCLUDED.album_image_url;
+    """)
+    upserted = cur.rowcount
+
+    # Anti-join: anything not in the staged library is no longer saved
+    cur.execute(f"""
+        UPDATE albums a
+        SET is_saved = FALSE, tracks_synced = FALSE
+        WHERE NOT EXISTS (SELECT 1 FROM {STAGING_TABLE} s WHERE s.id = a.id)
+          AND (a.is_saved IS DISTINCT FROM FALSE OR a.tracks_synced IS DISTINCT FROM FALSE)
+    """)
+    unsaved = cur.rowcount
+
+    # Cleanup of unsaved albums and the tracks that came from them
+    cur.execute("""
+        DELETE FROM liked_tracks l
+        USING tracks t, albums a
+        WHERE l.track_id = t.id
+          AND a.id = t.album_id
+          AND t.from_album = TRUE
+          AND a.is_saved = FALSE
+    """)
+    deleted_liked = cur.rowcount
+    cur.execute("""
+        DELETE FROM tracks t
+        USING albums a
+        WHERE a.id = t.album_id
+          AND t.from_album = TRUE
+          AND a.is_saved = FALSE
+    """)
+    deleted_tracks = cur.rowcount
+    cur.execute("DELETE FROM albums WHERE is_saved = FALSE")
+    deleted_albums = cur.rowcount
+    return upserted, unsaved, deleted_albums, deleted_tracks, deleted_liked
+
+
+def run(context=None):
+    # ─────────────────────────────────────────────
+    # Setup Spotify + DB connections
+    # ─────────────────────────────────────────────
+    sp = get_spotify_client()
+
+    conn = get_db_connection()
+
+    cur = conn.cursor()
+    ensure_sync_state(cur)
+    cur.execute(STAGING_DDL)
+    conn.commit()
+
+    limit = 50
+
+    log_event(JOB_NAME, "Starting saved albums sync")
+
+    # ─────────────────────────────────────────────
+    # Check Spotify and local saved album counts, exit early if up to date
+    # ─────────────────────────────────────────────
+    initial_result = sp.current_user_saved_albums(limit=1)
+    spotify_total = initial_result['total']
+    log_event(JOB_NAME, f"📊 Spotify reports {spotify_total} saved albums")
+
+    cur.execute("SELECT COUNT(*) FROM albums WHERE is_saved = TRUE")
+    local_total = cur.fetchone()[0]
+    log_event(JOB_NAME, f"📁 Local DB has {local_total} saved albums")
+
+    stored_offset = get_state(cur, OFFSET_KEY)
+    stored_total = get_state(cur, TOTAL_KEY)
+
+    if spotify_total == local_total and stored_offset is None:
+        log_event(JOB_NAME, "✅ Saved albums are up to date — skipping sync.")
+        cur.close()
+        conn.close()
+        return
+
+    # ─────────────────────────────────────────────
+    # Resume a partial run if the library has not changed size since
+    # ─────────────────────────────────────────────
+    cur.execute(f"SELECT EXISTS (SELECT 1 FROM {STAGING_TABLE})")
+    staging_has_rows = cur.fetchone()[0]
+    if (stored_offset is not None and stored_total == str(spotify_total)
+            and (staging_has_rows or int(stored_offset) == 0)):
+        offset = int(stored_offset)
+        log_event(JOB_NAME, f"⏯️ Resuming saved albums sync at offset {offset}")
+    else:
+        if stored_offset is not None and not staging_has_rows:
+            # UNLOGGED staging is emptied by crash recovery while the logged offset survives
+            log_event(JOB_NAME, "⚠️ Staged albums were lost since the last run — restarting from offset 0",
+                      level="warning")
+        offset = 0
+        cur.execute(f"TRUNCATE {STAGING_TABLE}")
+        set_state(cur, TOTAL_KEY, spotify_total)
+        set_state(cur, OFFSET_KEY, offset)
+        conn.commit()
+
+    # ─────────────────────────────────────────────
+    # Stream saved album pages into staging; progress is committed per page
+    # ─────────────────────────────────────────────
+    pages = 0
+    complete = False
     while True:
-        try:
-            return func(*args, **kwargs)
-        except SpotifyException as e:
-            if e.http_status == 429:
-                retry_after = int(e.headers.get("Retry-After", 5))
-                retries += 1
-                log_event("sync_saved_albums", f"Rate limit hit. Retry #{retries} in {retry_after}s")
-                time.sleep(retry_after)
-            else:
-                log_event("sync_saved_albums", f"Spotify error: {e}", level="error")
-                raise
-
-# ─────────────────────────────────────────────
-# Setup Spotify + DB connections
-# ─────────────────────────────────────────────
-sp = get_spotify_client()
-
-from utils.db_utils import get_db_connection
-
-conn = get_db_connection()
-
-cur = conn.cursor()
-
-limit = 50
-offset = 0
-current_album_ids = set()
-
-log_event("sync_saved_albums", "Starting saved albums sync")
-
-# ─────────────────────────────────────────────
-# Check Spotify and local saved album counts, exit early if up to date
-# ─────────────────────────────────────────────
-initial_result = safe_spotify_call(sp.current_user_saved_albums, limit=1)
-spotify_total = initial_result['total']
-log_event("sync_saved_albums", f"📊 Spotify reports {spotify_total} saved albums")
-
-cur.execute("SELECT COUNT(*) FROM albums WHERE is_saved = TRUE")
-local_total = cur.fetchone()[0]
-log_event("sync_saved_albums", f"📁 Local DB has {local_total} saved albums")
-
-if spotify_total == local_total:
-    log_event("sync_saved_albums", "✅ Saved albums are up to date — skipping sync.")
+        if MAX_PAGES_PER_RUN and pages >= MAX_PAGES_PER_RUN:
+            break
+        results = sp.current_user_saved_albums(limit=limit, offset=offset)
+        items = results['items']
+        if not items:
+            complete = True
+            break
+
+        copy_rows(cur, STAGING_TABLE, STAGING_COLUMNS, (staging_row(item) for item in items if item.get('album')))
+        offset += len(items)
+        pages += 1
+        set_state(cur, OFFSET_KEY, offset)
+        conn.commit()
+
+        if len(items) < limit:
+            complete = True
+            break
+
+    if not complete:
+        log_event(JOB_NAME, f"⏸️ Stopped after {pages} page(s) at offset {offset}; will resume next run")
+        cur.close()
+        conn.close()
+        return
+
+    cur.execute(f"SELECT COUNT(DISTINCT id) FROM {STAGING_TABLE}")
+    staged = cur.fetchone()[0]
+    log_event(JOB_NAME, f"{staged} saved albums staged")
+
+    # Re-read: albums saved or removed mid-scan shift the offsets of a resumed run
+    spotify_total = sp.current_user_saved_albums(limit=1)['total']
+    if staged < spotify_total:
+        # An incomplete staging set would unsave (and delete) every album missing from it
+        log_event(JOB_NAME, f"⚠️ Only {staged} of {spotify_total} saved albums staged — skipping reconcile, "
+                            f"next run rescans from offset 0", level="warning")
+        cur.execute(f"TRUNCATE {STAGING_TABLE}")
+        clear_state(cur, OFFSET_KEY)
+        clear_state(cur, TOTAL_KEY)
+        conn.commit()
+        cur.close()
+        conn.close()
+        return
+
+    # ─────────────────────────────────────────────
+    # Upsert, mark removed albums & cleanup in one transaction
+    # ─────────────────────────────────────────────
+    upserted, unsaved, deleted_albums, deleted_tracks, deleted_liked = reconcile(cur)
+    cur.execute(f"TRUNCATE {STAGING_TABLE}")
+    clear_state(cur, OFFSET_KEY)
+    clear_state(cur, TOTAL_KEY)
+    conn.commit()
     cur.close()
     conn.close()
-    sys.exit(0)
-
-# ─────────────────────────────────────────────
-# Sync saved albums from Spotify
-# ─────────────────────────────────────────────
-while True:
-    results = safe_spotify_call(sp.current_user_saved_albums, limit=limit, offset=offset)
-    items = results['items']
-    if not items:
-        break
-
-    for item in items:
-        album = item['album']
-        album_id = album['id']
-        current_album_ids.add(album_id)
-        added_at = item.get('added_at')
-
-        # Extract new album data
-        album_type = album.get('album_type')
-        album_image_url = album['images'][0]['url'] if album.get('images') else None
-        artist_id = album['artists'][0]['id']
-
-        cur.execute("""
-            INSERT INTO albums (id, name, artist, artist_id, release_date, total_tracks, is_saved, added_at, tracks_synced, album_type, album_image_url)
-            VALUES (%s, %s, %s, %s, %s, %s, TRUE, %s, FALSE, %s, %s)
-            ON CONFLICT (id) DO UPDATE
-            SET is_saved = TRUE,
-                added_at = EXCLUDED.added_at,
-                artist_id = EXCLUDED.artist_id,
-                album_type = EXCLUDED.album_type,
-                album_image_url = EXCLUDED.album_image_url;
-        """, (
-            album_id,
-            album['name'],
-            album['artists'][0]['name'],
-            artist_id,
-            album.get('release_date'),
-            album.get('total_tracks'),
-            added_at,
-            album_type,
-            album_image_url
-        ))
-
-    offset += len(items)
-    if len(items) < limit:
-        break
-
-log_event("sync_saved_albums", f"{len(current_album_ids)} saved albums synced")
 
-# ─────────────────────────────────────────────
-# Mark removed albums & cleanup
-# ─────────────────────────────────────────────
-cur.execute("""
-    UPDATE albums 
-    SET is_saved = FALSE, tracks_synced = FALSE 
-    WHERE id NOT IN %s
-""", (tuple(current_album_ids),))
-
-log_event("sync_saved_albums", "Cleaning up removed albums with no valid tracks")
-cur.execute("""
-    SELECT id FROM albums
-    WHERE is_saved = FALSE
-      AND id NOT IN (SELECT DISTINCT album_id FROM tracks WHERE from_album = TRUE)
-""")
-albums_to_remove = cur.fetchall()
-
-for (album_id,) in albums_to_remove:
-    log_event("sync_saved_albums", f"Removing album and orphaned tracks: {album_id}")
-    cur.execute("""
-        DELETE FROM tracks
-        WHERE album_id = %s AND from_album = TRUE
-    """, (album_id,))
-    cur.execute("""
-        DELETE FROM albums
-        WHERE id = %s
-    """, (album_id,))
+    log_event(JOB_NAME, f"{upserted} saved albums synced, {unsaved} no longer saved")
+    if deleted_albums:
+        log_event(JOB_NAME, f"Removed {deleted_albums} unsaved album(s), {deleted_tracks} album track(s) "
+                            f"and {deleted_liked} associated liked track(s)")
+    log_event(JOB_NAME, "Saved albums sync complete")
 
-conn.commit()
-cur.close()
-conn.close()
 
-log_event("sync_saved_albums", "Saved albums sync complete")
+if __name__ == "__main__":
+    run()
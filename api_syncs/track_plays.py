@@ -1,92 +1,141 @@
 import os
 import sys
-import time
-import requests
-import psycopg2
-from spotipy import Spotify
-from spotipy.exceptions import SpotifyException
-from datetime import datetime
+from dateutil import parser
+from psycopg2.extras import execute_values
 
 # ─────────────────────────────────────────────
 # Ensure utils is in path
 # ─────────────────────────────────────────────
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from utils.logger import log_event
-
-# ─────────────────────────────────────────────
-# Safe Spotify API Wrapper
-# ─────────────────────────────────────────────
-def safe_spotify_call(func, *args, **kwargs):
-    retries = 0
-    while True:
-        try:
-            return func(*args, **kwargs)
-        except SpotifyException as e:
-            if e.http_status == 429:
-                retry_after = int(e.headers.get("Retry-After", 5))
-                retries += 1
-                log_event("track_plays", f"Rate limit hit. Retry #{retries} in {retry_after}s")
-                time.sleep(retry_after)
-            else:
-                log_event("track_plays", f"Spotify error: {e}", level="error")
-                raise
-        except requests.exceptions.ReadTimeout as e:
-            retries += 1
-            log_event("track_plays", f"Timeout hit. Retry #{retries} in 5s... ({e})")
-            time.sleep(5)
-
-# ─────────────────────────────────────────────
-# Setup Spotify client
-# ─────────────────────────────────────────────
 from utils.spotify_auth import get_spotify_client
-sp = get_spotify_client()
-
-# ─────────────────────────────────────────────
-# Connect to PostgreSQL
-# ─────────────────────────────────────────────
 from utils.db_utils import get_db_connection
+from utils.sync_state import ensure_sync_state, get_state, set_state
+from utils.play_partitions import ensure_play_partitions
 
-conn = get_db_connection()
-cur = conn.cursor()
+JOB_NAME = "track_plays"
+# High-water mark: played_at (epoch ms) of the newest play already stored
+STATE_KEY = "track_plays.after_ms"
+PAGE_LIMIT = 50  # Spotify max for /me/player/recently-played
+# Safety stop for the `after` paging loop
+MAX_PAGES = int(os.getenv("TRACK_PLAYS_MAX_PAGES", "20"))
 
-# ─────────────────────────────────────────────
-# Sync recently played tracks
-# ─────────────────────────────────────────────
-log_event("track_plays", "Tracking recently played tracks")
-results = safe_spotify_call(sp.current_user_recently_played, limit=50)
-recent_plays = results["items"]
 
-new_count = 0
-for item in recent_plays:
+def _played_at_ms(item):
+    return int(parser.isoparse(item["played_at"]).timestamp() * 1000)
+
+
+def play_row(item):
     track = item["track"]
-    track_id = track["id"]
-    played_at = item["played_at"]
-    from dateutil import parser
-    played_at_dt = parser.isoparse(played_at)
-
-    # Extract additional fields
-    track_name = track["name"]
-    artist_id = track["artists"][0]["id"] if track["artists"] else None
-    artist_name = track["artists"][0]["name"] if track["artists"] else None
-    duration_ms = track.get("duration_ms")
-    album_id = track["album"]["id"] if track.get("album") else None
-    album_name = track["album"]["name"] if track.get("album") else None
-    album_type = track["album"]["album_type"] if track.get("album") else None
-
-    cur.execute("SELECT 1 FROM plays WHERE track_id = %s AND played_at = %s", (track_id, played_at_dt))
-    if cur.fetchone():
-        continue
-
-    cur.execute("""
-        INSERT INTO plays (track_id, played_at, track_name, artist_id, artist_name, duration_ms, album_id, album_name, album_type)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-        ON CONFLICT (track_id, played_at) DO NOTHING;
-    """, (track_id, played_at_dt, track_name, artist_id, artist_name, duration_ms, album_id, album_name, album_type))
-    new_count += 1
-    time.sleep(0.1)  # optional light throttle
-
-conn.commit()
-cur.close()
-conn.close()
-
-log_event("track_plays", f"Tracked recent plays. New entries: {new_count}")
+    album = track.get("album") or {}
+    artists = track.get("artists") or []
+    return (
+        track["id"],
+        parser.isoparse(item["played_at"]),
+        track["name"],
+        artists[0]["id"] if artists else None,
+        artists[0]["name"] if artists else None,
+        track.get("duration_ms"),
+        album.get("id"),
+        album.get("name"),
+        album.get("album_type"),
+    )
+
+
+def get_high_water_mark(cur):
+    value = get_state(cur, STATE_KEY)
+    if value is not None:
+        return int(value)
+    # First run with a cursor: start from the newest play already stored
+    cur.execute("SELECT (EXTRACT(EPOCH FROM MAX(played_at) AT TIME ZONE 'UTC') * 1000)::BIGINT FROM plays")
+    return cur.fetchone()[0]
+
+
+def fetch_new_plays(sp, after_ms):
+    """Fetch plays newer than ``after_ms`` using the API's ``after`` cursor.
+
+    Returns (items, first_page_full). Spotify only keeps the last 50 plays,
+    so a full first page means older plays may already have aged out.
+    """
+    items = []
+    cursor = after_ms
+    first_page_full = False
+    for page_number in range(MAX_PAGES):
+        if cursor is None:
+            page = sp.current_user_recently_played(limit=PAGE_LIMIT)
+        else:
+            page = sp.current_user_recently_played(limit=PAGE_LIMIT, after=cursor)
+        batch = page.get("items") or []
+        if page_number == 0:
+            first_page_full = len(batch) >= PAGE_LIMIT
+        items.extend(batch)
+
+        next_after = (page.get("cursors") or {}).get("after")
+        if len(batch) < PAGE_LIMIT or not next_after or (cursor is not None and int(next_after) <= cursor):
+            break
+        cursor = int(next_after)
+    return items, first_page_full
+
+
+def report_possible_gap(after_ms, items, first_page_full):
+    """Warn when the stored mark is older than the API window can reach."""
+    if after_ms is None or not items or not first_page_full:
+        return
+    oldest_ms = min(_played_at_ms(item) for item in items)
+    gap_ms = oldest_ms - after_ms
+    if gap_ms <= 0:
+        return
+    durations = [item["track"].get("duration_ms") for item in items if item["track"].get("duration_ms")]
+    avg_duration_ms = sum(durations) / len(durations) if durations else 210_000
+    missed = int(gap_ms // avg_duration_ms)
+    log_event(JOB_NAME, f"⚠️ Recently-played window overflowed: {gap_ms / 60000:.0f} min between the last stored "
+                        f"play and the oldest available one; up to ~{missed} play(s) may have been missed",
+              level="warning", extra={"after_ms": after_ms, "oldest_ms": oldest_ms, "estimated_missed": missed})
+
+
+def run(context=None):
+    sp = get_spotify_client()
+    conn = get_db_connection()
+    cur = conn.cursor()
+    ensure_sync_state(cur)
+    # Current month partition (and the next few) before anything is inserted
+    ensure_play_partitions(cur, tables=("plays",))
+
+    # ─────────────────────────────────────────────
+    # Fetch only plays newer than the high-water mark
+    # ─────────────────────────────────────────────
+    after_ms = get_high_water_mark(cur)
+    log_event(JOB_NAME, f"Tracking recently played tracks after {after_ms}")
+    items, first_page_full = fetch_new_plays(sp, after_ms)
+    items = [item for item in items if item.get("track") and item["track"].get("id")]
+    report_possible_gap(after_ms, items, first_page_full)
+
+    # ─────────────────────────────────────────────
+    # One multi-row insert; duplicates are skipped by the unique key
+    # ─────────────────────────────────────────────
+    rows = {}
+    for item in items:
+        row = play_row(item)
+        rows[(row[0], row[1])] = row
+
+    inserted = []
+    if rows:
+        inserted = execute_values(cur, """
+            INSERT INTO plays (track_id, played_at, track_name, artist_id, artist_name, duration_ms, album_id, album_name, album_type)
+            VALUES %s
+            ON CONFLICT (track_id, played_at) DO NOTHING
+            RETURNING id
+        """, list(rows.values()), page_size=1000, fetch=True)
+
+    if items:
+        newest_ms = max(_played_at_ms(item) for item in items)
+        set_state(cur, STATE_KEY, max(newest_ms, after_ms or 0))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+    log_event(JOB_NAME, f"Tracked recent plays. Fetched: {len(items)}, new entries: {len(inserted)}")
+
+
+if __name__ == "__main__":
+    run()
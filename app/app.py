@@ -232,13 +232,22 @@ def view_logs():
 
     # Parse query parameters
     script = request.args.get("script")
-    level = request.args.get("level")
+    level = (request.args.get("level") or "").lower() or None
     sort = request.args.get("sort", "desc").lower()
     if sort not in ("asc", "desc"):
         sort = "desc"
-    page = int(request.args.get("page", 1))
+    # Keyset cursor "<timestamp>|<id>" of the last row on the previous page (after)
+    # or the first row of the next page (before)
+    after = request.args.get("after")
+    before = request.args.get("before")
     page_size = 50
-    offset = (page - 1) * page_size
+
+    def parse_cursor(value):
+        try:
+            ts, row_id = value.rsplit("|", 1)
+            return ts, int(row_id)
+        except (AttributeError, ValueError):
+            return None
 
     try:
         conn = get_db_connection()
@@ -255,22 +264,55 @@ def view_logs():
             where_clauses.append("level = %s")
             params.append(level)
 
+        # Walking backwards (Previous) flips both the comparison and the order
+        backwards = parse_cursor(before) is not None
+        cursor = parse_cursor(before) if backwards else parse_cursor(after)
+        descending = (sort == "desc") != backwards
+        if cursor:
+            where_clauses.append(f"(timestamp, id) {'<' if descending else '>'} (%s::timestamptz, %s)")
+            params.extend(cursor)
+
         where_sql = "WHERE " + " AND ".join(where_clauses) if where_clauses else ""
+        direction = "DESC" if descending else "ASC"
         query = f"""
-            SELECT timestamp, source, level, message
+            SELECT id, timestamp, source, level, message
             FROM logs
             {where_sql}
-            ORDER BY timestamp {sort.upper()}
-            LIMIT {page_size} OFFSET {offset}
+            ORDER BY timestamp {direction}, id {direction}
+            LIMIT {page_size + 1}
         """
 
         cur.execute(query, tuple(params))
         rows = cur.fetchall()
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        if backwards:
+            rows.reverse()
+
+        # Matching row count from the rollup instead of COUNT(*) over logs
+        count_clauses = []
+        count_params = []
+        if script:
+            count_clauses.append("source = %s")
+            count_params.append(script)
+        if level:
+            count_clauses.append("level = %s")
+            count_params.append(level)
+        count_where = "WHERE " + " AND ".join(count_clauses) if count_clauses else ""
+        cur.execute(f"""
+            SELECT source, level, count, last_at
+            FROM log_counts
+            {count_where}
+            ORDER BY count DESC
+        """, tuple(count_params))
+        counts = cur.fetchall()
         cur.close()
         conn.close()
     except Exception as e:
         return f"<pre>❌ DB Error: {e}</pre>"
 
+    total = sum(row[2] for row in counts)
+
     # Build next and previous page URLs
     base_params = {}
     if script:
@@ -280,15 +322,21 @@ def view_logs():
     if sort:
         base_params['sort'] = sort
 
-    next_params = base_params.copy()
-    next_params['page'] = page + 1
-    next_url = url_for('view_logs') + '?' + urlencode(next_params)
-
-    prev_params = base_params.copy()
-    prev_params['page'] = max(page - 1, 1)
-    prev_url = url_for('view_logs') + '?' + urlencode(prev_params)
-
-    return render_template("logs.html", rows=rows, page=page, script=script, level=level, sort=sort, next_url=next_url, prev_url=prev_url)
+    def cursor_of(row):
+        return f"{row[1].isoformat()}|{row[0]}"
+
+    # Coming from a later page there is always a Next; from an earlier one, always a Previous
+    has_next = backwards or has_more
+    has_prev = has_more if backwards else cursor is not None
+    next_url = prev_url = None
+    if rows and has_next:
+        next_url = url_for('view_logs') + '?' + urlencode({**base_params, 'after': cursor_of(rows[-1])})
+    if rows and has_prev:
+        prev_url = url_for('view_logs') + '?' + urlencode({**base_params, 'before': cursor_of(rows[0])})
+
+    rows = [row[1:] for row in rows]
+    return render_template("logs.html", rows=rows, script=script, level=level, sort=sort,
+                           next_url=next_url, prev_url=prev_url, counts=counts, total=total)
 
 @app.route("/logout")
 def logout():
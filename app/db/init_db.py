@@ -1,6 +1,10 @@
 import os
 import psycopg2
 from utils.db_utils import get_db_connection
+from utils.sync_state import ensure_sync_state
+from utils.match_keys import ensure_match_keys
+from utils.play_partitions import ensure_partitioned_play_table
+from utils.play_fingerprint import ensure_play_fingerprint
 
 def run_init_db():
     # Connect to PostgreSQL
@@ -95,29 +99,9 @@ def run_init_db():
             cur.execute(f"ALTER TABLE tracks ADD COLUMN {col_name} {col_type};")
 
     # ─────────────────────────────────────────────
-    # Plays table
+    # Plays table (monthly partitions on played_at, see utils/play_partitions.py)
     # ─────────────────────────────────────────────
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS plays (
-        id SERIAL PRIMARY KEY,
-        track_id TEXT,
-        played_at TIMESTAMP,
-        track_name TEXT,
-        artist_id TEXT,
-        duration_ms INTEGER,
-        artist_name TEXT,
-        album_id TEXT,
-        album_name TEXT,
-        album_type TEXT,
-        checked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        UNIQUE(track_id, played_at)
-    );
-    """)
-
-    # Explicitly create a named unique index
-    cur.execute("""
-    CREATE UNIQUE INDEX IF NOT EXISTS idx_plays_unique ON plays (track_id, played_at);
-    """)
+    ensure_partitioned_play_table(cur, "plays")
 
     # Ensure all expected columns exist in the plays table
     expected_play_columns = {
@@ -144,27 +128,7 @@ def run_init_db():
     # ─────────────────────────────────────────────
     # Spotify play history table (same schema as plays; optional import target)
     # ─────────────────────────────────────────────
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS spotify_play_history (
-        id SERIAL PRIMARY KEY,
-        track_id TEXT,
-        played_at TIMESTAMP,
-        track_name TEXT,
-        artist_id TEXT,
-        duration_ms INTEGER,
-        artist_name TEXT,
-        album_id TEXT,
-        album_name TEXT,
-        album_type TEXT,
-        checked_at TIMESTAMP,
-        UNIQUE(track_id, played_at)
-    );
-    """)
-
-    # Explicitly create a named unique index to mirror plays
-    cur.execute("""
-    CREATE UNIQUE INDEX IF NOT EXISTS idx_spotify_play_history_unique ON spotify_play_history (track_id, played_at);
-    """)
+    ensure_partitioned_play_table(cur, "spotify_play_history")
 
     # Ensure all expected columns exist in the spotify_play_history table
     expected_history_columns = {
@@ -189,25 +153,19 @@ def run_init_db():
             print(f"🛠 Adding missing column to spotify_play_history: {col_name}")
             cur.execute(f"ALTER TABLE spotify_play_history ADD COLUMN {col_name} {col_type};")
 
-    # ─────────────────────────────────────────────
-    # Apple Music play history table (mirror of spotify_play_history)
-    # ─────────────────────────────────────────────
+    # Track ids imported without metadata, drained by backfill_spotify_play_history.py
     cur.execute("""
-    CREATE TABLE IF NOT EXISTS apple_music_play_history (
-        id SERIAL PRIMARY KEY,
-        track_id TEXT,
-        played_at TIMESTAMP,
-        track_name TEXT,
-        artist_id TEXT,
-        duration_ms INTEGER,
-        artist_name TEXT,
-        album_id TEXT,
-        album_name TEXT,
-        album_type TEXT,
-        checked_at TIMESTAMP
+    CREATE TABLE IF NOT EXISTS spotify_play_history_pending_tracks (
+        track_id TEXT PRIMARY KEY,
+        queued_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
     );
     """)
 
+    # ─────────────────────────────────────────────
+    # Apple Music play history table (mirror of spotify_play_history)
+    # ─────────────────────────────────────────────
+    ensure_partitioned_play_table(cur, "apple_music_play_history")
+
     # Ensure all expected columns exist in the apple_music_play_history table
     expected_apple_history_columns = {
         "id": "SERIAL",
@@ -231,6 +189,9 @@ def run_init_db():
             print(f"🛠 Adding missing column to apple_music_play_history: {col_name}")
             cur.execute(f"ALTER TABLE apple_music_play_history ADD COLUMN {col_name} {col_type};")
 
+    # One row per play: unique fingerprint (see utils/play_fingerprint.py)
+    ensure_play_fingerprint(cur)
+
 
 
     # ─────────────────────────────────────────────
@@ -247,7 +208,8 @@ def run_init_db():
         rules JSONB,
         is_dynamic BOOLEAN DEFAULT TRUE,
         snapshot_id TEXT,
-        last_synced_hash TEXT
+        last_synced_hash TEXT,
+        last_synced_uris TEXT[]
     );
     """)
 
@@ -263,6 +225,7 @@ def run_init_db():
         "is_dynamic": "BOOLEAN DEFAULT TRUE",
         "snapshot_id": "TEXT",
         "last_synced_hash": "TEXT",
+        "last_synced_uris": "TEXT[]",
         "pending_delete": "BOOLEAN DEFAULT FALSE",
         "missing_count": "INTEGER DEFAULT 0",
         "last_seen_spotify_at": "TIMESTAMP",
@@ -350,6 +313,18 @@ def run_init_db():
     );
     """)
 
+    # Added/removed ids per exclusions sync, for consumers that refresh only affected tracks
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS excluded_tracks_changes (
+        id SERIAL PRIMARY KEY,
+        track_id TEXT NOT NULL,
+        change TEXT NOT NULL CHECK (change IN ('added', 'removed')),
+        snapshot_id TEXT,
+        changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_excluded_tracks_changes_changed_at ON excluded_tracks_changes (changed_at);")
+
 
 
     # ─────────────────────────────────────────────
@@ -412,6 +387,78 @@ def run_init_db():
     );
     """)
 
+    # Keyset pagination on (timestamp, id), optionally filtered by source and/or level
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_logs_ts_id ON logs (timestamp, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_logs_source_ts_id ON logs (source, timestamp, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_logs_level_ts_id ON logs (level, timestamp, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_logs_source_level_ts_id ON logs (source, level, timestamp, id)")
+
+    # ─────────────────────────────────────────────
+    # Per-source/per-level log counts (rollup maintained by trigger)
+    # ─────────────────────────────────────────────
+    cur.execute("SELECT to_regclass('log_counts') IS NOT NULL")
+    log_counts_existed = cur.fetchone()[0]
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS log_counts (
+        source TEXT NOT NULL,
+        level TEXT NOT NULL,
+        count BIGINT NOT NULL DEFAULT 0,
+        last_at TIMESTAMPTZ,
+        PRIMARY KEY (source, level)
+    );
+    """)
+    cur.execute("""
+    CREATE OR REPLACE FUNCTION log_counts_apply() RETURNS trigger
+    LANGUAGE plpgsql AS $fn$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO log_counts (source, level, count, last_at)
+            SELECT source, COALESCE(level, ''), COUNT(*), MAX(timestamp)
+            FROM new_rows
+            GROUP BY source, COALESCE(level, '')
+            ON CONFLICT (source, level) DO UPDATE
+            SET count = log_counts.count + EXCLUDED.count,
+                last_at = GREATEST(log_counts.last_at, EXCLUDED.last_at);
+        ELSIF TG_OP = 'DELETE' THEN
+            UPDATE log_counts lc
+            SET count = GREATEST(lc.count - d.n, 0)
+            FROM (
+                SELECT source, COALESCE(level, '') AS level, COUNT(*) AS n
+                FROM old_rows
+                GROUP BY source, COALESCE(level, '')
+            ) d
+            WHERE lc.source = d.source AND lc.level = d.level;
+        ELSE
+            DELETE FROM log_counts;
+        END IF;
+        RETURN NULL;
+    END
+    $fn$;
+    """)
+    cur.execute("""
+    DROP TRIGGER IF EXISTS log_counts_ins ON logs;
+    CREATE TRIGGER log_counts_ins AFTER INSERT ON logs
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION log_counts_apply();
+    DROP TRIGGER IF EXISTS log_counts_del ON logs;
+    CREATE TRIGGER log_counts_del AFTER DELETE ON logs
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION log_counts_apply();
+    DROP TRIGGER IF EXISTS log_counts_trunc ON logs;
+    CREATE TRIGGER log_counts_trunc AFTER TRUNCATE ON logs
+        FOR EACH STATEMENT EXECUTE FUNCTION log_counts_apply();
+    """)
+    if not log_counts_existed:
+        # One-time backfill; the triggers keep it current from here on
+        cur.execute("""
+        INSERT INTO log_counts (source, level, count, last_at)
+        SELECT source, COALESCE(level, ''), COUNT(*), MAX(timestamp)
+        FROM logs
+        GROUP BY source, COALESCE(level, '')
+        ON CONFLICT (source, level) DO UPDATE
+        SET count = EXCLUDED.count, last_at = EXCLUDED.last_at
+        """)
+
     # ─────────────────────────────────────────────
     # Canonical album matches table
     # ─────────────────────────────────────────────
@@ -490,16 +537,39 @@ def run_init_db():
     );
     """)
 
+    # ─────────────────────────────────────────────
+    # Fuzzy match keys on tracks and play sources (see utils/match_keys.py)
+    # ─────────────────────────────────────────────
+    ensure_match_keys(cur)
+
+    # ─────────────────────────────────────────────
+    # Job cursors / high-water marks (see utils/sync_state.py)
+    # ─────────────────────────────────────────────
+    ensure_sync_state(cur)
+
+    # ─────────────────────────────────────────────
+    # Spotify access token cache (opt-in via SPOTIFY_TOKEN_DB_CACHE)
+    # Keyed by a hash of the refresh token, never the token itself
+    # ─────────────────────────────────────────────
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS spotify_token_cache (
+        cache_key TEXT PRIMARY KEY,
+        access_token TEXT NOT NULL,
+        expires_at TIMESTAMPTZ NOT NULL,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    );
+    """)
+
     conn.commit()
     cur.close()
     conn.close()
 
-    # Build the unified_tracks materialized view
-    import subprocess
-    subprocess.run(["python", "-m", "api_syncs.materialized_views"], check=True)
-
-    # Build the daily_metrics_cache table
-    subprocess.run(["python", "-m", "api_syncs.materialized_metrics"], check=True)
+    # Rebuild unified_plays_mv (a play-table migration drops it), then unified_tracks
+    # and the daily_metrics_cache table (in-process)
+    from utils.pipeline import run_job
+    run_job("materialized_plays")
+    run_job("materialized_views")
+    run_job("materialized_metrics")
 
     print("✅ Tables created and updated successfully.")
 
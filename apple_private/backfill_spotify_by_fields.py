@@ -33,7 +33,6 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 import psycopg2
 from psycopg2.extras import execute_values
 from spotipy import Spotify
-from spotipy.exceptions import SpotifyException
 from utils.db_utils import get_db_connection
 from utils.spotify_auth import get_spotify_client
 from utils.logger import log_event
@@ -120,34 +119,6 @@ def build_query(title: str, artist: str, album: Optional[str]) -> str:
         parts.append(f'album:"{album}"')
     return " ".join(parts)
 
-
-def safe_spotify_call(sp: Spotify, func, *args, **kwargs):
-    """Retry wrapper for Spotipy calls."""
-    retries = 0
-    while True:
-        try:
-            return func(*args, **kwargs)
-        except SpotifyException as e:
-            # rate limited
-            if e.http_status == 429:
-                wait_s = int(e.headers.get("Retry-After", "5"))
-                retries += 1
-                log_event("apple_spotify_match", f"429 rate limit. sleeping {wait_s}s (retry {retries})")
-                time.sleep(wait_s)
-                continue
-            # auth gone bad - surface and stop (get_spotify_client should refresh)
-            if e.http_status in (401, 403):
-                log_event("apple_spotify_match", f"auth error {e.http_status}: {e}", level="error")
-                raise
-            log_event("apple_spotify_match", f"spotify error: {e}", level="error")
-            raise
-        except Exception as e:
-            retries += 1
-            sleep = min(5 * retries, 20)
-            log_event("apple_spotify_match", f"net/other error: {e}. retry in {sleep}s", level="warning")
-            time.sleep(sleep)
-
-
 # -----------------------
 # Core match logic
 # -----------------------
@@ -287,7 +258,7 @@ def main():
 
             for apple_track_id, title, artist, album, dur_ms in batch:
                 query = build_query(title, artist, album)
-                result = safe_spotify_call(sp, sp.search, q=query, type="track", limit=10, market="US")
+                result = sp.search(q=query, type="track", limit=10, market="US")
                 items = result.get("tracks", {}).get("items", []) if result else []
                 choice = choose_best_match(title, album or "", dur_ms, items)
 
@@ -1,10 +1,7 @@
 #!/usr/bin/env python3
 import os
 import sys
-import time
 import psycopg2
-import requests
-from spotipy.exceptions import SpotifyException
 
 # ─────────────────────────────────────────────
 # Ensure utils is in path
@@ -14,31 +11,6 @@ from utils.db_utils import get_db_connection
 from utils.spotify_auth import get_spotify_client
 from utils.logger import log_event
 
-# ─────────────────────────────────────────────
-# Safe Spotify API Wrapper
-# ─────────────────────────────────────────────
-
-def safe_spotify_call(func, *args, **kwargs):
-    retries = 0
-    while True:
-        try:
-            return func(*args, **kwargs)
-        except SpotifyException as e:
-            if getattr(e, "http_status", None) == 429:
-                retry_after = int(getattr(e, "headers", {}).get("Retry-After", 5))
-                retries += 1
-                log_event("apple_spotify_backfill", f"Rate limit hit. Retry #{retries} in {retry_after}s")
-                time.sleep(retry_after)
-            elif getattr(e, "http_status", None) == 401:
-                # token expired – bubble up so caller can refresh client once
-                raise
-            else:
-                log_event("apple_spotify_backfill", f"Spotify error: {e}", level="error")
-                raise
-        except requests.exceptions.ReadTimeout as e:
-            retries += 1
-            log_event("apple_spotify_backfill", f"Timeout hit. Retry #{retries} in 5s... ({e})")
-            time.sleep(5)
 
 # ─────────────────────────────────────────────
 # Setup Spotify client
@@ -64,17 +36,8 @@ def fetch_pending_tracks():
 
 
 def fetch_spotify_metadata(track_id):
-    global sp
-    try:
-        tr = safe_spotify_call(sp.track, track_id, market=MARKET)
-    except SpotifyException as e:
-        if getattr(e, "http_status", None) == 401:
-            log_event("apple_spotify_backfill", "Spotify token expired; refreshing and retrying once")
-            sp = get_spotify_client()
-            tr = safe_spotify_call(sp.track, track_id, market=MARKET)
-        else:
-            raise
-    return tr
+    # Expired tokens are refreshed transparently by the shared client
+    return sp.track(track_id, market=MARKET)
 
 def update_row(conn, apple_track_id, data, success=True):
     cur = conn.cursor()
@@ -0,0 +1,384 @@
+"""
+Memory-mapped columnar snapshot of unified_tracks and an in-process rule evaluator.
+
+Optional engine (requires numpy) that answers playlist rules without a
+database round trip:
+
+- export_columnar_snapshot(conn, path) writes the columns the rules can
+  reference as .npy arrays in a directory, next to a manifest.json.
+  Strings are dictionary-encoded: an int32 code per row plus a UTF-8 blob and
+  offsets per distinct value. Codes are assigned in the database's ORDER BY
+  order, so sorting by code matches the SQL collation. Timestamps are int64
+  epoch microseconds (UTC session time zone, as everywhere else). Booleans are
+  int8 (1/0, -1 = NULL). Integer NULLs are INT64_MIN.
+- ColumnarTracks.load(path) memory-maps the arrays. evaluate(rules) parses
+  the rules with routes.rule_parser and turns the rule tree into vectorized
+  boolean masks. It then applies the same implicit filters, sort (NULLS
+  LAST for ASC, FIRST for DESC) and limit as the SQL path, and returns the
+  same track URIs. Rows that tie on every sort key keep table order, whereas
+  PostgreSQL leaves their order undefined.
+
+Enable it with COLUMNAR_TRACKS_PATH. materialized_views then rewrites the
+snapshot after every unified_tracks build and update_dynamic_playlists
+evaluates from it, falling back to SQL when it is missing, stale or numpy is
+not installed.
+"""
+import os
+import json
+import shutil
+import calendar
+import operator
+from functools import reduce
+from datetime import datetime, timedelta, timezone
+
+try:
+    import numpy as np
+except ImportError:  # optional dependency
+    np = None
+
+from routes.rule_parser import (
+    Group, load_rules, parse_rules, compile_condition, compile_sort, _bool, _int, _normalize_track_source,
+)
+
+SNAPSHOT_PATH = os.getenv("COLUMNAR_TRACKS_PATH", "")
+# Snapshots older than this are not trusted by update_dynamic_playlists
+MAX_AGE_S = int(os.getenv("COLUMNAR_TRACKS_MAX_AGE_S", "86400"))
+FORMAT_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+FETCH_SIZE = 20000
+INT_NULL = -(2 ** 63)
+
+# column -> kind; every column a rule condition or sort can reference
+COLUMNS = {
+    "track_id": "string",
+    "track_name": "string",
+    "artist": "string",
+    "album_name": "string",
+    "album_id": "string",
+    "track_source": "string",
+    "library_origin": "string",
+    "added_at": "timestamp",
+    "last_played_at": "timestamp",
+    "first_played_at": "timestamp",
+    "play_count": "int",
+    "disc_number": "int",
+    "track_number": "int",
+    "is_liked": "bool",
+    "is_playable": "bool",
+    "excluded": "bool",
+}
+
+_OPS = {
+    "=": lambda a, b: a == b,
+    "<>": lambda a, b: a != b,
+    ">": lambda a, b: a > b,
+    "<": lambda a, b: a < b,
+    ">=": lambda a, b: a >= b,
+    "<=": lambda a, b: a <= b,
+}
+_PLAYS_OPS = {"is": "=", "eq": "=", "gt": ">", "lt": "<", "gte": ">=", "lte": "<=", "is_not": "<>"}
+_DATE_OPS = {"gt": ">", "lt": "<", "gte": ">=", "lte": "<=", "eq": "="}
+
+# field -> (column, operator or {rule operator: operator}, value converter)
+# Mirrors routes.rule_parser.CONDITION_MAP; the interval and source fields are handled in _condition_mask.
+FIELD_SPECS = {
+    "min_plays": ("play_count", ">=", _int),
+    "max_plays": ("play_count", "<=", _int),
+    "plays": ("play_count", _PLAYS_OPS, _int),
+    "added_after": ("added_at", ">=", None),
+    "added_before": ("added_at", "<=", None),
+    "date_added": ("added_at", _DATE_OPS, None),
+    "last_played": ("last_played_at", ">=", None),
+    "first_played": ("first_played_at", ">=", None),
+    "is_liked": ("is_liked", "=", _bool),
+    "is_playable": ("is_playable", "=", _bool),
+    "artist": ("artist", "contains", str),
+    "album": ("album_name", "contains", str),
+    "track": ("track_name", "contains", str),
+    "library_origin": ("library_origin", {"eq": "=", "is_not": "<>"}, None),
+}
+
+
+def available():
+    return np is not None
+
+
+def _require_numpy():
+    if np is None:
+        raise RuntimeError("numpy is required for the columnar track engine (pip install numpy)")
+
+
+# ─────────────────────────────────────────────
+# Value helpers
+# ─────────────────────────────────────────────
+def _epoch_us(value):
+    """Timestamp literal/datetime -> epoch microseconds (naive values are UTC)."""
+    if not isinstance(value, datetime):
+        value = datetime.fromisoformat(str(value).strip().replace(" ", "T", 1))
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    delta = value - datetime(1970, 1, 1, tzinfo=timezone.utc)
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def _minus_interval(now, interval):
+    """now - interval for rule_parser's "N days|weeks|months" strings (calendar months, like PostgreSQL)."""
+    count, unit = interval.split()
+    count = int(count)
+    if unit == "days":
+        return now - timedelta(days=count)
+    if unit == "weeks":
+        return now - timedelta(weeks=count)
+    index = now.year * 12 + now.month - 1 - count
+    year, month = index // 12, index % 12 + 1
+    return now.replace(year=year, month=month, day=min(now.day, calendar.monthrange(year, month)[1]))
+
+
+# ─────────────────────────────────────────────
+# Export
+# ─────────────────────────────────────────────
+def _select_expression(column, kind):
+    if kind == "string":
+        return (f"CASE WHEN {column} IS NULL THEN -1 "
+                f"ELSE DENSE_RANK() OVER (PARTITION BY {column} IS NULL ORDER BY {column}) - 1 END")
+    if kind == "timestamp":
+        return f"COALESCE((EXTRACT(EPOCH FROM {column}) * 1000000)::bigint, {INT_NULL})"
+    if kind == "bool":
+        return f"CASE WHEN {column} THEN 1 WHEN NOT {column} THEN 0 ELSE -1 END"
+    return f"COALESCE({column}::bigint, {INT_NULL})"
+
+
+_DTYPES = {"string": "int32", "timestamp": "int64", "int": "int64", "bool": "int8"}
+
+
+def export_columnar_snapshot(conn, path=None):
+    """Write unified_tracks to ``path`` as a columnar snapshot. Returns the row count.
+
+    Everything is read in one REPEATABLE READ transaction so codes and
+    dictionaries agree; the directory is swapped in atomically.
+    """
+    _require_numpy()
+    path = path or SNAPSHOT_PATH
+    build_path = f"{path}.build"
+    shutil.rmtree(build_path, ignore_errors=True)
+    os.makedirs(build_path)
+
+    names = list(COLUMNS)
+    conn.rollback()
+    cur = conn.cursor()
+    try:
+        cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        for column, kind in COLUMNS.items():
+            if kind != "string":
+                continue
+            cur.execute(f"SELECT DISTINCT {column} FROM unified_tracks WHERE {column} IS NOT NULL ORDER BY {column}")
+            encoded = [row[0].encode("utf-8") for row in cur.fetchall()]
+            offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            np.cumsum([len(e) for e in encoded], out=offsets[1:])
+            np.save(os.path.join(build_path, f"{column}.dict.npy"), np.frombuffer(b"".join(encoded), dtype=np.uint8))
+            np.save(os.path.join(build_path, f"{column}.offsets.npy"), offsets)
+
+        rows = conn.cursor(name="columnar_tracks_export")
+        rows.itersize = FETCH_SIZE
+        rows.execute(f"SELECT {', '.join(_select_expression(c, k) for c, k in COLUMNS.items())} FROM unified_tracks")
+        chunks = []
+        while True:
+            batch = rows.fetchmany(FETCH_SIZE)
+            if not batch:
+                break
+            chunks.append(np.array(batch, dtype=np.int64))
+        rows.close()
+    finally:
+        conn.rollback()
+        cur.close()
+
+    table = np.concatenate(chunks) if chunks else np.zeros((0, len(names)), dtype=np.int64)
+    for i, (column, kind) in enumerate(COLUMNS.items()):
+        np.save(os.path.join(build_path, f"{column}.npy"), table[:, i].astype(_DTYPES[kind]))
+
+    with open(os.path.join(build_path, MANIFEST_FILE), "w") as fp:
+        json.dump({
+            "version": FORMAT_VERSION,
+            "rows": int(table.shape[0]),
+            "built_at": datetime.now(timezone.utc).isoformat(),
+            "columns": COLUMNS,
+        }, fp, indent=2)
+
+    old_path = f"{path}.old"
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.exists(path):
+        os.replace(path, old_path)
+    os.replace(build_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+    return int(table.shape[0])
+
+
+# ─────────────────────────────────────────────
+# Evaluation
+# ─────────────────────────────────────────────
+class ColumnarTracks:
+    """Memory-mapped unified_tracks snapshot; see the module docstring."""
+
+    def __init__(self, path, manifest):
+        self.path = path
+        self.manifest = manifest
+        self.rows = manifest["rows"]
+        self._arrays = {}
+        self._dictionaries = {}
+        self._codes = {}
+        self._lowered = {}
+
+    @classmethod
+    def load(cls, path=None):
+        _require_numpy()
+        path = path or SNAPSHOT_PATH
+        with open(os.path.join(path, MANIFEST_FILE)) as fp:
+            manifest = json.load(fp)
+        if manifest.get("version") != FORMAT_VERSION or manifest.get("columns") != COLUMNS:
+            raise ValueError(f"Incompatible columnar snapshot at {path}")
+        return cls(path, manifest)
+
+    @property
+    def age_seconds(self):
+        return (datetime.now(timezone.utc) - datetime.fromisoformat(self.manifest["built_at"])).total_seconds()
+
+    def array(self, name):
+        if name not in self._arrays:
+            self._arrays[name] = np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode="r")
+        return self._arrays[name]
+
+    def dictionary(self, column):
+        """Distinct values of a string column, indexed by code."""
+        if column not in self._dictionaries:
+            blob = self.array(f"{column}.dict").tobytes()
+            offsets = self.array(f"{column}.offsets")
+            self._dictionaries[column] = [blob[offsets[i]:offsets[i + 1]].decode("utf-8")
+                                          for i in range(len(offsets) - 1)]
+        return self._dictionaries[column]
+
+    def codes(self, column):
+        """{value: code} of a string column."""
+        if column not in self._codes:
+            self._codes[column] = {value: code for code, value in enumerate(self.dictionary(column))}
+        return self._codes[column]
+
+    # ── masks ──────────────────────────────────
+    def _compare(self, column, op, value):
+        kind = COLUMNS[column]
+        values = self.array(column)
+        if value is None:
+            # SQL comparisons with NULL are never true
+            return np.zeros(self.rows, dtype=bool)
+        if kind == "string":
+            if op not in ("=", "<>"):
+                raise ValueError(f"Operator {op} is not supported on string column {column}")
+            # Values missing from the dictionary get a code no row has
+            return (values >= 0) & _OPS[op](values, self.codes(column).get(str(value), -2))
+        if kind == "bool":
+            return (values >= 0) & _OPS[op](values, int(value))
+        if kind == "timestamp":
+            value = _epoch_us(value)
+        return (values != INT_NULL) & _OPS[op](values, value)
+
+    def _contains(self, column, value):
+        needle = str(value).lower()
+        if column not in self._lowered:
+            self._lowered[column] = [v.lower() for v in self.dictionary(column)]
+        lowered = self._lowered[column]
+        hits = np.fromiter((needle in v for v in lowered), dtype=bool, count=len(lowered))
+        # Code -1 (NULL) picks the trailing False
+        return np.append(hits, False)[self.array(column)]
+
+    def _condition_mask(self, node, now):
+        if node.field == "added_in_last":
+            since = _minus_interval(now, compile_condition(node)[1][0])
+            return self._compare("added_at", ">=", since)
+        if node.field == "last_played_in_last":
+            since = _minus_interval(now, compile_condition(node)[1][0])
+            return self._compare("last_played_at", ">=" if node.operator == "eq" else "<", since)
+        if node.field == "track_source":
+            value = _normalize_track_source(node.value)
+            return self._compare("track_source", "=" if node.operator == "eq" else "<>", value)
+
+        column, op, convert = FIELD_SPECS[node.field]
+        if isinstance(op, dict):
+            op = op[node.operator]
+        value = convert(node.value) if convert else node.value
+        if op == "contains":
+            return self._contains(column, value)
+        return self._compare(column, op, value)
+
+    def _group_mask(self, node, now, errors):
+        """Mask of a Group, or None when none of its conditions filter anything."""
+        masks = []
+        for child in node.children:
+            if isinstance(child, Group):
+                mask = self._group_mask(child, now, errors)
+            else:
+                # Same validation (and dropping of bad conditions) as the SQL compiler
+                try:
+                    if compile_condition(child) is None:
+                        continue
+                except (TypeError, ValueError) as e:
+                    errors.append(f"Error parsing rule '{child.field}': {e}")
+                    continue
+                mask = self._condition_mask(child, now)
+            if mask is not None:
+                masks.append(mask)
+        if not masks:
+            return None
+        return reduce(operator.and_ if node.connector == "AND" else operator.or_, masks)
+
+    def _sort_keys(self, order_by, rows):
+        """np.lexsort keys (least significant first) for an ORDER BY list over ``rows``."""
+        keys = []
+        for term in order_by.split(","):
+            column, direction = term.split()
+            values = np.asarray(self.array(column)[rows], dtype=np.int64)
+            null_value = -1 if COLUMNS[column] in ("string", "bool") else INT_NULL
+            nulls = values == null_value
+            values = np.where(nulls, 0, values)
+            if direction == "DESC":
+                # PostgreSQL: DESC puts NULLs first
+                keys.append((~nulls, -values))
+            else:
+                keys.append((nulls, values))
+        flat = []
+        for null_key, value_key in reversed(keys):
+            flat.extend([value_key, null_key])
+        return flat
+
+    def evaluate(self, rules_json, now=None, errors=None):
+        """Track URIs for one playlist's rules, like ``routes.rule_parser.build_track_query``."""
+        rules = load_rules(rules_json)
+        errors = [] if errors is None else errors
+        now = now or datetime.now(timezone.utc)
+
+        mask = self._group_mask(parse_rules(rules, errors), now, errors)
+        if mask is None:
+            mask = np.ones(self.rows, dtype=bool)
+        if "is_playable" not in [c.get("field") for c in rules.get("conditions", [])]:
+            mask = mask & (self.array("is_playable") == 1)
+        mask = mask & (self.array("excluded") == 0)
+
+        rows = np.flatnonzero(mask)
+        limit = max(int(rules.get("limit", 100)), 0)
+        if len(rows):
+            rows = rows[np.lexsort(self._sort_keys(compile_sort(rules), rows))][:limit]
+        track_ids = self.dictionary("track_id")
+        codes = self.array("track_id")[rows]
+        return [f"spotify:track:{track_ids[code]}" for code in codes if code >= 0]
+
+    def evaluate_many(self, rules_by_slug, now=None):
+        """{slug: [uri, ...]} for several playlists, like ``evaluate_dynamic_playlists``."""
+        now = now or datetime.now(timezone.utc)
+        return {slug: self.evaluate(rules, now=now) for slug, rules in rules_by_slug.items()}
+
+
+def load_fresh_snapshot(path=None):
+    """The configured snapshot if the engine is enabled, usable and fresh enough; else None."""
+    path = path or SNAPSHOT_PATH
+    if not path or np is None or not os.path.exists(os.path.join(path, MANIFEST_FILE)):
+        return None
+    snapshot = ColumnarTracks.load(path)
+    return snapshot if snapshot.age_seconds <= MAX_AGE_S else None
@@ -4,16 +4,131 @@ import psycopg2
 import hashlib
 from spotipy import Spotify
 from spotipy.oauth2 import SpotifyOAuth
-from routes.rule_parser import build_track_query
+from routes.rule_parser import build_track_query, build_batch_track_query, execute_track_query
 from utils.logger import log_event
 from utils.spotify_auth import get_spotify_client
 from datetime import datetime
+from collections import Counter
+
+ITEMS_PER_REQUEST = 100  # Spotify max for playlist item writes
 
 def compute_tracklist_hash(track_uris):
     joined = ",".join(track_uris)  # order matters
     return hashlib.sha256(joined.encode("utf-8")).hexdigest()
 
-def sync_playlist(slug):
+def fetch_playlist_uris(sp, playlist_id):
+    """Current item URIs of a playlist, in order (None for unplayable/unknown items)."""
+    uris = []
+    page = sp.playlist_items(playlist_id, fields="items(track(uri)),next", additional_types=("track", "episode"))
+    while page:
+        uris.extend((item.get("track") or {}).get("uri") for item in page["items"])
+        page = sp.next(page) if page.get("next") else None
+    return uris
+
+def plan_playlist_diff(current, target, max_ops=None):
+    """Plan the playlist writes that turn ``current`` into ``target`` (lists of URIs).
+
+    Returns operations in the order they must be applied, or None once more
+    than ``max_ops`` would be needed:
+      ("remove", uris)                                  - drop every occurrence
+      ("move", range_start, range_length, insert_before) - reorder a block
+      ("add", uris, position)                            - insert at position
+    """
+    current_counts = Counter(current)
+    target_counts = Counter(target)
+    # Removal is by URI (all occurrences), so only URIs occurring equally often stay put
+    kept = {uri for uri, count in current_counts.items() if target_counts.get(uri) == count}
+    removed = [uri for uri in current_counts if uri not in kept]
+    ops = [("remove", removed[i:i + ITEMS_PER_REQUEST]) for i in range(0, len(removed), ITEMS_PER_REQUEST)]
+
+    # Reorder the surviving items into target order, moving whole blocks at a time
+    working = [uri for uri in current if uri in kept]
+    wanted = [uri for uri in target if uri in kept]
+    for i in range(len(wanted)):
+        if max_ops is not None and len(ops) > max_ops:
+            return None
+        if working[i] == wanted[i]:
+            continue
+        j = working.index(wanted[i], i + 1)
+        length = 1
+        while j + length < len(working) and working[j + length] == wanted[i + length]:
+            length += 1
+        working[i:j + length] = working[j:j + length] + working[i:j]
+        ops.append(("move", j, length, i))
+
+    # Insert what's missing; earlier positions are already final when each run lands
+    run_start, run = None, []
+    for position, uri in enumerate(target + [None]):
+        if uri is not None and uri not in kept:
+            if not run:
+                run_start = position
+            run.append(uri)
+            continue
+        for k in range(0, len(run), ITEMS_PER_REQUEST):
+            ops.append(("add", run[k:k + ITEMS_PER_REQUEST], run_start + k))
+        run = []
+
+    if max_ops is not None and len(ops) > max_ops:
+        return None
+    return ops
+
+def apply_playlist_ops(sp, playlist_id, ops, snapshot_id=None):
+    """Apply ``plan_playlist_diff`` operations; returns the final snapshot_id."""
+    for op in ops:
+        if op[0] == "remove":
+            result = sp.playlist_remove_all_occurrences_of_items(playlist_id, op[1], snapshot_id=snapshot_id)
+        elif op[0] == "move":
+            _, range_start, range_length, insert_before = op
+            result = sp.playlist_reorder_items(playlist_id, range_start=range_start, insert_before=insert_before,
+                                               range_length=range_length, snapshot_id=snapshot_id)
+        else:
+            result = sp.playlist_add_items(playlist_id, op[1], position=op[2])
+        snapshot_id = (result or {}).get("snapshot_id", snapshot_id)
+    return snapshot_id
+
+def replace_playlist_tracks(sp, playlist_id, track_uris):
+    """Overwrite the playlist: first 100 items in one replace, the rest appended.
+
+    The playlist is never left empty in between.
+    """
+    result = sp.playlist_replace_items(playlist_id, track_uris[:ITEMS_PER_REQUEST])
+    for i in range(ITEMS_PER_REQUEST, len(track_uris), ITEMS_PER_REQUEST):
+        result = sp.playlist_add_items(playlist_id, track_uris[i:i + ITEMS_PER_REQUEST])
+    return (result or {}).get("snapshot_id")
+
+def fetch_user_playlists(sp):
+    """All playlists in the current user's library (one listing shared by a batch of syncs)."""
+    playlists = []
+    results = sp.current_user_playlists()
+    while results:
+        playlists.extend(results['items'])
+        results = sp.next(results) if results.get('next') else None
+    return playlists
+
+def evaluate_dynamic_playlists(cur, rules_by_slug):
+    """Resolve every playlist's rules in one shared scan of unified_tracks.
+
+    Returns ``{slug: [uri, ...]}`` with each list ordered and limited as
+    its rules ask.
+    """
+    slugs = list(rules_by_slug)
+    if not slugs:
+        return {}
+    query, params = build_batch_track_query([rules_by_slug[slug] for slug in slugs])
+    cur.execute(query, params)
+    track_uris = {slug: [] for slug in slugs}
+    for idx, uri in cur.fetchall():
+        if uri:
+            track_uris[slugs[idx]].append(uri)
+    return track_uris
+
+def sync_playlist(slug, track_uris=None, user_playlists=None):
+    """Sync one dynamic playlist to Spotify.
+
+    ``track_uris`` (already-evaluated rules) and ``user_playlists`` (the
+    user's playlist listing) can be passed in by batch callers; otherwise
+    both are fetched here.
+    """
     log_event("generate_playlist", f"🔁 Starting sync for playlist slug: '{slug}'")
     try:
         from utils.db_utils import get_db_connection
@@ -31,14 +146,10 @@ def sync_playlist(slug):
         # Spotify check first
         sp = get_spotify_client()
         try:
-            user_id = sp.current_user()["id"]
-            playlists = []
-            results = sp.current_user_playlists()
-            while results:
-                playlists.extend(results['items'])
-                results = sp.next(results) if results.get('next') else None
+            playlists = user_playlists if user_playlists is not None else fetch_user_playlists(sp)
 
             user_playlist_ids = {pl["id"] for pl in playlists}
+            spotify_snapshot_id = next((pl.get("snapshot_id") for pl in playlists if pl["id"] == playlist_id), None)
             if playlist_id not in user_playlist_ids:
                 reason = "playlist not found in user's library"
                 log_event("generate_playlist", f"⚠️ Playlist '{playlist_id}' not found in user's library. Soft-flagging in DB instead of deleting.")
@@ -95,31 +206,33 @@ def sync_playlist(slug):
             log_event("generate_playlist", "⏭ Skipped 'exclusions' playlist (manually managed)")
             return
 
-        try:
-            log_event("generate_playlist", f"📥 Raw rules_json for '{slug}': {rules_json} (type: {type(rules_json)})")
-            if isinstance(rules_json, dict):
-                rules = rules_json
-            else:
-                rules = json.loads(rules_json or "{}")
-            log_event("generate_playlist", f"📋 Successfully loaded rules for '{slug}': {rules} (type: {type(rules)})")
-        except Exception as e:
-            log_event("generate_playlist", f"❌ Failed to parse rules for '{slug}': {e} — rules_json was: {rules_json}", level="error")
-            return
+        rules = None
+        if track_uris is None:
+            try:
+                log_event("generate_playlist", f"📥 Raw rules_json for '{slug}': {rules_json} (type: {type(rules_json)})")
+                if isinstance(rules_json, dict):
+                    rules = rules_json
+                else:
+                    rules = json.loads(rules_json or "{}")
+                log_event("generate_playlist", f"📋 Successfully loaded rules for '{slug}': {rules} (type: {type(rules)})")
+            except Exception as e:
+                log_event("generate_playlist", f"❌ Failed to parse rules for '{slug}': {e} — rules_json was: {rules_json}", level="error")
+                return
 
         try:
-            query = build_track_query(rules)
-            log_event("generate_playlist", f"🔍 Running query: {query}")
-            log_event("generate_playlist", f"🛠 SQL Query: {query} | Params: []")
-            cur.execute(query)
-            rows = cur.fetchall()
-            log_event("generate_playlist", f"📊 Fetched rows: {len(rows)} | Sample: {rows[:5]}")
-            track_uris = [row[0] for row in rows if row and row[0]]
-            log_event("generate_playlist", f"📦 Track URIs fetched: {track_uris}")
+            if track_uris is None:
+                query, params = build_track_query(rules)
+                log_event("generate_playlist", f"🛠 SQL Query: {query} | Params: {params}")
+                execute_track_query(cur, query, params)
+                rows = cur.fetchall()
+                log_event("generate_playlist", f"📊 Fetched rows: {len(rows)} | Sample: {rows[:5]}")
+                track_uris = [row[0] for row in rows if row and row[0]]
+            log_event("generate_playlist", f"📦 Track URIs fetched: {len(track_uris)}")
 
             new_hash = compute_tracklist_hash(track_uris)
-            cur.execute("SELECT last_synced_hash FROM playlist_mappings WHERE slug = %s", (slug,))
+            cur.execute("SELECT last_synced_hash, last_synced_uris, snapshot_id FROM playlist_mappings WHERE slug = %s", (slug,))
             last_hash_row = cur.fetchone()
-            last_synced_hash = last_hash_row[0] if last_hash_row else None
+            last_synced_hash, last_synced_uris, stored_snapshot_id = last_hash_row if last_hash_row else (None, None, None)
             log_event("generate_playlist", f"🧠 Computed hash: {new_hash} | Stored hash: {last_synced_hash}")
 
             if last_synced_hash == new_hash:
@@ -131,25 +244,43 @@ def sync_playlist(slug):
             log_event("generate_playlist", f"❌ Error building/executing track query for '{slug}': {query_error} — rules: {rules}", level="error")
             return
 
-        # Always clear the playlist before re-adding
-        log_event("generate_playlist", f"🧹 Clearing playlist '{slug}' before re-adding tracks")
-        sp = get_spotify_client()
-        user = sp.current_user()
-        sp.user_playlist_replace_tracks(user["id"], playlist_id, [])
+        # Work out what's on Spotify now: the list we last pushed, unless the playlist changed since
+        if last_synced_uris is not None and stored_snapshot_id and stored_snapshot_id == spotify_snapshot_id:
+            current_uris = list(last_synced_uris)
+        else:
+            log_event("generate_playlist", f"📥 Stored track list for '{slug}' is missing or stale; reading playlist from Spotify")
+            current_uris = fetch_playlist_uris(sp, playlist_id)
 
-        if not track_uris:
-            log_event("generate_playlist", f"⚠️ No tracks found for '{slug}' — playlist was cleared.")
-            cur.execute("UPDATE playlist_mappings SET track_count = 0, last_synced_at = %s WHERE slug = %s", (datetime.utcnow(), slug))
-            conn.commit()
-            return
+        # A full rewrite costs one write per 100 tracks; diff unless that would take more calls
+        rewrite_cost = max(1, -(-len(track_uris) // ITEMS_PER_REQUEST))
+        ops = None
+        if None not in current_uris:
+            ops = plan_playlist_diff(current_uris, track_uris, max_ops=rewrite_cost)
 
-        log_event("generate_playlist", f"🎧 Retrieved {len(track_uris)} tracks for '{slug}'")
+        if ops is not None:
+            counts = Counter(op[0] for op in ops)
+            log_event("generate_playlist", f"🔀 Applying diff to '{slug}' in {len(ops)} call(s): "
+                                           f"{counts['remove']} remove, {counts['move']} move, {counts['add']} add")
+            snapshot_id = apply_playlist_ops(sp, playlist_id, ops, snapshot_id=spotify_snapshot_id)
+        else:
+            log_event("generate_playlist", f"♻️ Rewriting playlist '{slug}' with {len(track_uris)} tracks ({rewrite_cost} call(s))")
+            snapshot_id = replace_playlist_tracks(sp, playlist_id, track_uris)
 
-        log_event("generate_playlist", f"➕ Adding {len(track_uris)} tracks to playlist '{slug}' in batches of 100")
-        for i in range(0, len(track_uris), 100):
-            sp.playlist_add_items(playlist_id, track_uris[i:i + 100])
+        if not track_uris:
+            log_event("generate_playlist", f"⚠️ No tracks found for '{slug}' — playlist was cleared.")
 
-        cur.execute("UPDATE playlist_mappings SET track_count = %s, last_synced_at = %s, last_synced_hash = %s WHERE slug = %s", (len(track_uris), datetime.utcnow(), new_hash, slug))
+        cur.execute(
+            """
+            UPDATE playlist_mappings
+            SET track_count = %s,
+                last_synced_at = %s,
+                last_synced_hash = %s,
+                last_synced_uris = %s,
+                snapshot_id = %s
+            WHERE slug = %s
+            """,
+            (len(track_uris), datetime.utcnow(), new_hash, track_uris, snapshot_id, slug)
+        )
         conn.commit()
         log_event("generate_playlist", f"📝 Updated playlist_mappings for '{slug}' with {len(track_uris)} track URIs")
 
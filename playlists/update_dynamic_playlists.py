@@ -1,10 +1,26 @@
 import os
+import json
+import time
 import psycopg2
 from utils.db_utils import get_db_connection
-from playlists.generate_playlist import sync_playlist
+from utils.spotify_auth import get_spotify_client
+from playlists.playlist_sync import sync_playlist, evaluate_dynamic_playlists, fetch_user_playlists
+from playlists.columnar_tracks import load_fresh_snapshot
 from utils.logger import log_event
 
-def main():
+
+def load_playlist_rules(cur):
+    """{slug: rules} for every dynamic playlist whose rules parse; others are left to sync_playlist."""
+    cur.execute("SELECT slug, rules FROM playlist_mappings WHERE is_dynamic = TRUE AND slug <> 'exclusions'")
+    rules_by_slug = {}
+    for slug, rules_json in cur.fetchall():
+        try:
+            rules_by_slug[slug] = rules_json if isinstance(rules_json, dict) else json.loads(rules_json or "{}")
+        except (TypeError, ValueError):
+            continue
+    return rules_by_slug
+
+def run(context=None):
     log_event("update_dynamic_playlists", "🚀 Starting dynamic playlist updater")
     try:
         conn = get_db_connection()
@@ -13,10 +29,45 @@ def main():
         slugs = [row[0] for row in cur.fetchall()]
         log_event("update_dynamic_playlists", f"🧾 Found {len(slugs)} dynamic playlists to update: {slugs}")
 
+        # ─────────────────────────────────────────────
+        # Evaluate every playlist's rules: in-process from the columnar
+        # snapshot when enabled, else in one pass over unified_tracks
+        # ─────────────────────────────────────────────
+        rules_by_slug = load_playlist_rules(cur)
+        track_uris_by_slug = None
+        try:
+            snapshot = load_fresh_snapshot()
+            if snapshot is not None:
+                start = time.time()
+                track_uris_by_slug = snapshot.evaluate_many(rules_by_slug)
+                log_event("update_dynamic_playlists", f"🧊 Evaluated {len(track_uris_by_slug)} playlists from the "
+                                                      f"columnar snapshot in {(time.time() - start) * 1000:.0f} ms")
+        except Exception as e:
+            track_uris_by_slug = None
+            log_event("update_dynamic_playlists", f"⚠️ Columnar evaluation failed, falling back to SQL: {e}",
+                      level="warning")
+
+        if track_uris_by_slug is None:
+            track_uris_by_slug = {}
+            try:
+                track_uris_by_slug = evaluate_dynamic_playlists(cur, rules_by_slug)
+                log_event("update_dynamic_playlists", f"📊 Evaluated {len(track_uris_by_slug)} playlists in one query")
+            except Exception as e:
+                conn.rollback()
+                log_event("update_dynamic_playlists", f"⚠️ Batch evaluation failed, falling back to per-playlist queries: {e}",
+                          level="warning")
+
+        # One playlist listing shared by every sync
+        user_playlists = None
+        try:
+            user_playlists = fetch_user_playlists(get_spotify_client())
+        except Exception as e:
+            log_event("update_dynamic_playlists", f"⚠️ Could not list user playlists up front: {e}", level="warning")
+
         for slug in slugs:
             try:
                 log_event("update_dynamic_playlists", f"🔁 Updating playlist: {slug}")
-                sync_playlist(slug)
+                sync_playlist(slug, track_uris=track_uris_by_slug.get(slug), user_playlists=user_playlists)
             except Exception as e:
                 log_event("update_dynamic_playlists", f"❌ Error syncing playlist '{slug}': {e}", level="error")
 
@@ -46,4 +97,4 @@ def main():
         log_event("update_dynamic_playlists", "✅ Finished updating dynamic playlists")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    run()
\ No newline at end of file
@@ -1,7 +1,13 @@
+import os
 import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from psycopg2.extras import RealDictCursor
 from flask import Blueprint, jsonify, render_template
-from utils.db_utils import get_db_connection
+from utils.db_utils import get_db_connection, db_connection
+from utils.logger import log_event
+from utils.play_partitions import plays_since_sql
 from datetime import datetime, timedelta
 
 metrics_bp = Blueprint("metrics", __name__)
@@ -26,10 +32,73 @@ def cached_metrics_data():
     else:
         return jsonify({"error": "No cached metrics found."}), 404
 
-def collect_metrics_payload():
-    conn = get_db_connection()
-    cur = conn.cursor()
-
+# ─────────────────────────────────────────────
+# Metric panel registry
+# ─────────────────────────────────────────────
+# Panels run concurrently, each on its own pooled connection
+METRICS_CONCURRENCY = int(os.getenv("METRICS_CONCURRENCY", "6"))
+# Per-panel statement timeout (ms); a panel that hits it falls back to its last good value
+METRICS_PANEL_TIMEOUT_MS = int(os.getenv("METRICS_PANEL_TIMEOUT_MS", "15000"))
+
+METRIC_PANELS = {}
+# Last successfully computed value per panel (this process)
+_last_good = {}
+_last_good_lock = threading.Lock()
+
+
+def metric_panel(key, default=None, timeout_ms=None):
+    """Register ``fn(cur) -> value`` as the panel for payload key ``key``."""
+    def decorator(fn):
+        METRIC_PANELS[key] = {
+            "fn": fn,
+            "default": default,
+            "timeout_ms": timeout_ms or METRICS_PANEL_TIMEOUT_MS,
+        }
+        return fn
+    return decorator
+
+
+def _run_panel(key):
+    panel = METRIC_PANELS[key]
+    start = time.perf_counter()
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            try:
+                cur.execute("SET LOCAL statement_timeout = %s", (panel["timeout_ms"],))
+                value = panel["fn"](cur)
+            finally:
+                cur.close()
+        with _last_good_lock:
+            _last_good[key] = value
+        return key, value, time.perf_counter() - start, None
+    except Exception as e:
+        return key, None, time.perf_counter() - start, e
+
+
+def _load_cached_payload():
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT data FROM daily_metrics_cache ORDER BY snapshot_date DESC LIMIT 1")
+            row = cur.fetchone()
+            cur.close()
+        return row[0] if row else {}
+    except Exception:
+        return {}
+
+
+def _fallback_value(key, cached_payload):
+    with _last_good_lock:
+        if key in _last_good:
+            return _last_good[key]
+    if key in cached_payload:
+        return cached_payload[key]
+    return METRIC_PANELS[key]["default"]
+
+
+@metric_panel("top_artists", default=[])
+def top_artists(cur):
     # Top Artists
     cur.execute("""
         SELECT artist, COALESCE(artist_image, '/app/static/img/no_image.png') AS image_url, SUM(play_count) as play_count
@@ -43,7 +112,11 @@ def collect_metrics_payload():
         {"artist": row[0], "image_url": row[1], "count": row[2]}
         for row in cur.fetchall()
     ]
+    return top_artists
+
 
+@metric_panel("top_tracks", default=[])
+def top_tracks(cur):
     # Top Tracks
     cur.execute("""
         SELECT track_name, artist, COALESCE(album_image_url, artist_image, '/app/static/img/no_image.png') AS image_url, play_count
@@ -56,18 +129,27 @@ def collect_metrics_payload():
         {"track_name": row[0], "artist": row[1], "image_url": row[2], "count": row[3]}
         for row in cur.fetchall()
     ]
+    return top_tracks
 
+
+@metric_panel("daily_plays", default=[])
+def daily_plays(cur):
     # Plays Per Day (last 30 days)
-    cur.execute("""
+    # Straight from the partitioned play tables: only the last month or two are scanned
+    cur.execute(f"""
         SELECT DATE(played_at) AS play_date, COUNT(*) AS daily_play_count
-        FROM unified_plays_mv
-        WHERE played_at >= NOW() - INTERVAL '30 days'
-          AND played_at IS NOT NULL
+        FROM (
+{plays_since_sql("played_at", "NOW() - INTERVAL '30 days'")}
+        ) recent
         GROUP BY play_date
         ORDER BY play_date ASC;
     """)
     daily_plays = [{"date": row[0].isoformat(), "count": row[1]} for row in cur.fetchall()]
+    return daily_plays
+
 
+@metric_panel("top_albums", default=[])
+def top_albums(cur):
     # Top Albums
     cur.execute("""
         SELECT album_name, artist, COALESCE(MIN(album_image_url),'/app/static/img/no_image.png') AS image_url, SUM(play_count) AS total_plays
@@ -81,8 +163,11 @@ def collect_metrics_payload():
         {"album_name": row[0], "artist": row[1], "image_url": row[2], "count": row[3]}
         for row in cur.fetchall()
     ]
+    return top_albums
 
 
+@metric_panel("plays_by_day", default=[])
+def plays_by_day(cur):
     # Plays by Day of Week
     cur.execute("""
         SELECT TRIM(TO_CHAR(last_played_at, 'Day')) AS day, SUM(play_count)
@@ -106,7 +191,11 @@ def collect_metrics_payload():
         {"day": row[0].strip(), "percentage": round((row[1] / total_daily_plays) * 100, 1)}
         for row in rows
     ]
+    return plays_by_day
+
 
+@metric_panel("plays_by_hour", default=[])
+def plays_by_hour(cur):
     # Plays by Hour of Day
     cur.execute("""
         WITH hourly AS (
@@ -127,7 +216,11 @@ def collect_metrics_payload():
         {"hour": int(row[0]), "percentage": row[1]}
         for row in cur.fetchall()
     ]
+    return plays_by_hour
 
+
+@metric_panel("plays_by_month", default=[])
+def plays_by_month(cur):
     # Plays by Month
     cur.execute("""
         SELECT TO_CHAR(played_at, 'YYYY-MM') AS month, COUNT(*) AS total_plays
@@ -137,7 +230,11 @@ def collect_metrics_payload():
         ORDER BY month
     """)
     plays_by_month = [{"month": row[0], "count": row[1]} for row in cur.fetchall()]
+    return plays_by_month
+
 
+@metric_panel("tracks_added", default=[])
+def tracks_added(cur):
     # Tracks Added Over Time
     cur.execute("""
         SELECT DATE(added_at), COUNT(*)
@@ -147,7 +244,11 @@ def collect_metrics_payload():
         ORDER BY DATE(added_at)
     """)
     tracks_added = [{"date": row[0].isoformat(), "count": row[1]} for row in cur.fetchall()]
+    return tracks_added
+
 
+@metric_panel("top_liked_artists", default=[])
+def top_liked_artists(cur):
     # Top Liked Artists
     cur.execute("""
         SELECT artist, artist_image, COUNT(*) as liked_count
@@ -158,7 +259,11 @@ def collect_metrics_payload():
         LIMIT 10
     """)
     top_liked_artists = [{"artist": row[0], "image_url": row[1], "count": row[2]} for row in cur.fetchall()]
+    return top_liked_artists
 
+
+@metric_panel("top_genres", default=[])
+def top_genres(cur):
     # Top Genres by First Genre
     cur.execute("""
         SELECT TRIM(genres[1]) AS primary_genre, SUM(play_count) AS total_plays
@@ -169,7 +274,11 @@ def collect_metrics_payload():
         LIMIT 10
     """)
     top_genres = [{"genre": row[0], "count": row[1]} for row in cur.fetchall()]
+    return top_genres
+
 
+@metric_panel("popularity_distribution", default=[])
+def popularity_distribution(cur):
     # Popularity Distribution of Liked Tracks
     cur.execute("""
         SELECT
@@ -192,7 +301,11 @@ def collect_metrics_payload():
         ORDER BY popularity_range
     """)
     popularity_distribution = [{"range": row[0], "count": row[1]} for row in cur.fetchall()]
+    return popularity_distribution
 
+
+@metric_panel("avg_popularity_score", default=0)
+def avg_popularity_score(cur):
     # Average Popularity Score
     cur.execute("""
         SELECT ROUND(AVG(popularity), 1)
@@ -200,7 +313,11 @@ def collect_metrics_payload():
         WHERE popularity IS NOT NULL
     """)
     avg_popularity_score = cur.fetchone()[0] or 0
+    return avg_popularity_score
+
 
+@metric_panel("release_to_play", default=[])
+def release_to_play(cur):
     # Time from Release to First Play
     cur.execute("""
         SELECT bucket, ROUND(COUNT(*) * 100.0 / SUM(COUNT(*)) OVER (), 1) AS percentage
@@ -257,7 +374,11 @@ def collect_metrics_payload():
           END
     """)
     release_to_play = [{"bucket": row[0], "percentage": row[1]} for row in cur.fetchall()]
+    return release_to_play
 
+
+@metric_panel("monthly_library_growth", default=[])
+def monthly_library_growth(cur):
     # Monthly Increase in Library Size
     cur.execute("""
         SELECT DATE_TRUNC('month', added_at) AS month, COUNT(*) AS added
@@ -267,9 +388,13 @@ def collect_metrics_payload():
         ORDER BY month
     """)
     monthly_library_growth = [{"month": row[0].isoformat(), "count": row[1]} for row in cur.fetchall()]
+    return monthly_library_growth
+
 
+@metric_panel("top_artist_by_month", default=[])
+def top_artist_by_month(cur):
     # Top Artist by Month
-    cur.execute("""
+    cur.execute(f"""
         SELECT artist_name, month, play_count
         FROM (
             SELECT
@@ -280,10 +405,10 @@ def collect_metrics_payload():
                     PARTITION BY TO_CHAR(played_at, 'YYYY-MM')
                     ORDER BY COUNT(*) DESC
                 ) AS rank
-            FROM unified_plays_mv
-            WHERE played_at >= NOW() - INTERVAL '24 months'
-              AND played_at IS NOT NULL
-              AND artist_name IS NOT NULL
+            FROM (
+{plays_since_sql("artist_name, played_at", "NOW() - INTERVAL '24 months'")}
+            ) recent
+            WHERE artist_name IS NOT NULL
             GROUP BY artist_name, TO_CHAR(played_at, 'YYYY-MM')
         ) ranked
         WHERE rank = 1
@@ -293,7 +418,11 @@ def collect_metrics_payload():
         {"artist": row[0], "month": row[1], "count": row[2]}
         for row in cur.fetchall()
     ]
+    return top_artist_by_month
+
 
+@metric_panel("summary_stats", default={})
+def summary_stats(cur):
     # Summary Stats
     cur.execute("""
         SELECT 
@@ -404,28 +533,39 @@ def collect_metrics_payload():
         "avg_listens_per_day": avg_listens_per_day,
         "avg_listens_per_month": avg_listens_per_month,
     }
+    return summary_stats
 
-    cur.close()
-    conn.close()
+def collect_metrics_payload():
+    """Run every registered panel concurrently and assemble the payload.
+
+    A panel that errors or exceeds its statement timeout is replaced by its
+    last good value (this process, then the latest daily_metrics_cache row),
+    so one bad query can't fail the whole payload.
+    """
+    start = time.perf_counter()
+    keys = list(METRIC_PANELS)
+    with ThreadPoolExecutor(max_workers=max(1, min(METRICS_CONCURRENCY, len(keys))),
+                            thread_name_prefix="metrics") as pool:
+        results = list(pool.map(_run_panel, keys))
+
+    payload = {}
+    timings = []
+    cached_payload = None
+    for key, value, elapsed, error in results:
+        timings.append(f"{key}={elapsed * 1000:.0f}ms")
+        if error is None:
+            payload[key] = value
+            continue
+        if cached_payload is None:
+            cached_payload = _load_cached_payload()
+        payload[key] = _fallback_value(key, cached_payload)
+        log_event("metrics", f"⚠️ Panel '{key}' failed after {elapsed:.1f}s; serving last cached value: {error}",
+                  level="warning")
+
+    log_event("metrics", f"📊 Collected {len(keys)} metric panels in {time.perf_counter() - start:.1f}s "
+                         f"({', '.join(timings)})")
+    return payload
 
-    return {
-        "top_artists": top_artists,
-        "top_tracks": top_tracks,
-        "daily_plays": daily_plays,
-        "top_albums": top_albums,
-        "plays_by_day": plays_by_day,
-        "plays_by_hour": plays_by_hour,
-        "plays_by_month": plays_by_month,
-        "tracks_added": tracks_added,
-        "top_liked_artists": top_liked_artists,
-        "top_genres": top_genres,
-        "popularity_distribution": popularity_distribution,
-        "avg_popularity_score": avg_popularity_score,
-        "release_to_play": release_to_play,
-        "monthly_library_growth": monthly_library_growth,
-        "top_artist_by_month": top_artist_by_month,
-        "summary_stats": summary_stats,
-    }
 
 @metrics_bp.route("/metrics-data")
 def metrics_data():
@@ -24,18 +24,18 @@ def user_has_synced_before(user_id):
         return False
 
 def run_initial_syncs(user_id: int, is_initial=True):
-    import subprocess
+    from utils.pipeline import PipelineContext, run_pipeline
 
     full_job_sequence = [
-        "sync_saved_albums.py",
-        "sync_album_tracks.py",
-        "sync_liked_tracks.py" if not is_initial else "sync_liked_tracks_full.py",
-        "sync_artists.py",
-        "check_track_availability.py",
-        "sync_exclusions.py",
-        "materialized_views.py",
-        "materialized_metrics.py",
-        "check_canonical_albums.py"
+        "sync_saved_albums",
+        "sync_album_tracks",
+        "sync_liked_tracks" if not is_initial else "sync_liked_tracks_full",
+        "sync_artists",
+        "check_track_availability",
+        "sync_exclusions",
+        "materialized_views",
+        "materialized_metrics",
+        "check_canonical_albums"
     ]
 
     # Check if exclusions playlist exists; create it if missing
@@ -47,22 +47,11 @@ def run_initial_syncs(user_id: int, is_initial=True):
     except Exception as e:
         log_event("initial_sync", f"❌ Failed to ensure exclusions playlist: {e}", level="error")
 
-    full_job_sequence.append("sync_exclusions.py")
-    full_job_sequence.append("materialized_views.py")
+    full_job_sequence.append("sync_exclusions")
+    full_job_sequence.append("materialized_views")
 
-    for job in full_job_sequence:
-        try:
-            log_event("initial_sync", f"🚀 Starting {job} for user {user_id}")
-            result = subprocess.run(
-                ["python", f"api_syncs/{job}", "--user_id", str(user_id)],
-                capture_output=True,
-                text=True,
-                check=True,
-                env={**os.environ, "PYTHONPATH": "."}
-            )
-            log_event("initial_sync", f"✅ Completed {job} for user {user_id}\n{result.stdout}")
-        except subprocess.CalledProcessError as e:
-            log_event("initial_sync", f"❌ Failed {job} for user {user_id}\n{e.stderr}", level="error")
+    # All jobs run in this process, sharing the Spotify client and DB pool
+    return run_pipeline(full_job_sequence, PipelineContext(user_id=user_id, source="initial_sync"))
 
 
 playlist_dashboard = Blueprint("playlist_dashboard", __name__)
@@ -175,29 +164,24 @@ def run_initial_sync():
 @playlist_dashboard.route('/sync/lite', methods=['POST'])
 @login_required
 def run_lite_sync():
-    import subprocess
+    from utils.pipeline import PipelineContext, run_pipeline
     user_id = current_user.get_id()
 
     lite_job_sequence = [
-        'api_syncs/track_plays.py',
-        'api_syncs/sync_saved_albums_lite.py',
-        'api_syncs/sync_album_tracks.py',
-        'api_syncs/sync_liked_tracks.py',
-        'api_syncs/sync_artists.py',
-        'api_syncs/materialized_views.py',
-        'api_syncs/materialized_metrics.py',
-        'playlists/update_dynamic_playlists.py',
+        'track_plays',
+        'sync_saved_albums_lite',
+        'sync_album_tracks',
+        'sync_liked_tracks',
+        'sync_artists',
+        'materialized_views',
+        'materialized_metrics',
+        'update_dynamic_playlists',
     ]
 
-    try:
-        for job in lite_job_sequence:
-            subprocess.run(
-                ['python', job, '--user_id', str(user_id)],
-                check=True,
-                env={**os.environ, 'PYTHONPATH': '.'}
-            )
+    failed = run_pipeline(lite_job_sequence, PipelineContext(user_id=user_id, source="lite_sync"), stop_on_error=True)
+    if failed:
+        flash(f"Lite sync failed on {failed[0]}; see logs for details.", "error")
+    else:
         flash("Lite sync completed successfully.", "success")
-    except subprocess.CalledProcessError as e:
-        flash(f"Lite sync failed on {job}: {e}", "error")
 
-    return redirect(url_for('home'))
\ No newline at end of file
+    return redirect(url_for('home'))
@@ -1,41 +1,79 @@
 # utils/rule_parser.py
+#
+# Rules JSON -> AST -> parameterized SQL.
+#
+# User values never reach the SQL text: they're bound as params, so two
+# playlists with the same rule *shape* share one SQL string (and one plan).
+# Compiled (sql, params) pairs are cached by a canonical hash of the rules.
+import os
 import json
+import hashlib
+import threading
+import weakref
+from collections import OrderedDict, namedtuple
 from utils.logger import log_event
 
 ALLOWED_UNITS = {"days", "weeks", "months"}
 
-def _added_in_last_clause(value, unit, operator):
+# Compiled-query cache size (entries) and server-side prepared statements toggle.
+# Prepared statements are off by default: they don't survive transaction-pooling proxies.
+RULE_CACHE_SIZE = int(os.getenv("RULE_CACHE_SIZE", "256"))
+USE_PREPARED_STATEMENTS = os.getenv("RULES_USE_PREPARED_STATEMENTS", "0") == "1"
+
+# ─────────────────────────────────────────────
+# AST
+# ─────────────────────────────────────────────
+Group = namedtuple("Group", "connector children")
+Condition = namedtuple("Condition", "field operator value unit")
+
+
+def _int(v):
+    return int(v)
+
+
+def _bool(v):
+    if isinstance(v, bool):
+        return v
+    val = str(v).strip().lower()
+    if val in ("true", "1", "yes"):
+        return True
+    if val in ("false", "0", "no"):
+        return False
+    raise ValueError(f"Expected a boolean, got {v!r}")
+
+
+def _contains(v):
+    # LIKE pattern for "contains v", with v's own wildcards escaped
+    escaped = str(v).replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+def _interval(value, unit, field):
     try:
         n = int(value)
     except (TypeError, ValueError):
-        raise ValueError("'added_in_last' requires an integer value")
+        raise ValueError(f"'{field}' requires an integer value")
     if n < 0:
-        raise ValueError("'added_in_last' value must be >= 0")
+        raise ValueError(f"'{field}' value must be >= 0")
     unit = str(unit or "").strip().lower()
     if unit not in ALLOWED_UNITS:
-        raise ValueError("'added_in_last' unit must be one of: days, weeks, months")
+        raise ValueError(f"'{field}' unit must be one of: days, weeks, months")
+    return f"{n} {unit}"
+
+
+def _added_in_last_clause(value, unit):
     # Interpret eq/gte/lte the same: within the last N units
-    # You can expand semantics later if needed
-    return f"added_at >= NOW() - INTERVAL '{n} {unit}'"
+    return "added_at >= NOW() - %s::interval", [_interval(value, unit, "added_in_last")]
+
 
 def _last_played_in_last_clause(value, unit, operator):
-    try:
-        n = int(value)
-    except (TypeError, ValueError):
-        raise ValueError("'last_played_in_last' requires an integer value")
-    if n < 0:
-        raise ValueError("'last_played_in_last' value must be >= 0")
-    unit = str(unit or "").strip().lower()
-    if unit not in ALLOWED_UNITS:
-        raise ValueError("'last_played_in_last' unit must be one of: days, weeks, months")
+    interval = _interval(value, unit, "last_played_in_last")
     if operator == "eq":
         # Played in the last N (inclusive)
-        return f"last_played_at >= NOW() - INTERVAL '{n} {unit}'"
-    elif operator == "is_not":
-        # NOT played in the last N
-        return f"last_played_at < NOW() - INTERVAL '{n} {unit}'"
-    else:
-        raise ValueError(f"Unsupported operator '{operator}' for last_played_in_last")
+        return "last_played_at >= NOW() - %s::interval", [interval]
+    # NOT played in the last N
+    return "last_played_at < NOW() - %s::interval", [interval]
+
 
 def _normalize_track_source(v: object):
     val = str(v or "").strip().lower()
@@ -45,153 +83,293 @@ def _normalize_track_source(v: object):
         return None  # treat as no filter
     raise ValueError("Source must be 'library', 'non_library', or 'both'.")
 
-def _source_clause(v: object, op: str) -> str:
+
+def _source_clause(v: object, op: str):
     val = _normalize_track_source(v)
-    return "" if val is None else f"track_source {op} '{val}'"
+    return None if val is None else (f"track_source {op} %s", [val])
+
+
+def _cmp(sql):
+    return lambda v: (sql, [v])
+
+
+def _int_cmp(sql):
+    return lambda v: (sql, [_int(v)])
 
-# Define a mapping of supported condition fields to SQL templates
+
+# Supported condition fields -> (sql fragment, params) builders.
+# Fields with a dict entry take an operator; the others ignore it.
 CONDITION_MAP = {
-    "min_plays": lambda v: f"play_count >= {int(v)}",
-    "max_plays": lambda v: f"play_count <= {int(v)}",
-    "added_after": lambda v: f"added_at >= '{v}'",
-    "added_before": lambda v: f"added_at <= '{v}'",
+    "min_plays": _int_cmp("play_count >= %s"),
+    "max_plays": _int_cmp("play_count <= %s"),
+    "added_after": _cmp("added_at >= %s"),
+    "added_before": _cmp("added_at <= %s"),
     "plays": {
-        "is": lambda v: f"play_count = {int(v)}",
-        "eq": lambda v: f"play_count = {int(v)}",
-        "gt": lambda v: f"play_count > {int(v)}",
-        "lt": lambda v: f"play_count < {int(v)}",
-        "gte": lambda v: f"play_count >= {int(v)}",
-        "lte": lambda v: f"play_count <= {int(v)}",
-        "is_not": lambda v: f"play_count != {int(v)}"
-    },
-    "is_liked": lambda v: f"is_liked = {str(v).upper()}",
-    "artist": lambda v: f"LOWER(artist) LIKE LOWER('%{v}%')",
-    "is_playable": lambda v: f"is_playable = {str(v).upper()}",
-    "added_in_last": {
-        "eq":  lambda v: "",
-        "gte": lambda v: "",
-        "lte": lambda v: "",
-    },
-    "last_played_in_last": {
-        "eq":  lambda v: "",
-        "is_not": lambda v: "",
+        "is": _int_cmp("play_count = %s"),
+        "eq": _int_cmp("play_count = %s"),
+        "gt": _int_cmp("play_count > %s"),
+        "lt": _int_cmp("play_count < %s"),
+        "gte": _int_cmp("play_count >= %s"),
+        "lte": _int_cmp("play_count <= %s"),
+        "is_not": _int_cmp("play_count != %s"),
     },
+    "is_liked": lambda v: ("is_liked = %s", [_bool(v)]),
+    "artist": lambda v: ("LOWER(artist) LIKE LOWER(%s)", [_contains(v)]),
+    "is_playable": lambda v: ("is_playable = %s", [_bool(v)]),
+    "added_in_last": {"eq", "gte", "lte"},
+    "last_played_in_last": {"eq", "is_not"},
     "date_added": {
-        "gt": lambda v: f"added_at > '{v}'",
-        "lt": lambda v: f"added_at < '{v}'",
-        "gte": lambda v: f"added_at >= '{v}'",
-        "lte": lambda v: f"added_at <= '{v}'",
-        "eq": lambda v: f"added_at = '{v}'"
+        "gt": _cmp("added_at > %s"),
+        "lt": _cmp("added_at < %s"),
+        "gte": _cmp("added_at >= %s"),
+        "lte": _cmp("added_at <= %s"),
+        "eq": _cmp("added_at = %s"),
     },
-    "album": lambda v: f"LOWER(album_name) LIKE LOWER('%{v}%')",
-    "track": lambda v: f"LOWER(track_name) LIKE LOWER('%{v}%')",
+    "album": lambda v: ("LOWER(album_name) LIKE LOWER(%s)", [_contains(v)]),
+    "track": lambda v: ("LOWER(track_name) LIKE LOWER(%s)", [_contains(v)]),
     "track_source": {
         "eq": lambda v: _source_clause(v, "="),
-        "is_not": lambda v: _source_clause(v, "<>")
+        "is_not": lambda v: _source_clause(v, "<>"),
     },
     "library_origin": {
-        "eq": lambda v: f"library_origin = '{v}'",
-        "is_not": lambda v: f"library_origin <> '{v}'"
+        "eq": _cmp("library_origin = %s"),
+        "is_not": _cmp("library_origin <> %s"),
     },
-    "last_played": lambda v: f"last_played_at >= '{v}'",
-    "first_played": lambda v: f"first_played_at >= '{v}'",
+    "last_played": _cmp("last_played_at >= %s"),
+    "first_played": _cmp("first_played_at >= %s"),
 }
 
-def build_track_query(rules_json):
+SORT_FIELD_MAP = {
+    "album": "album_name",
+    "artist": "artist",
+    "added": "added_at",
+    "plays": "play_count",
+    "last_played": "last_played_at",
+    "album_id": "album_id",
+    "disc_number": "disc_number",
+    "track_number": "track_number",
+}
+# Column names may also be given directly
+SORT_COLUMNS = set(SORT_FIELD_MAP.values()) | {"play_count", "track_name", "first_played_at"}
+
+
+def load_rules(rules_json):
     try:
         if isinstance(rules_json, dict):
-            rules = rules_json
-        elif isinstance(rules_json, str):
-            rules = json.loads(rules_json)
-        else:
-            rules = json.loads(json.dumps(rules_json))
-        log_event("rule_parser", f"🔍 Raw input to parse: {rules_json}")
-        log_event("rule_parser", f"📥 Loaded rules: {rules}")
+            return rules_json
+        if isinstance(rules_json, str):
+            return json.loads(rules_json)
+        return json.loads(json.dumps(rules_json))
     except json.JSONDecodeError:
         raise ValueError("Invalid JSON for rules")
 
-    def parse_condition_group(group):
-        connector = " AND " if group.get("match", "all") == "all" else " OR "
-        condition_strings = []
-
-        for condition in group.get("conditions", []):
-            if "conditions" in condition:
-                # Nested group
-                sub_clause = parse_condition_group(condition)
-                condition_strings.append(f"({sub_clause})")
-                continue
-
-            field = condition.get("field")
-            value = condition.get("value")
-            operator = condition.get("operator")
-
-            if not field or field not in CONDITION_MAP:
-                log_event("rule_parser", f"⚠️ Unsupported or missing field in rule: {condition}", level="error")
-                continue
-
-            try:
-                map_entry = CONDITION_MAP[field]
-                if field == 'added_in_last':
-                    if operator not in map_entry:
-                        raise ValueError(f"Unsupported operator '{operator}' for field '{field}'")
-                    condition_sql = _added_in_last_clause(value, condition.get('unit'), operator)
-                elif field == 'last_played_in_last':
-                    if operator not in map_entry:
-                        raise ValueError(f"Unsupported operator '{operator}' for field '{field}'")
-                    condition_sql = _last_played_in_last_clause(value, condition.get('unit'), operator)
-                else:
-                    if isinstance(map_entry, dict):
-                        if operator not in map_entry:
-                            raise ValueError(f"Unsupported operator '{operator}' for field '{field}'")
-                        condition_sql = map_entry[operator](value)
-                    else:
-                        condition_sql = map_entry(value)
-                if condition_sql and str(condition_sql).strip():
-                    condition_strings.append(condition_sql)
-                    log_event("rule_parser", f"✅ Parsed rule '{field}' -> {condition_sql}")
-                else:
-                    log_event("rule_parser", f"ℹ️ Skipping rule '{field}' because it produced no condition (likely 'both')")
-            except Exception as e:
-                log_event("rule_parser", f"❌ Error parsing rule '{field}': {e}", level="error")
-
-        return connector.join(condition_strings)
-
-    # Start parsing from top-level group
-    where_clause = parse_condition_group(rules)
-
-    if not where_clause or not where_clause.strip():
-        where_clause = "1=1"
+
+def parse_rules(group, errors):
+    """Rules group -> AST. Invalid conditions are dropped and described in ``errors``."""
+    connector = "AND" if group.get("match", "all") == "all" else "OR"
+    children = []
+    for condition in group.get("conditions", []):
+        if "conditions" in condition:
+            children.append(parse_rules(condition, errors))
+            continue
+
+        field = condition.get("field")
+        operator = condition.get("operator")
+        map_entry = CONDITION_MAP.get(field) if field else None
+        if map_entry is None:
+            errors.append(f"Unsupported or missing field in rule: {condition}")
+            continue
+        if isinstance(map_entry, (dict, set)) and operator not in map_entry:
+            errors.append(f"Unsupported operator '{operator}' for field '{field}'")
+            continue
+        children.append(Condition(field, operator, condition.get("value"), condition.get("unit")))
+    return Group(connector, children)
+
+
+def compile_condition(node):
+    """Condition -> (sql, params), or None when it filters nothing."""
+    if node.field == "added_in_last":
+        return _added_in_last_clause(node.value, node.unit)
+    if node.field == "last_played_in_last":
+        return _last_played_in_last_clause(node.value, node.unit, node.operator)
+    map_entry = CONDITION_MAP[node.field]
+    if isinstance(map_entry, dict):
+        return map_entry[node.operator](node.value)
+    return map_entry(node.value)
+
+
+def compile_group(node, params, errors):
+    parts = []
+    for child in node.children:
+        if isinstance(child, Group):
+            sub_clause = compile_group(child, params, errors)
+            if sub_clause:
+                parts.append(f"({sub_clause})")
+            continue
+        try:
+            compiled = compile_condition(child)
+        except (TypeError, ValueError) as e:
+            errors.append(f"Error parsing rule '{child.field}': {e}")
+            continue
+        if compiled:
+            sql, values = compiled
+            parts.append(sql)
+            params.extend(values)
+    return f" {node.connector} ".join(parts)
+
+
+def compile_sort(rules):
+    sort_fields = []
+    if isinstance(rules.get("sort"), list):
+        for sort_rule in rules["sort"]:
+            sort_by = sort_rule.get("by", "play_count")
+            direction = str(sort_rule.get("direction", "desc")).upper()
+            column = SORT_FIELD_MAP.get(sort_by, sort_by)
+            if column in SORT_COLUMNS and direction in ("ASC", "DESC"):
+                sort_fields.append(f"{column} {direction}")
+    return ", ".join(sort_fields) if sort_fields else "play_count DESC"
+
+
+# where: boolean SQL over unified_tracks columns; params: its bound values
+CompiledRules = namedtuple("CompiledRules", "where params order_by limit")
+
+
+def compile_rules(rules):
+    """Rules dict -> (CompiledRules, errors)."""
+    errors = []
+    params = []
+    where_clause = compile_group(parse_rules(rules, errors), params, errors)
+    # Parenthesized so a top-level "any" group can't swallow the filters below
+    where_clause = f"({where_clause})" if where_clause else "1=1"
 
     # Always include these
     if "is_playable" not in [c.get("field") for c in rules.get("conditions", [])]:
         where_clause += " AND is_playable = TRUE"
     where_clause += " AND excluded = FALSE"
 
-    # Sort clause
-    sort_clause = "ORDER BY play_count DESC"
-    if isinstance(rules.get("sort"), list):
-        sort_fields = []
-        sort_field_map = {
-            "album": "album_name",
-            "artist": "artist",
-            "added": "added_at",
-            "plays": "play_count",
-            "last_played": "last_played_at",
-            "album_id": "album_id",
-            "disc_number": "disc_number",
-            "track_number": "track_number"
-        }
-        for sort_rule in rules["sort"]:
-            sort_by = sort_rule.get("by", "play_count")
-            direction = sort_rule.get("direction", "desc").upper()
-            mapped_sort_by = sort_field_map.get(sort_by, sort_by)
-            if direction in ("ASC", "DESC"):
-                sort_fields.append(f"{mapped_sort_by} {direction}")
-        if sort_fields:
-            sort_clause = "ORDER BY " + ", ".join(sort_fields)
-
-    limit = rules.get("limit", 100)
-    query = f"SELECT 'spotify:track:' || track_id FROM unified_tracks WHERE {where_clause} {sort_clause} LIMIT {int(limit)}"
-
-    log_event("rule_parser", f"🛠 Built SQL: {query}")
-    return query
\ No newline at end of file
+    return CompiledRules(where_clause, tuple(params), compile_sort(rules), int(rules.get("limit", 100))), errors
+
+
+# ─────────────────────────────────────────────
+# Compiled-query cache
+# ─────────────────────────────────────────────
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def rules_hash(rules):
+    canonical = json.dumps(rules, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def get_compiled_rules(rules_json):
+    """Compile (or fetch from cache) the rules into a CompiledRules."""
+    rules = load_rules(rules_json)
+    key = rules_hash(rules)
+    with _cache_lock:
+        cached = _cache.get(key)
+        if cached is not None:
+            _cache.move_to_end(key)
+            return cached
+
+    compiled, errors = compile_rules(rules)
+    for error in errors:
+        log_event("rule_parser", f"⚠️ {error}", level="error")
+    log_event("rule_parser", f"🛠 Compiled rules {key[:12]}: WHERE {compiled.where} ORDER BY {compiled.order_by}",
+              extra={"params": list(compiled.params), "limit": compiled.limit})
+
+    with _cache_lock:
+        _cache[key] = compiled
+        while len(_cache) > RULE_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return compiled
+
+
+def build_track_query(rules_json):
+    """Compile playlist rules into ``(sql, params)`` for ``cur.execute``."""
+    compiled = get_compiled_rules(rules_json)
+    query = (f"SELECT 'spotify:track:' || track_id FROM unified_tracks "
+             f"WHERE {compiled.where} ORDER BY {compiled.order_by} LIMIT %s")
+    return query, list(compiled.params) + [compiled.limit]
+
+
+def build_batch_track_query(rules_list):
+    """Compile several playlists' rules into one shared-scan query.
+
+    unified_tracks is read once: each row is tagged with one boolean per
+    playlist, then every playlist ranks its own matches with its own sort
+    and limit. Returns ``(sql, params)``; result rows are
+    ``(playlist_index, uri)`` ordered by playlist index, then position.
+    """
+    compiled = [get_compiled_rules(rules) for rules in rules_list]
+    if not compiled:
+        raise ValueError("No rules to compile")
+
+    params = []
+    flags = []
+    for i, c in enumerate(compiled):
+        flags.append(f"({c.where}) AS m{i}")
+        params.extend(c.params)
+    any_match = " OR ".join(f"m{i}" for i in range(len(compiled)))
+
+    branches = []
+    for i, c in enumerate(compiled):
+        branches.append(f"""
+            SELECT {i} AS idx, track_id, rn FROM (
+                SELECT track_id, ROW_NUMBER() OVER (ORDER BY {c.order_by}) AS rn
+                FROM tagged WHERE m{i}
+            ) ranked_{i}
+            WHERE rn <= %s""")
+        params.append(c.limit)
+
+    query = f"""
+        WITH tagged AS MATERIALIZED (
+            SELECT * FROM (
+                SELECT u.*, {", ".join(flags)}
+                FROM unified_tracks u
+            ) flagged
+            WHERE {any_match}
+        )
+        SELECT idx, 'spotify:track:' || track_id
+        FROM ({" UNION ALL ".join(branches)}
+        ) picked
+        ORDER BY idx, rn
+    """
+    return query, params
+
+
+# ─────────────────────────────────────────────
+# Execution (optionally via server-side prepared statements)
+# ─────────────────────────────────────────────
+# Statement names PREPAREd on each physical connection
+_prepared = weakref.WeakKeyDictionary()
+
+def _to_positional(query, count):
+    # "%s" placeholders -> "$1".."$n" for PREPARE (rule SQL has no literal %)
+    parts = query.split("%s")
+    if len(parts) != count + 1:
+        raise ValueError("placeholder/param count mismatch")
+    return "".join(part + (f"${i + 1}" if i < count else "") for i, part in enumerate(parts))
+
+
+def execute_track_query(cur, query, params, prepared=None):
+    """Run a compiled track query on ``cur``.
+
+    With prepared statements enabled, each distinct SQL text is PREPAREd
+    once per physical connection and then EXECUTEd with the params, so the
+    per-playlist queries of a rebuild skip parsing and planning.
+    """
+    if prepared is None:
+        prepared = USE_PREPARED_STATEMENTS
+    if not prepared:
+        cur.execute(query, params)
+        return
+
+    name = "rule_q_" + hashlib.sha1(query.encode("utf-8")).hexdigest()[:16]
+    with _cache_lock:
+        statements = _prepared.setdefault(cur.connection, set())
+    if name not in statements:
+        cur.execute(f"PREPARE {name} AS {_to_positional(query, len(params))}")
+        statements.add(name)
+    placeholders = ", ".join(["%s"] * len(params))
+    cur.execute(f"EXECUTE {name} ({placeholders})" if params else f"EXECUTE {name}", params)
@@ -1,7 +1,25 @@
+import io
 import os
+import time
+import atexit
+import threading
+from contextlib import contextmanager
+
 import psycopg2
+from psycopg2 import extensions
+from psycopg2.pool import PoolError
 
-def get_db_connection():
+# ─────────────────────────────────────────────
+# Pool tunables (via env vars)
+# ─────────────────────────────────────────────
+POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+POOL_IDLE_TIMEOUT_S = float(os.getenv("DB_POOL_IDLE_TIMEOUT_S", "300"))
+POOL_CHECKOUT_TIMEOUT_S = float(os.getenv("DB_POOL_CHECKOUT_TIMEOUT_S", "30"))
+# Connections idle for longer than this are pinged with SELECT 1 before reuse
+POOL_PING_AFTER_S = float(os.getenv("DB_POOL_PING_AFTER_S", "30"))
+
+
+def _connect():
     return psycopg2.connect(
         dbname=os.environ['DB_NAME'],
         user=os.environ['DB_USER'],
@@ -9,4 +27,243 @@ def get_db_connection():
         host=os.environ['DB_HOST'],
         port=os.environ.get('DB_PORT', 5432),
         sslmode='require'
-    )
\ No newline at end of file
+    )
+
+
+class _PooledSlot:
+    """A physical connection plus the bookkeeping the pool keeps for it."""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.last_used = time.monotonic()
+        # Per-physical-connection scratch space (survives checkouts)
+        self.state = {}
+
+
+class PooledConnection:
+    """Proxy handed out by the pool.
+
+    Behaves like a psycopg2 connection; ``close()`` hands the physical
+    connection back to the pool instead of tearing down the TLS session.
+    """
+
+    def __init__(self, pool, slot):
+        self._pool = pool
+        self._slot = slot
+
+    @property
+    def pool_state(self):
+        """Dict tied to the physical connection, e.g. for session-level caches."""
+        return self._checked_out().state
+
+    @property
+    def closed(self):
+        if self._slot is None:
+            return 1
+        return self._slot.raw.closed
+
+    def close(self):
+        if self._slot is None:
+            return
+        slot, self._slot = self._slot, None
+        self._pool.release(slot)
+
+    def _checked_out(self):
+        if self._slot is None:
+            raise psycopg2.InterfaceError("connection already returned to the pool")
+        return self._slot
+
+    def __getattr__(self, name):
+        return getattr(self._checked_out().raw, name)
+
+    def __setattr__(self, name, value):
+        if name in ("_pool", "_slot"):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._checked_out().raw, name, value)
+
+    def __enter__(self):
+        self._checked_out().raw.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return self._checked_out().raw.__exit__(exc_type, exc, tb)
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class ConnectionPool:
+    """Thread-safe pool of PostgreSQL connections.
+
+    - At most ``max_size`` connections are checked out at once; callers block
+      up to ``checkout_timeout`` seconds for a free slot.
+    - Idle connections older than ``idle_timeout`` are closed on the next checkout.
+    - Connections that sat idle for a while are health-checked before reuse.
+    """
+
+    def __init__(self, connect=_connect, max_size=POOL_MAX_SIZE, idle_timeout=POOL_IDLE_TIMEOUT_S,
+                 checkout_timeout=POOL_CHECKOUT_TIMEOUT_S, ping_after=POOL_PING_AFTER_S):
+        self._connect = connect
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self.ping_after = ping_after
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._idle = []
+        self._pid = os.getpid()
+
+    def _reset_after_fork(self):
+        # Never share sockets with a parent process; just forget its connections.
+        self._idle = []
+        self._slots = threading.BoundedSemaphore(self.max_size)
+        self._pid = os.getpid()
+
+    def _healthy(self, slot):
+        if slot.raw.closed:
+            return False
+        if time.monotonic() - slot.last_used < self.ping_after:
+            return True
+        try:
+            with slot.raw.cursor() as cur:
+                cur.execute("SELECT 1")
+            slot.raw.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, slot):
+        try:
+            slot.raw.close()
+        except Exception:
+            pass
+
+    def getconn(self):
+        if os.getpid() != self._pid:
+            self._reset_after_fork()
+        if not self._slots.acquire(timeout=self.checkout_timeout):
+            raise PoolError(f"connection pool exhausted ({self.max_size} in use)")
+        try:
+            while True:
+                with self._lock:
+                    now = time.monotonic()
+                    expired = [s for s in self._idle if now - s.last_used > self.idle_timeout]
+                    self._idle = [s for s in self._idle if now - s.last_used <= self.idle_timeout]
+                    slot = self._idle.pop() if self._idle else None
+                for stale in expired:
+                    self._discard(stale)
+                if slot is None:
+                    slot = _PooledSlot(self._connect())
+                    break
+                if self._healthy(slot):
+                    break
+                self._discard(slot)
+        except Exception:
+            self._slots.release()
+            raise
+        return PooledConnection(self, slot)
+
+    def release(self, slot):
+        try:
+            raw = slot.raw
+            if raw.closed:
+                return
+            if raw.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                # Mirror psycopg2's close(): anything uncommitted is discarded
+                raw.rollback()
+            if raw.autocommit:
+                raw.autocommit = False
+            slot.last_used = time.monotonic()
+            with self._lock:
+                self._idle.append(slot)
+        except psycopg2.Error:
+            self._discard(slot)
+        finally:
+            self._slots.release()
+
+    def closeall(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for slot in idle:
+            self._discard(slot)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool()
+    return _pool
+
+
+def get_db_connection():
+    """Check out a pooled connection; call ``close()`` to hand it back."""
+    return get_pool().getconn()
+
+
+@contextmanager
+def db_connection():
+    """Context-managed pooled connection.
+
+    Commits on success, rolls back on error and always returns the
+    connection to the pool.
+    """
+    conn = get_db_connection()
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+# ─────────────────────────────────────────────
+# Bulk loading
+# ─────────────────────────────────────────────
+def _copy_text(value):
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    return (str(value)
+            .replace("\\", "\\\\")
+            .replace("\t", "\\t")
+            .replace("\n", "\\n")
+            .replace("\r", "\\r"))
+
+
+def copy_rows(cur, table, columns, rows):
+    """Stream ``rows`` into ``table`` with COPY ... FROM STDIN.
+
+    Values are written in COPY's text format (``None`` becomes NULL), so
+    anything whose ``str()`` PostgreSQL can parse for the column type works.
+    Returns the number of rows sent.
+    """
+    buf = io.StringIO()
+    count = 0
+    for row in rows:
+        buf.write("\t".join(_copy_text(v) for v in row))
+        buf.write("\n")
+        count += 1
+    if not count:
+        return 0
+    buf.seek(0)
+    cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buf)
+    return count
+
+
+@atexit.register
+def _close_pool():
+    if _pool is not None:
+        _pool.closeall()
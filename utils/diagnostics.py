@@ -1,5 +1,6 @@
 from psycopg2.extras import DictCursor
 from utils.db_utils import get_db_connection
+from utils.match_keys import fuzzy_match_sql
 
 def get_duplicate_album_track_counts():
     conn = get_db_connection()
@@ -29,7 +30,7 @@ def get_fuzzy_matched_plays():
     conn = get_db_connection()
     cur = conn.cursor()
 
-    cur.execute("""
+    cur.execute(f"""
         SELECT
             p.id AS play_id,
             p.track_id AS original_track_id,
@@ -50,9 +51,7 @@ def get_fuzzy_matched_plays():
                 t.id AS matched_track_id
             FROM plays p
             JOIN tracks t
-              ON LOWER(p.track_name) = LOWER(t.name)
-             AND LOWER(p.artist_name) = LOWER(t.artist)
-             AND ABS(COALESCE(p.duration_ms, 0) - COALESCE(t.duration_ms, 0)) <= 1000
+              ON {fuzzy_match_sql("p", "t")}
             WHERE p.track_id != t.id
         ) fmt ON fmt.play_id = p.id
 
@@ -1,16 +1,119 @@
 import os
-from utils.db_utils import get_db_connection
+import sys
 import json
+import queue
+import atexit
+import threading
 from datetime import datetime
 
+from psycopg2.extras import execute_values
+
+from utils.db_utils import get_db_connection
+
+# ─────────────────────────────────────────────
+# Buffer tunables (via env vars)
+# ─────────────────────────────────────────────
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "100"))
+LOG_FLUSH_INTERVAL_S = float(os.getenv("LOG_FLUSH_INTERVAL_S", "2"))
+# Hard cap on queued events; beyond this, events go straight to stderr
+LOG_QUEUE_MAX = int(os.getenv("LOG_QUEUE_MAX", "10000"))
+
+_queue = queue.Queue(maxsize=LOG_QUEUE_MAX)
+_worker = None
+_worker_pid = None
+_worker_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_stop = threading.Event()
+
+
+def _to_stderr(rows, reason=None):
+    if reason:
+        print(f"⚠️ log sink unavailable ({reason}); writing {len(rows)} event(s) to stderr", file=sys.stderr)
+    for ts, source, level, message, extra in rows:
+        print(f"{ts.isoformat()} [{level}] {source}: {message} {extra}", file=sys.stderr)
+
+
+def _write(rows):
+    if not rows:
+        return
+    try:
+        conn = get_db_connection()
+        try:
+            cur = conn.cursor()
+            execute_values(cur, """
+                INSERT INTO logs (timestamp, source, level, message, extra)
+                VALUES %s
+            """, rows, page_size=len(rows))
+            conn.commit()
+            cur.close()
+        finally:
+            conn.close()
+    except Exception as e:
+        _to_stderr(rows, reason=e)
+
+
+def _drain(limit=None):
+    rows = []
+    while limit is None or len(rows) < limit:
+        try:
+            rows.append(_queue.get_nowait())
+        except queue.Empty:
+            break
+    return rows
+
+
+def flush_logs():
+    """Write every queued event now (blocks until done)."""
+    with _flush_lock:
+        while True:
+            rows = _drain(LOG_BATCH_SIZE)
+            if not rows:
+                break
+            _write(rows)
+
+
+def _run():
+    while not _stop.is_set():
+        try:
+            first = _queue.get(timeout=LOG_FLUSH_INTERVAL_S)
+        except queue.Empty:
+            continue
+        # Give the batch a chance to fill before paying for a round trip
+        if _queue.qsize() < LOG_BATCH_SIZE - 1:
+            _stop.wait(min(LOG_FLUSH_INTERVAL_S, 0.25))
+        with _flush_lock:
+            _write([first] + _drain(LOG_BATCH_SIZE - 1))
+
+
+def _ensure_worker():
+    global _worker, _worker_pid, _queue
+    if _worker is not None and _worker_pid == os.getpid() and _worker.is_alive():
+        return
+    with _worker_lock:
+        if _worker is not None and _worker_pid == os.getpid() and _worker.is_alive():
+            return
+        if _worker_pid is not None and _worker_pid != os.getpid():
+            # Forked child: the parent's buffer and thread don't belong to us
+            _queue = queue.Queue(maxsize=LOG_QUEUE_MAX)
+        _stop.clear()
+        _worker = threading.Thread(target=_run, name="log-sink", daemon=True)
+        _worker_pid = os.getpid()
+        _worker.start()
+
+
 def log_event(source, message, level="info", extra=None):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO logs (timestamp, source, level, message, extra)
-        VALUES (%s, %s, %s, %s, %s)
-    """, (datetime.utcnow(), source, level, message, json.dumps(extra)))
-    conn.commit()
-    cur.close()
-    conn.close()
+    row = (datetime.utcnow(), source, level, message, json.dumps(extra))
+    _ensure_worker()
+    try:
+        _queue.put_nowait(row)
+    except queue.Full:
+        _to_stderr([row], reason="log queue full")
+
 
+@atexit.register
+def _shutdown():
+    # Registered after utils.db_utils, so this runs before the pool is closed
+    _stop.set()
+    if _worker is not None and _worker_pid == os.getpid():
+        _worker.join(timeout=LOG_FLUSH_INTERVAL_S + 5)
+    flush_logs()
@@ -0,0 +1,57 @@
+"""
+Persisted fuzzy-match keys on tracks and every play source.
+
+Each table gets two STORED generated columns, so every ingest path fills
+them without code changes:
+
+- match_key:       lower(title) || U+001F || lower(artist)  (NULL if either is NULL)
+- duration_bucket: COALESCE(duration_ms, 0) / 1000
+
+A play fuzzy-matches a track when the match keys are equal and the
+durations are within 1000 ms, i.e. an equi-join on match_key with the
+bucket within +-1 plus the exact ABS() check. Normalization is plain
+lower() on purpose: unified_tracks' change tracking records lower-cased
+name/artist keys and the two must agree.
+"""
+
+MATCH_KEY_SEPARATOR_SQL = "E'\\x1f'"
+
+# table -> (title column, artist column)
+MATCH_KEY_SOURCES = {
+    "tracks": ("name", "artist"),
+    "plays": ("track_name", "artist_name"),
+    "spotify_play_history": ("track_name", "artist_name"),
+    "apple_music_play_history": ("track_name", "artist_name"),
+}
+
+
+def match_key_sql(title, artist):
+    """SQL expression of the match key for the given title/artist expressions."""
+    return f"(LOWER({title}) || {MATCH_KEY_SEPARATOR_SQL} || LOWER({artist}))"
+
+
+def fuzzy_match_sql(play, track):
+    """Join predicate: play alias ``play`` fuzzy-matches track alias ``track``."""
+    return (f"{track}.match_key = {play}.match_key "
+            f"AND {track}.duration_bucket BETWEEN {play}.duration_bucket - 1 AND {play}.duration_bucket + 1 "
+            f"AND ABS(COALESCE({play}.duration_ms, 0) - COALESCE({track}.duration_ms, 0)) <= 1000")
+
+
+def ensure_match_keys(cur):
+    """Add the generated key columns (one-time table rewrite) and their indexes."""
+    for table, (title, artist) in MATCH_KEY_SOURCES.items():
+        cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name = %s", (table,))
+        existing = {row[0] for row in cur.fetchall()}
+        if "match_key" not in existing:
+            print(f"🛠 Adding match_key to {table}")
+            cur.execute(f"""
+                ALTER TABLE {table}
+                ADD COLUMN match_key TEXT GENERATED ALWAYS AS {match_key_sql(title, artist)} STORED
+            """)
+        if "duration_bucket" not in existing:
+            print(f"🛠 Adding duration_bucket to {table}")
+            cur.execute(f"""
+                ALTER TABLE {table}
+                ADD COLUMN duration_bucket INTEGER GENERATED ALWAYS AS (COALESCE(duration_ms, 0) / 1000) STORED
+            """)
+        cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_match_key ON {table} (match_key, duration_bucket)")
@@ -0,0 +1,103 @@
+"""
+In-process job pipeline.
+
+Every sync job exposes ``run(context=None)``; ``run_pipeline`` imports and
+runs a list of them in this interpreter, so they share one Spotify client
+(token + keep-alive session + rate limiter), one DB connection pool and the
+buffered logger instead of paying for a fresh process each.
+
+    from utils.pipeline import PipelineContext, run_pipeline
+    run_pipeline(["sync_saved_albums", "sync_album_tracks"], PipelineContext(user_id=1))
+
+The scripts still run standalone (``python api_syncs/<job>.py``); their
+``__main__`` blocks just call ``run()``.
+"""
+import time
+import importlib
+
+from utils.logger import log_event, flush_logs
+
+# Job name -> module exposing run(context)
+JOBS = {
+    "track_plays": "api_syncs.track_plays",
+    "maintain_play_partitions": "api_syncs.maintain_play_partitions",
+    "sync_saved_albums": "api_syncs.sync_saved_albums",
+    "sync_saved_albums_lite": "api_syncs.sync_saved_albums_lite",
+    "sync_album_tracks": "api_syncs.sync_album_tracks",
+    "sync_liked_tracks": "api_syncs.sync_liked_tracks",
+    "sync_liked_tracks_full": "api_syncs.sync_liked_tracks_full",
+    "sync_artists": "api_syncs.sync_artists",
+    "check_track_availability": "api_syncs.check_track_availability",
+    "sync_exclusions": "api_syncs.sync_exclusions",
+    "check_canonical_albums": "api_syncs.check_canonical_albums",
+    "materialized_plays": "api_syncs.materialized_plays",
+    "materialized_views": "api_syncs.materialized_views",
+    "materialized_metrics": "api_syncs.materialized_metrics",
+    "update_dynamic_playlists": "playlists.update_dynamic_playlists",
+}
+
+
+class PipelineContext:
+    """State shared by the jobs of one pipeline run."""
+
+    def __init__(self, user_id=None, options=None, source="pipeline"):
+        self.user_id = user_id
+        # Free-form per-run options, e.g. {"full_rebuild": True}
+        self.options = dict(options or {})
+        self.source = source
+        # [(job, seconds, ok)] in run order
+        self.timings = []
+
+    @property
+    def spotify(self):
+        from utils.spotify_auth import get_spotify_client
+        return get_spotify_client()
+
+    def connection(self):
+        from utils.db_utils import get_db_connection
+        return get_db_connection()
+
+
+def ensure_context(context):
+    return context if context is not None else PipelineContext()
+
+
+def run_job(name, context=None):
+    """Run one job by name; returns the job's return value."""
+    context = ensure_context(context)
+    start = time.perf_counter()
+    ok = False
+    try:
+        module = importlib.import_module(JOBS[name])
+        result = module.run(context)
+        ok = True
+        return result
+    finally:
+        context.timings.append((name, time.perf_counter() - start, ok))
+
+
+def run_pipeline(job_names, context=None, stop_on_error=False):
+    """Run ``job_names`` in order in this process.
+
+    A failing job is logged and the pipeline moves on (as the old subprocess
+    chains did) unless ``stop_on_error`` is set. Returns the names of the
+    jobs that failed.
+    """
+    context = ensure_context(context)
+    failed = []
+    pipeline_start = time.perf_counter()
+    for name in job_names:
+        log_event(context.source, f"🚀 Starting {name}" + (f" for user {context.user_id}" if context.user_id else ""))
+        try:
+            run_job(name, context)
+            log_event(context.source, f"✅ Completed {name} in {context.timings[-1][1]:.1f}s")
+        except Exception as e:
+            failed.append(name)
+            log_event(context.source, f"❌ Failed {name} after {context.timings[-1][1]:.1f}s: {e}", level="error")
+            if stop_on_error:
+                break
+
+    summary = ", ".join(f"{name}={elapsed:.1f}s{'' if ok else ' (failed)'}" for name, elapsed, ok in context.timings)
+    log_event(context.source, f"🏁 Pipeline finished in {time.perf_counter() - pipeline_start:.1f}s: {summary}")
+    flush_logs()
+    return failed
@@ -0,0 +1,54 @@
+"""
+Deterministic per-play fingerprint for apple_music_play_history.
+
+Apple play-activity rows carry no stable id that survives a re-export, so a
+play is identified by when it happened and what was played:
+
+    md5(epoch(played_at) || U+001F || lower(track_name) || U+001F || lower(artist_name))
+
+It is a STORED generated column (so every ingest path fills it) with a
+unique index on (play_fingerprint, played_at); the table is partitioned on
+played_at, which therefore has to be part of the key. Durations, ids and
+album names are left out on purpose: enrichment may fill or correct them
+later, and that must not turn a re-imported play into a "new" one.
+"""
+
+FINGERPRINT_TABLE = "apple_music_play_history"
+FINGERPRINT_INDEX = "idx_apple_music_play_history_fingerprint"
+
+
+def fingerprint_sql(played_at, title, artist):
+    """SQL expression of the fingerprint for the given column expressions."""
+    return (f"md5(COALESCE(EXTRACT(EPOCH FROM {played_at})::text, '') || E'\\x1f' || "
+            f"COALESCE(LOWER({title}), '') || E'\\x1f' || COALESCE(LOWER({artist}), ''))")
+
+
+def ensure_play_fingerprint(cur):
+    """Add the fingerprint column, drop existing duplicates once and create the unique index."""
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL", (FINGERPRINT_INDEX,))
+    if cur.fetchone()[0]:
+        return
+
+    cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name = %s", (FINGERPRINT_TABLE,))
+    if "play_fingerprint" not in {row[0] for row in cur.fetchall()}:
+        print(f"🛠 Adding play_fingerprint to {FINGERPRINT_TABLE}")
+        cur.execute(f"""
+            ALTER TABLE {FINGERPRINT_TABLE}
+            ADD COLUMN play_fingerprint TEXT
+            GENERATED ALWAYS AS ({fingerprint_sql('played_at', 'track_name', 'artist_name')}) STORED
+        """)
+
+    # Earlier re-imports left duplicates behind; keep the first copy of each play
+    cur.execute(f"""
+        DELETE FROM {FINGERPRINT_TABLE} a
+        USING {FINGERPRINT_TABLE} b
+        WHERE a.play_fingerprint = b.play_fingerprint
+          AND a.played_at = b.played_at
+          AND a.id > b.id
+    """)
+    if cur.rowcount:
+        print(f"🛠 Removed {cur.rowcount} duplicate plays from {FINGERPRINT_TABLE}")
+    cur.execute(f"""
+        CREATE UNIQUE INDEX IF NOT EXISTS {FINGERPRINT_INDEX}
+        ON {FINGERPRINT_TABLE} (play_fingerprint, played_at)
+    """)
@@ -0,0 +1,289 @@
+"""
+Monthly range partitioning of the play tables.
+
+plays, spotify_play_history and apple_music_play_history are partitioned by
+RANGE (played_at): one partition per calendar month ({table}_pYYYY_MM) plus a
+DEFAULT partition ({table}_default) for rows outside every month partition.
+
+- Queries bounded on played_at (recent windows, metrics) only scan the
+  matching months; a BRIN index on played_at keeps range scans cheap inside
+  the big historical partitions.
+- Partitioned unique keys must contain the partition key, so the primary key
+  is (id, played_at) and played_at is NOT NULL. UNIQUE (track_id, played_at)
+  already qualifies, so ON CONFLICT upserts are unchanged.
+- Future months are created ahead of time by ensure_play_partitions(); rows
+  that still land in DEFAULT are moved out when their month is created.
+- Old months can be detached (detach_partitions_before) and archived or
+  dropped as ordinary tables.
+
+A pre-existing regular table is converted once by ensure_partitioned_play_table().
+"""
+
+import os
+import re
+from datetime import datetime
+
+from utils.match_keys import MATCH_KEY_SOURCES, match_key_sql
+
+PLAY_TABLES = ("plays", "spotify_play_history", "apple_music_play_history")
+# Named unique indexes (the upsert targets of plays / spotify_play_history)
+UNIQUE_INDEXES = {
+    "plays": "idx_plays_unique",
+    "spotify_play_history": "idx_spotify_play_history_unique",
+}
+CHECKED_AT_DEFAULTS = {"plays": " DEFAULT CURRENT_TIMESTAMP"}
+# Views over the play tables that must be dropped before a migration (recreated by their jobs)
+DEPENDENT_VIEWS = ("unified_plays_mv",)
+
+MONTHS_AHEAD = int(os.getenv("PLAY_PARTITION_MONTHS_AHEAD", "3"))
+# Detach month partitions older than this many months (0 = keep everything attached)
+DETACH_AFTER_MONTHS = int(os.getenv("PLAY_PARTITION_DETACH_AFTER_MONTHS", "0"))
+
+PARTITION_NAME_RE = re.compile(r"_p(\d{4})_(\d{2})$")
+
+PLAY_TABLE_DDL = """
+CREATE TABLE {table} (
+    id INTEGER NOT NULL DEFAULT nextval('{sequence}'),
+    track_id TEXT,
+    played_at TIMESTAMP NOT NULL,
+    track_name TEXT,
+    artist_id TEXT,
+    duration_ms INTEGER,
+    artist_name TEXT,
+    album_id TEXT,
+    album_name TEXT,
+    album_type TEXT,
+    checked_at TIMESTAMP{checked_at_default},
+    match_key TEXT GENERATED ALWAYS AS {match_key} STORED,
+    duration_bucket INTEGER GENERATED ALWAYS AS (COALESCE(duration_ms, 0) / 1000) STORED
+) PARTITION BY RANGE (played_at)
+"""
+
+
+# ─────────────────────────────────────────────
+# Queries
+# ─────────────────────────────────────────────
+def plays_since_sql(columns, since):
+    """UNION ALL of ``columns`` from every play table with ``played_at >= since``.
+
+    The bound sits inside each branch, so every table prunes to the months
+    in the window (``since`` may be a stable expression like
+    ``NOW() - INTERVAL '30 days'``; it is pruned at executor startup).
+    """
+    return "\n    UNION ALL\n".join(
+        f"    SELECT {columns} FROM {table} WHERE played_at >= {since}" for table in PLAY_TABLES
+    )
+
+
+# ─────────────────────────────────────────────
+# Month helpers
+# ─────────────────────────────────────────────
+def month_start(value):
+    return datetime(value.year, value.month, 1)
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table, month):
+    return f"{table}_p{month:%Y_%m}"
+
+
+def _relkind(cur, name):
+    cur.execute("""
+        SELECT c.relkind FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = current_schema() AND c.relname = %s
+    """, (name,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def is_partitioned(cur, table):
+    return _relkind(cur, table) == "p"
+
+
+def attached_partitions(cur, table):
+    cur.execute("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = %s::regclass
+    """, (table,))
+    return {row[0] for row in cur.fetchall()}
+
+
+def _stored_columns(cur, table):
+    """Insertable columns of ``table`` in ordinal order (generated columns excluded)."""
+    cur.execute("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s AND is_generated = 'NEVER'
+        ORDER BY ordinal_position
+    """, (table,))
+    return [row[0] for row in cur.fetchall()]
+
+
+# ─────────────────────────────────────────────
+# Partition creation
+# ─────────────────────────────────────────────
+def _create_month_partition(cur, table, month):
+    name = partition_name(table, month)
+    bounds = (month.isoformat(sep=" "), add_months(month, 1).isoformat(sep=" "))
+    default = f"{table}_default"
+
+    cur.execute(f"SELECT EXISTS (SELECT 1 FROM {default} WHERE played_at >= %s AND played_at < %s)", bounds)
+    if not cur.fetchone()[0]:
+        cur.execute(f"CREATE TABLE {name} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)", bounds)
+        return
+
+    # DEFAULT already holds rows for this month: move them into a standalone
+    # table first, then attach it (attaching re-checks DEFAULT for overlaps)
+    columns = ", ".join(_stored_columns(cur, table))
+    cur.execute(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING GENERATED)")
+    cur.execute(f"""
+        WITH moved AS (
+            DELETE FROM {default} WHERE played_at >= %s AND played_at < %s
+            RETURNING {columns}
+        )
+        INSERT INTO {name} ({columns}) SELECT {columns} FROM moved
+    """, bounds)
+    cur.execute(f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)", bounds)
+
+
+def ensure_month_partitions(cur, table, start, end):
+    """Create the missing month partitions of ``table`` covering [start, end]. Returns their names."""
+    created = []
+    month = month_start(start)
+    while month <= end:
+        name = partition_name(table, month)
+        # A detached (archived) month keeps its name; its rows now go to DEFAULT
+        if _relkind(cur, name) is None:
+            _create_month_partition(cur, table, month)
+            created.append(name)
+        month = add_months(month, 1)
+    return created
+
+
+def ensure_play_partitions(cur, start=None, end=None, tables=PLAY_TABLES):
+    """Make sure every partitioned play table has months from ``start`` (default:
+    this month) through ``end`` (default: MONTHS_AHEAD months from now)."""
+    now = datetime.utcnow()
+    start = start or now
+    end = end or add_months(month_start(now), MONTHS_AHEAD)
+    created = []
+    for table in tables:
+        if is_partitioned(cur, table):
+            created.extend(ensure_month_partitions(cur, table, start, end))
+    return created
+
+
+def _add_keys(cur, table):
+    cur.execute(f"ALTER TABLE {table} ADD PRIMARY KEY (id, played_at)")
+    if table in UNIQUE_INDEXES:
+        cur.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {UNIQUE_INDEXES[table]} ON {table} (track_id, played_at)")
+    cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_played_at_brin ON {table} USING BRIN (played_at)")
+
+
+def _create_partitioned(cur, table, sequence):
+    title, artist = MATCH_KEY_SOURCES[table]
+    cur.execute(PLAY_TABLE_DDL.format(
+        table=table,
+        sequence=sequence,
+        checked_at_default=CHECKED_AT_DEFAULTS.get(table, ""),
+        match_key=match_key_sql(title, artist),
+    ))
+    cur.execute(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT")
+
+
+# ─────────────────────────────────────────────
+# Creation / one-time migration
+# ─────────────────────────────────────────────
+def ensure_partitioned_play_table(cur, table):
+    """Create ``table`` partitioned, or convert an existing regular table.
+
+    The migration copies every row (ids and the id sequence are kept) inside
+    the caller's transaction. Rows without a played_at cannot be partitioned;
+    they are set aside in {table}_null_played_at. Returns True if anything changed.
+    """
+    kind = _relkind(cur, table)
+    if kind == "p":
+        return False
+
+    if kind is None:
+        sequence = f"{table}_id_seq"
+        cur.execute(f"CREATE SEQUENCE IF NOT EXISTS {sequence}")
+        _create_partitioned(cur, table, sequence)
+        _add_keys(cur, table)
+        cur.execute(f"ALTER SEQUENCE {sequence} OWNED BY {table}.id")
+        ensure_month_partitions(cur, table, datetime.utcnow(), add_months(month_start(datetime.utcnow()), MONTHS_AHEAD))
+        return True
+
+    legacy = f"{table}_unpartitioned"
+    print(f"🛠 Converting {table} to monthly partitions")
+    for view in DEPENDENT_VIEWS:
+        cur.execute(f"DROP MATERIALIZED VIEW IF EXISTS {view}")
+    cur.execute(f"ALTER TABLE {table} RENAME TO {legacy}")
+
+    cur.execute("SELECT pg_get_serial_sequence(%s, 'id')", (legacy,))
+    sequence = cur.fetchone()[0]
+    if sequence is None:
+        sequence = f"{table}_id_seq"
+        cur.execute(f"CREATE SEQUENCE IF NOT EXISTS {sequence}")
+        cur.execute(f"SELECT setval('{sequence}', COALESCE((SELECT MAX(id) FROM {legacy}), 0) + 1, FALSE)")
+    else:
+        # Keep the sequence alive when the legacy table is dropped
+        cur.execute(f"ALTER SEQUENCE {sequence} OWNED BY NONE")
+
+    _create_partitioned(cur, table, sequence)
+    cur.execute(f"SELECT MIN(played_at) FROM {legacy}")
+    oldest = cur.fetchone()[0]
+    now = datetime.utcnow()
+    ensure_month_partitions(cur, table, oldest or now, add_months(month_start(now), MONTHS_AHEAD))
+
+    legacy_columns = set(_stored_columns(cur, legacy))
+    columns = ", ".join(c for c in _stored_columns(cur, table) if c in legacy_columns)
+    cur.execute(f"INSERT INTO {table} ({columns}) SELECT {columns} FROM {legacy} WHERE played_at IS NOT NULL")
+    copied = cur.rowcount
+
+    cur.execute(f"SELECT COUNT(*) FROM {legacy} WHERE played_at IS NULL")
+    orphaned = cur.fetchone()[0]
+    if orphaned:
+        cur.execute(f"CREATE TABLE {table}_null_played_at AS SELECT * FROM {legacy} WHERE played_at IS NULL")
+    cur.execute(f"DROP TABLE {legacy}")
+
+    # Index/constraint names are free again now that the legacy table is gone
+    _add_keys(cur, table)
+    cur.execute(f"ALTER SEQUENCE {sequence} OWNED BY {table}.id")
+    cur.execute(f"ANALYZE {table}")
+    print(f"🛠 Moved {copied} rows into {table} partitions"
+          + (f"; {orphaned} rows without played_at kept in {table}_null_played_at" if orphaned else ""))
+    return True
+
+
+# ─────────────────────────────────────────────
+# Archival
+# ─────────────────────────────────────────────
+def detach_partitions_before(cur, table, before):
+    """Detach month partitions of ``table`` that end on or before ``before``.
+
+    Detached partitions stay as ordinary tables ({table}_pYYYY_MM) to be
+    dumped or dropped. DETACH fires no triggers, so a full unified_tracks
+    rebuild is queued. Returns the detached names.
+    """
+    detached = []
+    for name in sorted(attached_partitions(cur, table)):
+        match = PARTITION_NAME_RE.search(name)
+        if not match:
+            continue  # DEFAULT partition
+        month = datetime(int(match.group(1)), int(match.group(2)), 1)
+        if add_months(month, 1) <= before:
+            cur.execute(f"ALTER TABLE {table} DETACH PARTITION {name}")
+            detached.append(name)
+
+    if detached:
+        cur.execute("SELECT to_regclass('unified_tracks_dirty') IS NOT NULL")
+        if cur.fetchone()[0]:
+            cur.execute("INSERT INTO unified_tracks_dirty (kind, key) VALUES ('full', %s) ON CONFLICT DO NOTHING",
+                        (table,))
+    return detached
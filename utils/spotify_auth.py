@@ -1,29 +1,226 @@
 from utils.logger import log_event
 from spotipy.oauth2 import SpotifyOAuth
 import os
+import time
+import hashlib
+import threading
 import requests
-from spotipy import Spotify
+from requests.adapters import HTTPAdapter
+from spotipy import Spotify, SpotifyException
+from utils.spotify_rate_limit import get_call_policy
+
+TOKEN_URL = "https://accounts.spotify.com/api/token"
+
+# Refresh this many seconds before Spotify says the token expires
+TOKEN_EXPIRY_MARGIN_S = int(os.getenv("SPOTIFY_TOKEN_EXPIRY_MARGIN_S", "60"))
+# Opt-in: share access tokens between processes through the spotify_token_cache table
+TOKEN_DB_CACHE = os.getenv("SPOTIFY_TOKEN_DB_CACHE", "false").lower() in ("1", "true", "yes")
+HTTP_POOL_SIZE = int(os.getenv("SPOTIFY_HTTP_POOL_SIZE", "20"))
+HTTP_TIMEOUT_S = int(os.getenv("SPOTIFY_HTTP_TIMEOUT_S", "10"))
+
+
+# ─────────────────────────────────────────────
+# Shared keep-alive HTTP session
+# ─────────────────────────────────────────────
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_http_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                # No adapter-level retries: 429/5xx/timeouts are handled by the
+                # shared call policy in utils.spotify_rate_limit
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+                session.mount("https://", adapter)
+                session.headers.update({"Accept-Encoding": "gzip, deflate"})
+                _session = session
+    return _session
+
+
+# ─────────────────────────────────────────────
+# Access token cache
+# ─────────────────────────────────────────────
+class RefreshTokenAuthManager:
+    """Spotipy-compatible auth manager that exchanges a long-lived refresh
+    token for access tokens and reuses them until shortly before expiry."""
+
+    def __init__(self, refresh_token, client_id, client_secret, session=None):
+        self.refresh_token = refresh_token
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.session = session or get_http_session()
+        self._lock = threading.Lock()
+        self._access_token = None
+        self._expires_at = 0.0
+        self._cache_key = hashlib.sha256(refresh_token.encode()).hexdigest()
+
+    def _fresh(self):
+        return self._access_token and time.time() < self._expires_at - TOKEN_EXPIRY_MARGIN_S
+
+    def get_access_token(self, as_dict=False):
+        if not self._fresh():
+            with self._lock:
+                if not self._fresh():
+                    if not (TOKEN_DB_CACHE and self._load_from_db()):
+                        self._request_token()
+        if as_dict:
+            return {"access_token": self._access_token, "expires_at": int(self._expires_at)}
+        return self._access_token
+
+    def invalidate(self, token=None):
+        """Drop the cached token (only if it is still ``token``, when given)."""
+        with self._lock:
+            if token is None or token == self._access_token:
+                self._access_token = None
+                self._expires_at = 0.0
+                if TOKEN_DB_CACHE:
+                    self._delete_from_db(token)
+
+    def _request_token(self):
+        response = self.session.post(
+            TOKEN_URL,
+            data={
+                "grant_type": "refresh_token",
+                "refresh_token": self.refresh_token,
+                "client_id": self.client_id,
+                "client_secret": self.client_secret,
+            },
+            timeout=HTTP_TIMEOUT_S,
+        )
+        response.raise_for_status()
+        payload = response.json()
+        access_token = payload.get("access_token")
+        if not access_token:
+            raise Exception("❌ Failed to get access token from Spotify.")
+        self._access_token = access_token
+        self._expires_at = time.time() + int(payload.get("expires_in", 3600))
+        log_event("auth", "🔑 Obtained new Spotify access token")
+        if TOKEN_DB_CACHE:
+            self._save_to_db()
+
+    # DB cache helpers never fail the caller; the token endpoint is the fallback
+    def _load_from_db(self):
+        from utils.db_utils import get_db_connection
+        try:
+            conn = get_db_connection()
+            try:
+                cur = conn.cursor()
+                cur.execute("""
+                    SELECT access_token, EXTRACT(EPOCH FROM expires_at)
+                    FROM spotify_token_cache
+                    WHERE cache_key = %s
+                """, (self._cache_key,))
+                row = cur.fetchone()
+                cur.close()
+            finally:
+                conn.close()
+        except Exception as e:
+            log_event("auth", f"⚠️ Could not read cached Spotify token: {e}", level="warning")
+            return False
+        if not row or time.time() >= float(row[1]) - TOKEN_EXPIRY_MARGIN_S:
+            return False
+        self._access_token = row[0]
+        self._expires_at = float(row[1])
+        return True
+
+    def _save_to_db(self):
+        from utils.db_utils import get_db_connection
+        try:
+            conn = get_db_connection()
+            try:
+                cur = conn.cursor()
+                cur.execute("""
+                    INSERT INTO spotify_token_cache (cache_key, access_token, expires_at, updated_at)
+                    VALUES (%s, %s, TO_TIMESTAMP(%s), NOW())
+                    ON CONFLICT (cache_key) DO UPDATE
+                    SET access_token = EXCLUDED.access_token,
+                        expires_at = EXCLUDED.expires_at,
+                        updated_at = NOW()
+                """, (self._cache_key, self._access_token, self._expires_at))
+                conn.commit()
+                cur.close()
+            finally:
+                conn.close()
+        except Exception as e:
+            log_event("auth", f"⚠️ Could not cache Spotify token: {e}", level="warning")
+
+    def _delete_from_db(self, token):
+        from utils.db_utils import get_db_connection
+        try:
+            conn = get_db_connection()
+            try:
+                cur = conn.cursor()
+                cur.execute("""
+                    DELETE FROM spotify_token_cache
+                    WHERE cache_key = %s AND (%s IS NULL OR access_token = %s)
+                """, (self._cache_key, token, token))
+                conn.commit()
+                cur.close()
+            finally:
+                conn.close()
+        except Exception as e:
+            log_event("auth", f"⚠️ Could not clear cached Spotify token: {e}", level="warning")
+
+
+# ─────────────────────────────────────────────
+# Spotify client with transparent re-auth
+# ─────────────────────────────────────────────
+class SpotifyClient(Spotify):
+    """Spotify client that sends every request through the shared rate
+    limiter / retry policy, and refreshes its access token and retries
+    once when a request comes back 401 mid-run."""
+
+    def _internal_call(self, method, url, payload, params):
+        return get_call_policy().call(
+            method, url, lambda: self._call_with_reauth(method, url, payload, params)
+        )
+
+    def _call_with_reauth(self, method, url, payload, params):
+        token = self.auth_manager.get_access_token(as_dict=False)
+        try:
+            # spotipy mutates params, so hand it a copy in case we retry
+            return super()._internal_call(method, url, payload, dict(params))
+        except SpotifyException as e:
+            if e.http_status != 401:
+                raise
+            log_event("auth", "🔄 Spotify returned 401; refreshing access token and retrying")
+            self.auth_manager.invalidate(token)
+            return super()._internal_call(method, url, payload, dict(params))
+
+
+_client = None
+_client_lock = threading.Lock()
+
 
 def get_spotify_client():
+    """Return the process-wide Spotify client (token cached and auto-refreshed)."""
+    global _client
     refresh_token = os.environ.get("SPOTIFY_REFRESH_TOKEN")
     if not refresh_token:
-        log_event("auth", "error", "❌ SPOTIFY_REFRESH_TOKEN not set in environment.")
+        log_event("auth", "❌ SPOTIFY_REFRESH_TOKEN not set in environment.", level="error")
         raise Exception("❌ SPOTIFY_REFRESH_TOKEN not set in environment.")
 
-    token_response = requests.post(
-        "https://accounts.spotify.com/api/token",
-        data={
-            "grant_type": "refresh_token",
-            "refresh_token": refresh_token,
-            "client_id": os.environ["SPOTIFY_CLIENT_ID"],
-            "client_secret": os.environ["SPOTIFY_CLIENT_SECRET"],
-        }
-    )
-    token_response.raise_for_status()
-    access_token = token_response.json().get("access_token")
-    if not access_token:
-        raise Exception("❌ Failed to get access token from Spotify.")
-    return Spotify(auth=access_token)
+    with _client_lock:
+        if _client is None or _client.auth_manager.refresh_token != refresh_token:
+            session = get_http_session()
+            auth_manager = RefreshTokenAuthManager(
+                refresh_token,
+                os.environ["SPOTIFY_CLIENT_ID"],
+                os.environ["SPOTIFY_CLIENT_SECRET"],
+                session=session,
+            )
+            # Fail fast, as before, if the refresh token is bad
+            auth_manager.get_access_token()
+            _client = SpotifyClient(
+                auth_manager=auth_manager,
+                requests_session=session,
+                requests_timeout=HTTP_TIMEOUT_S,
+            )
+        return _client
 
 
 # Returns a SpotifyOAuth instance using environment variables (used during login flow)
@@ -33,4 +230,4 @@ def get_spotify_oauth():
         client_secret=os.environ['SPOTIFY_CLIENT_SECRET'],
         redirect_uri=os.environ['SPOTIFY_REDIRECT_URI'],
         scope="user-read-recently-played user-library-read playlist-modify-private playlist-modify-public"
-    )
\ No newline at end of file
+    )
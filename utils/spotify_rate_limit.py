@@ -0,0 +1,249 @@
+"""
+Shared call policy for every Spotify Web API request made by this process.
+
+- Adaptive token bucket: starts at SPOTIFY_RATE_PER_S requests/second, halves
+  (and pauses for Retry-After) on every 429, then creeps back up on success.
+- Jittered exponential backoff for transient failures (5xx, timeouts,
+  dropped connections).
+- Circuit breaker: after SPOTIFY_BREAKER_THRESHOLD consecutive transient
+  failures, calls fail fast for SPOTIFY_BREAKER_RESET_S seconds.
+- Per-endpoint concurrency limits ("tracks", "albums", "me/tracks", ...),
+  so a thread pool can't flood one endpoint.
+
+utils.spotify_auth.SpotifyClient routes every request through
+get_call_policy(), so callers just use the spotipy methods directly.
+"""
+import os
+import time
+import random
+import threading
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from spotipy.exceptions import SpotifyException
+
+from utils.logger import log_event
+
+# ─────────────────────────────────────────────
+# Tunables (via env vars)
+# ─────────────────────────────────────────────
+RATE_PER_S = float(os.getenv("SPOTIFY_RATE_PER_S", "10"))
+RATE_MIN_PER_S = float(os.getenv("SPOTIFY_RATE_MIN_PER_S", "0.5"))
+RATE_MAX_PER_S = float(os.getenv("SPOTIFY_RATE_MAX_PER_S", "30"))
+BURST = int(os.getenv("SPOTIFY_BURST", "10"))
+MAX_RETRIES = int(os.getenv("SPOTIFY_MAX_RETRIES", "8"))
+BACKOFF_BASE_S = float(os.getenv("SPOTIFY_BACKOFF_BASE_S", "0.5"))
+BACKOFF_MAX_S = float(os.getenv("SPOTIFY_BACKOFF_MAX_S", "60"))
+BREAKER_THRESHOLD = int(os.getenv("SPOTIFY_BREAKER_THRESHOLD", "10"))
+BREAKER_RESET_S = float(os.getenv("SPOTIFY_BREAKER_RESET_S", "60"))
+DEFAULT_CONCURRENCY = int(os.getenv("SPOTIFY_MAX_CONCURRENCY", "8"))
+# e.g. "search=2,tracks=8,me/tracks=1"
+ENDPOINT_CONCURRENCY = os.getenv("SPOTIFY_ENDPOINT_CONCURRENCY", "")
+
+TRANSIENT_STATUSES = {500, 502, 503, 504}
+TRANSIENT_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError)
+
+
+class CircuitOpenError(SpotifyException):
+    """Raised without calling Spotify while the circuit breaker is open."""
+
+    def __init__(self, retry_in):
+        super().__init__(503, -1, f"Spotify circuit breaker open; retry in {retry_in:.0f}s")
+
+
+class AdaptiveTokenBucket:
+    """Token bucket whose refill rate adapts to Spotify's 429 responses (AIMD)."""
+
+    def __init__(self, rate=RATE_PER_S, burst=BURST, min_rate=RATE_MIN_PER_S, max_rate=RATE_MAX_PER_S):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                else:
+                    self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def on_throttle(self, retry_after):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = 0.0
+            self._updated = time.monotonic()
+            self._paused_until = max(self._paused_until, self._updated + retry_after)
+
+    def on_success(self):
+        with self._lock:
+            if self.rate < self.max_rate:
+                # Additive increase: roughly +1 req/s per second of clean traffic
+                self.rate = min(self.max_rate, self.rate + 1.0 / max(self.rate, 1.0))
+
+
+class CircuitBreaker:
+    def __init__(self, threshold=BREAKER_THRESHOLD, reset_after=BREAKER_RESET_S):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            elapsed = time.monotonic() - self._opened_at
+            if elapsed < self.reset_after:
+                raise CircuitOpenError(self.reset_after - elapsed)
+            # Half-open: let this call through as a probe
+            self._opened_at = None
+            self._failures = self.threshold - 1
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.threshold and self._opened_at is None:
+                self._opened_at = time.monotonic()
+                log_event("spotify_api", f"🚧 Circuit breaker opened after {self._failures} consecutive failures",
+                          level="error")
+
+
+def _parse_concurrency_overrides(spec):
+    overrides = {}
+    for part in spec.split(","):
+        if "=" in part:
+            name, value = part.split("=", 1)
+            overrides[name.strip()] = int(value)
+    return overrides
+
+
+def endpoint_of(url):
+    """Map a request URL to the endpoint key used for concurrency limits."""
+    path = urlparse(url).path
+    parts = [p for p in path.split("/") if p and p != "v1"]
+    if not parts:
+        return "root"
+    if parts[0] == "me" and len(parts) > 1:
+        return f"me/{parts[1]}"
+    return parts[0]
+
+
+def _retry_after(e):
+    headers = getattr(e, "headers", None) or {}
+    try:
+        return max(1.0, float(headers.get("Retry-After", 5)))
+    except (TypeError, ValueError):
+        return 5.0
+
+
+def _backoff(attempt):
+    # "Full jitter" exponential backoff
+    return random.uniform(0, min(BACKOFF_MAX_S, BACKOFF_BASE_S * (2 ** attempt)))
+
+
+class SpotifyCallPolicy:
+    def __init__(self):
+        self.bucket = AdaptiveTokenBucket()
+        self.breaker = CircuitBreaker()
+        self._overrides = _parse_concurrency_overrides(ENDPOINT_CONCURRENCY)
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def _semaphore(self, endpoint):
+        with self._lock:
+            sem = self._semaphores.get(endpoint)
+            if sem is None:
+                sem = threading.BoundedSemaphore(self._overrides.get(endpoint, DEFAULT_CONCURRENCY))
+                self._semaphores[endpoint] = sem
+            return sem
+
+    def call(self, method, url, fn):
+        """Run ``fn()`` (one HTTP request) under the shared limits and retry policy."""
+        endpoint = endpoint_of(url)
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            self.bucket.acquire()
+            try:
+                with self._semaphore(endpoint):
+                    result = fn()
+            except SpotifyException as e:
+                if e.http_status == 429 and attempt < MAX_RETRIES:
+                    wait = _retry_after(e)
+                    self.bucket.on_throttle(wait)
+                    log_event("spotify_api", f"⏳ Rate limited on {endpoint}; backing off {wait:.0f}s "
+                                             f"(rate now {self.bucket.rate:.1f}/s)", level="warning")
+                    attempt += 1
+                    continue
+                if e.http_status in TRANSIENT_STATUSES:
+                    self.breaker.record_failure()
+                    # A 5xx on a write may still have been applied; only reads are replayed
+                    if method == "GET" and attempt < MAX_RETRIES:
+                        wait = _backoff(attempt)
+                        log_event("spotify_api", f"⚠️ {e.http_status} from {endpoint}; retry #{attempt + 1} in {wait:.1f}s",
+                                  level="warning")
+                        time.sleep(wait)
+                        attempt += 1
+                        continue
+                raise
+            except TRANSIENT_ERRORS as e:
+                self.breaker.record_failure()
+                # A read timeout on a write may have been applied; don't replay it
+                replay_safe = method == "GET" or isinstance(e, requests.exceptions.ConnectTimeout)
+                if replay_safe and attempt < MAX_RETRIES:
+                    wait = _backoff(attempt)
+                    log_event("spotify_api", f"⚠️ {type(e).__name__} on {endpoint}; retry #{attempt + 1} in {wait:.1f}s",
+                              level="warning")
+                    time.sleep(wait)
+                    attempt += 1
+                    continue
+                raise
+            self.breaker.record_success()
+            self.bucket.on_success()
+            return result
+
+
+_policy = None
+_policy_lock = threading.Lock()
+
+
+def get_call_policy():
+    global _policy
+    if _policy is None:
+        with _policy_lock:
+            if _policy is None:
+                _policy = SpotifyCallPolicy()
+    return _policy
+
+
+def spotify_map(func, items, max_workers=DEFAULT_CONCURRENCY):
+    """``[func(item) for item in items]``, run concurrently; order is preserved.
+
+    Throughput is governed by the shared call policy, so ``max_workers``
+    only bounds how many requests may be in flight at once.
+    """
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="spotify") as pool:
+        return list(pool.map(func, items))
@@ -0,0 +1,39 @@
+"""
+Small key/value store for job cursors and high-water marks (sync_state table),
+e.g. the last ingested play timestamp or a resumable paging offset.
+
+Reads and writes use the caller's cursor, so a mark can be committed in the
+same transaction as the data it describes.
+"""
+
+SYNC_STATE_TABLE = """
+CREATE TABLE IF NOT EXISTS sync_state (
+    key TEXT PRIMARY KEY,
+    value TEXT,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+"""
+
+
+def ensure_sync_state(cur):
+    cur.execute(SYNC_STATE_TABLE)
+
+
+def get_state(cur, key, default=None):
+    cur.execute("SELECT value FROM sync_state WHERE key = %s", (key,))
+    row = cur.fetchone()
+    return row[0] if row and row[0] is not None else default
+
+
+def set_state(cur, key, value):
+    cur.execute("""
+        INSERT INTO sync_state (key, value, updated_at)
+        VALUES (%s, %s, NOW())
+        ON CONFLICT (key) DO UPDATE
+        SET value = EXCLUDED.value,
+            updated_at = NOW()
+    """, (key, None if value is None else str(value)))
+
+
+def clear_state(cur, key):
+    cur.execute("DELETE FROM sync_state WHERE key = %s", (key,))